@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from common import REPO_ROOT, WORDS, setup_environment, synthetic_text
+from stub_ollama import start_server
+
+# Stand-in for a French translation: every word is replaced, so no shingle is shared with the original
+TRANSLATION = {word: word[::-1] + "e" for word in WORDS}
+
+
+def reprint(text, rng, edit_rate):
+  # Another edition: a new cover line and a few words changed throughout
+  words = text.split(" ")
+  for i in rng.sample(range(len(words)), int(len(words) * edit_rate)):
+    words[i] = rng.choice(WORDS)
+  return f"Revised edition {rng.randint(2001, 2024)}\n\n" + " ".join(words)
+
+
+def translate(text):
+  return "\n\n".join(" ".join(TRANSLATION.get(word, word) for word in paragraph.split(" "))
+                     for paragraph in text.split("\n\n"))
+
+
+def make_corpus(folder, docs, reprint_share, twin_share, edit_rate, paragraphs, seed=0):
+  """
+    Writes `docs` unrelated documents, plus a reprint of `reprint_share` of them and a
+    translated twin of `twin_share` of them.
+    :return: The expected (original, duplicate) pairs of reprints and of twins.
+    """
+  rng = random.Random(seed)
+  reprints, twins = [], []
+  for i in range(docs):
+    text = synthetic_text(paragraphs=paragraphs, words_per_paragraph=80, seed=seed + i)
+    (folder / f"doc{i:04d}.txt").write_text(text, encoding="utf-8")
+    if rng.random() < reprint_share:
+      (folder / f"doc{i:04d}r.txt").write_text(reprint(text, rng, edit_rate), encoding="utf-8")
+      reprints.append((f"doc{i:04d}", f"doc{i:04d}r"))
+    if rng.random() < twin_share:
+      (folder / f"doc{i:04d}f.txt").write_text(translate(text), encoding="utf-8")
+      twins.append((f"doc{i:04d}", f"doc{i:04d}f"))
+  return reprints, twins
+
+
+def run_process(input_path, work_dir, env, extra_args) -> tuple[dict, float]:
+  # A fresh database and LLM cache per run, so that nothing is reused between the two runs
+  env = dict(env, VECTOR_DB_PATH=str(work_dir / "lance_db"), LLM_CACHE_PATH=str(work_dir / "llm_cache.sqlite"))
+  start = time.perf_counter()
+  result = subprocess.run([sys.executable, str(REPO_ROOT / "process.py"), str(input_path), "--export-formats", "json",
+                           "--metrics-json", str(work_dir / "metrics.json")] + extra_args,
+                          cwd=work_dir,
+                          env=env,
+                          capture_output=True,
+                          text=True)
+  seconds = time.perf_counter() - start
+  if result.returncode != 0:
+    raise RuntimeError(result.stderr.strip().splitlines()[-1])
+  with open(work_dir / "metrics.json", encoding="utf-8") as f:
+    return json.load(f), seconds
+
+
+def totals(summary) -> dict:
+  stages, counters = {}, {}
+  for stage in summary["stages"]:
+    stages[stage["stage"]] = stages.get(stage["stage"], 0) + stage["count"]
+  for counter in summary["counters"]:
+    counters[counter["name"]] = counters.get(counter["name"], 0) + counter["value"]
+  return {
+      "embed requests": stages.get("embed_request", 0),
+      "embedded chunks": counters.get("embedded_chunks", 0),
+      "LLM requests": stages.get("llm_request", 0),
+  }
+
+
+def grouped_pairs(groups_path) -> set:
+  import sqlite3
+  connection = sqlite3.connect(groups_path)
+  rows = connection.execute("SELECT doc_id, representative FROM duplicates WHERE doc_id != representative").fetchall()
+  return {frozenset(row) for row in rows}
+
+
+def main(args):
+  server, url = start_server(latency=args.latency)
+  setup_environment(url)
+  env = dict(os.environ, PYTHONPATH=str(REPO_ROOT))
+  work_dir = Path(tempfile.mkdtemp(prefix="govdocs-dedup-"))
+  reprints, twins = [], []
+  if args.input:
+    input_path = Path(args.input)
+  else:
+    input_path = work_dir / "text"
+    input_path.mkdir()
+    reprints, twins = make_corpus(input_path, args.docs, args.reprints, args.twins, args.edit_rate, args.paragraphs)
+  print(f"{len(list(input_path.rglob('*.txt')))} documents in {input_path}, stub latency {args.latency}s")
+  results = {}
+  for name, extra_args in (("all", []), (f"--dedup {args.mode}", ["--dedup", args.mode,
+                                                                   "--dedup-threshold", str(args.threshold)])):
+    run_dir = work_dir / name.strip("-").replace(" ", "_")
+    run_dir.mkdir()
+    summary, seconds = run_process(input_path, run_dir, env, extra_args)
+    results[name] = dict(totals(summary), seconds=seconds)
+    if extra_args:
+      dedup = next((stage for stage in summary["stages"] if stage["stage"] == "dedup"), {"seconds": 0.0})
+      print(f"Grouping took {dedup['seconds']:.2f}s")
+      pairs = grouped_pairs(run_dir / "duplicates.sqlite")
+  print(f"{'':>16} {'embed requests':>15} {'embedded chunks':>16} {'LLM requests':>13} {'seconds':>8}")
+  for name, result in results.items():
+    print(f"{name:>16} {result['embed requests']:15d} {result['embedded chunks']:16d} {result['LLM requests']:13d} "
+          f"{result['seconds']:8.1f}")
+  first, second = results.values()
+  for key in ("embed requests", "LLM requests"):
+    saved = first[key] - second[key]
+    print(f"{key} saved: {saved} ({saved / max(first[key], 1):.0%})")
+  if reprints or twins:
+    found_reprints = sum(frozenset(pair) in pairs for pair in reprints)
+    found_twins = sum(frozenset(pair) in pairs for pair in twins)
+    print(f"Reprints grouped: {found_reprints} of {len(reprints)}, translated twins grouped: {found_twins} of "
+          f"{len(twins)}, other documents grouped: {len(pairs) - found_reprints - found_twins}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Embed and LLM requests saved by processing one document per group of near-duplicates.")
+  parser.add_argument("input", nargs="?", help="Folder with .txt files (default: a synthetic corpus)")
+  parser.add_argument("--docs", type=int, default=40, help="Unrelated documents in the synthetic corpus")
+  parser.add_argument("--reprints", type=float, default=0.3, help="Share of the documents with a second edition")
+  parser.add_argument("--twins", type=float, default=0.2, help="Share of the documents with a translated twin")
+  parser.add_argument("--edit-rate", type=float, default=0.01, help="Share of the words changed in a reprint")
+  parser.add_argument("--paragraphs", type=int, default=20, help="Paragraphs per synthetic document")
+  parser.add_argument("--mode", choices=("copy", "link"), default="copy")
+  parser.add_argument("--threshold", type=float, default=0.8)
+  parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every stub request")
+  main(parser.parse_args())
@@ -0,0 +1,56 @@
+import time
+import argparse
+
+from common import setup_environment, synthetic_text
+from stub_ollama import start_server
+
+
+def embed_document_per_chunk(text, doc_id):
+  # Baseline behaviour: one request and one table write per chunk
+  from src.config import get_embeddings_table
+  from src.embed import chunk_text, get_embedding
+  for i, chunk in enumerate(chunk_text(text)):
+    embedding = get_embedding(chunk)
+    flat_embedding = [float(val) for sublist in embedding for val in sublist]
+    get_embeddings_table().add([{"doc_id": doc_id, "chunk_id": i, "content": chunk, "embedding": flat_embedding}])
+
+
+def main(num_docs, paragraphs, batch_sizes, latency):
+  server, url = start_server(latency=latency)
+  db_path = setup_environment(url)
+  from src.config import set_parameters
+  from src.embed import chunk_text, embed_document
+
+  # Every run gets texts of its own: embed_document reuses the stored vectors of chunks it has seen
+  # before, so repeating the texts would time those lookups instead of the embed requests
+  runs = [[synthetic_text(paragraphs, seed=run * num_docs + i) for i in range(num_docs)]
+          for run in range(len(batch_sizes) + 1)]
+  num_chunks = sum(len(chunk_text(text)) for text in runs[0])
+  print(f"{num_docs} documents, {num_chunks} chunks, {latency * 1000:.0f}ms stub latency, db at {db_path}")
+
+  texts = runs[0]
+  start = time.perf_counter()
+  for i, text in enumerate(texts):
+    embed_document_per_chunk(text, f"baseline-{i}")
+  elapsed = time.perf_counter() - start
+  print(f"per-chunk (baseline): {num_chunks / elapsed:8.1f} chunks/sec")
+
+  for batch_size, texts in zip(batch_sizes, runs[1:]):
+    set_parameters(force_rebuild=True, embed_batch_size=batch_size)
+    num_chunks = sum(len(chunk_text(text)) for text in texts)
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+      embed_document(text, f"batch{batch_size}-{i}.txt")
+    elapsed = time.perf_counter() - start
+    print(f"batch size {batch_size:>4}:     {num_chunks / elapsed:8.1f} chunks/sec")
+  server.shutdown()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark embed_document against a local stub server.")
+  parser.add_argument("--docs", type=int, default=5)
+  parser.add_argument("--paragraphs", type=int, default=200)
+  parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16, 32])
+  parser.add_argument("--latency", type=float, default=0.01, help="Seconds added to every stub request")
+  args = parser.parse_args()
+  main(args.docs, args.paragraphs, args.batch_sizes, args.latency)
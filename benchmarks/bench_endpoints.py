@@ -0,0 +1,102 @@
+import time
+import asyncio
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from common import setup_environment, synthetic_text
+from stub_ollama import start_server
+
+
+def run_sync(pool, texts, threads):
+  # Embeds every text from `threads` threads, like concurrent pipeline stages
+  from src.config import EMBEDDING_MODEL
+
+  def embed(text):
+    start = time.perf_counter()
+    try:
+      pool.embed(model=EMBEDDING_MODEL, input=text)
+      return time.perf_counter() - start, False
+    except Exception:
+      return time.perf_counter() - start, True
+
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    return list(executor.map(embed, texts))
+
+
+def run_async(pool, texts, concurrency):
+  from src.config import EMBEDDING_MODEL
+  from src.endpoints import AsyncEndpointPool
+  async_pool = AsyncEndpointPool(pool)
+  limiter = asyncio.Semaphore(concurrency)
+
+  async def embed(text):
+    async with limiter:
+      start = time.perf_counter()
+      try:
+        await async_pool.embed(model=EMBEDDING_MODEL, input=text)
+        return time.perf_counter() - start, False
+      except Exception:
+        return time.perf_counter() - start, True
+
+  async def embed_all():
+    return await asyncio.gather(*(embed(text) for text in texts))
+
+  return asyncio.run(embed_all())
+
+
+def report(phase, pool, results, elapsed):
+  latencies = [seconds for seconds, _ in results]
+  failures = sum(failed for _, failed in results)
+  print(f"{phase}: {len(results) / elapsed:.1f} requests/sec, p50 {np.percentile(latencies, 50) * 1000:.0f}ms, "
+        f"p95 {np.percentile(latencies, 95) * 1000:.0f}ms, {failures} failed")
+  for endpoint in pool.status():
+    latency = f"{endpoint['latency'] * 1000:.0f}ms" if endpoint["latency"] is not None else "-"
+    print(f"  {endpoint['name']:>8} {endpoint['requests']:5d} requests {endpoint['errors']:4d} errors "
+          f"latency {latency:>6}{'  ejected' if endpoint['ejected'] else ''}")
+  return failures
+
+
+def main(args):
+  healthy, healthy_url = start_server(latency=args.latency)
+  slow, slow_url = start_server(latency=args.slow_latency)
+  failing, failing_url = start_server(latency=args.latency, failure_rate=1.0)
+  setup_environment(",".join([healthy_url, slow_url, failing_url]))
+  from src import endpoints
+  from src.config import get_ollama_embed
+  endpoints.HEALTH_INTERVAL = args.health_interval
+  endpoints.BACKOFF = 0.05
+  pool = get_ollama_embed()
+  names = {healthy_url: "healthy", slow_url: "slow", failing_url: "failing"}
+  status = pool.status
+  pool.status = lambda: [{**endpoint, "name": names[endpoint["url"]]} for endpoint in status()]
+  texts = [synthetic_text(1, seed=i) for i in range(args.requests)]
+  print(f"{args.requests} requests per phase from {args.threads} threads; healthy {args.latency * 1000:.0f}ms, "
+        f"slow {args.slow_latency * 1000:.0f}ms, failing backend answers with errors")
+
+  failures = 0
+  start = time.perf_counter()
+  failures += report("sync, one backend failing", pool, run_sync(pool, texts, args.threads), time.perf_counter() - start)
+
+  # The failing backend recovers and is re-admitted by the next health check
+  failing.failure_rate = 0.0
+  time.sleep(args.health_interval * 1.5)
+  start = time.perf_counter()
+  failures += report("async, after recovery", pool, run_async(pool, texts, args.threads), time.perf_counter() - start)
+
+  for server in (healthy, slow, failing):
+    server.shutdown()
+  if failures:
+    print(f"FAILED: {failures} requests failed although a healthy backend was available")
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Route embedding requests across healthy, slow and failing stub servers.")
+  parser.add_argument("--requests", type=int, default=300)
+  parser.add_argument("--threads", type=int, default=8)
+  parser.add_argument("--latency", type=float, default=0.01, help="Seconds per request of the healthy backends")
+  parser.add_argument("--slow-latency", type=float, default=0.2, help="Seconds per request of the slow backend")
+  parser.add_argument("--health-interval", type=float, default=1.0, help="Seconds between health checks")
+  main(parser.parse_args())
@@ -0,0 +1,97 @@
+import os
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+
+from common import setup_environment, WORDS
+
+
+def percentile(values, q):
+  return float(np.percentile(np.array(values) * 1000, q))
+
+
+def identifier(i):
+  # ISBN-like number that appears in exactly one chunk
+  return f"978-0-{7000 + i % 3000}-{i:06d}"
+
+
+def populate(table, start, stop, dimensions, docs, seed=0):
+  # Random vectors and text, with an identifier in every 100th chunk
+  rng = np.random.default_rng(seed + start)
+  batch_size = 10000
+  for batch_start in range(start, stop, batch_size):
+    count = min(batch_size, stop - batch_start)
+    vectors = rng.normal(size=(count, dimensions)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(batch_start, batch_start + count)
+    contents = []
+    for i in ids:
+      content = " ".join(WORDS[j] for j in rng.integers(0, len(WORDS), 80))
+      if i % 100 == 0:
+        content += f" ISBN {identifier(i)}"
+      contents.append(content)
+    table.add(
+        pa.Table.from_pydict(
+            {
+                "doc_id": [f"doc{i % docs}" for i in ids],
+                "chunk_id": ids.tolist(),
+                "content": contents,
+                "chunk_hash": [f"hash{i}" for i in ids],
+                "embedding": pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), dimensions),
+            },
+            schema=table.schema))
+
+
+def run_queries(mode, queries, k, nprobes):
+  from src.search import search_vector, search_text, search_hybrid
+  latencies, found = [], 0
+  for query_text, vector, target in queries:
+    start = time.perf_counter()
+    if mode == "vector":
+      results = search_vector(vector, k, nprobes=nprobes)
+    elif mode == "text":
+      results = search_text(query_text, k)
+    else:
+      results = search_hybrid(query_text, vector, k, nprobes=nprobes)
+    latencies.append(time.perf_counter() - start)
+    found += target in results["chunk_id"].to_pylist()
+  return latencies, found / len(queries)
+
+
+def main(sizes, dimensions, k, num_queries, nprobes):
+  # Nothing is embedded: the queries come with their vectors
+  setup_environment("http://127.0.0.1:9")
+  os.environ["EMBEDDING_DIM"] = str(dimensions)
+  from src.config import get_embeddings_table
+  from src.search import build_index, build_fts_index
+  table = get_embeddings_table()
+  rng = np.random.default_rng(1)
+  print(f"{dimensions} dimensions, {num_queries} identifier queries per mode, k={k}, nprobes {nprobes}")
+  print(f"{'chunks':>8} {'mode':>7} {'p50 ms':>8} {'p95 ms':>8} {'found':>6}")
+  rows = 0
+  for size in sorted(sizes):
+    populate(table, rows, size, dimensions, docs=max(1, size // 50))
+    rows = size
+    build_index("IVF_PQ")
+    build_fts_index()
+    targets = rng.choice(np.arange(0, rows, 100), num_queries)
+    queries = []
+    for target in targets:
+      vector = rng.normal(size=dimensions).astype(np.float32)
+      queries.append((f"ISBN {identifier(target)}", vector / np.linalg.norm(vector), int(target)))
+    for mode in ("vector", "text", "hybrid"):
+      latencies, found = run_queries(mode, queries, k, nprobes)
+      print(f"{rows:8d} {mode:>7} {percentile(latencies, 50):8.1f} {percentile(latencies, 95):8.1f} {found:6.0%}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Latency of hybrid (full-text + vector) versus vector-only search as the corpus grows.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000], help="Numbers of chunks")
+  parser.add_argument("--dimensions", type=int, default=1024)
+  parser.add_argument("-k", type=int, default=10)
+  parser.add_argument("--queries", type=int, default=50)
+  parser.add_argument("--nprobes", type=int, default=20)
+  args = parser.parse_args()
+  main(args.sizes, args.dimensions, args.k, args.queries, args.nprobes)
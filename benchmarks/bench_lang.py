@@ -0,0 +1,56 @@
+import sys
+import time
+import argparse
+from collections import Counter
+
+from PIL import Image
+
+import common  # noqa: F401 (puts the repository root on sys.path)
+import ocr_pdf
+from bench_preprocess import load_pages
+
+
+def main(paths, pages_per_file, dpi, fixed_lang):
+  ocr_pdf.DPI = dpi
+  images = load_pages(paths, pages_per_file, dpi)
+  if not images:
+    sys.exit("No pages to benchmark")
+  processed_images = []
+  for image in images:
+    processed_image = Image.fromarray(ocr_pdf.preprocess_image(image))
+    processed_image.info['dpi'] = (dpi, dpi)
+    processed_images.append(processed_image)
+  print(f"{len(images)} pages at {dpi} dpi, {ocr_pdf.PREPROCESS} preprocessing")
+
+  ocr_pdf.LANG = fixed_lang
+  start = time.perf_counter()
+  for image in images:
+    ocr_pdf.ocr_image(image)
+  fixed_elapsed = time.perf_counter() - start
+
+  detected = Counter()
+  start = time.perf_counter()
+  for processed_image in processed_images:
+    detected[ocr_pdf.detect_language(processed_image)] += 1
+  detect_elapsed = time.perf_counter() - start
+
+  ocr_pdf.LANG = "auto"
+  start = time.perf_counter()
+  for image in images:
+    ocr_pdf.ocr_image(image)
+  auto_elapsed = time.perf_counter() - start
+
+  print(f"{fixed_lang:>8}: {len(images) / fixed_elapsed:6.2f} pages/sec")
+  print(f"{'auto':>8}: {len(images) / auto_elapsed:6.2f} pages/sec "
+        f"(detection {detect_elapsed / len(images) * 1000:.0f} ms/page)")
+  print("Detected languages: " + ", ".join(f"{lang} {count}" for lang, count in detected.most_common()))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare fixed and per-page automatic OCR languages on sample pages.")
+  parser.add_argument("paths", nargs="+", help="Sample pdf or image files")
+  parser.add_argument("--pages", type=int, default=5, help="Pages sampled from each pdf")
+  parser.add_argument("--dpi", type=int, default=ocr_pdf.DPI)
+  parser.add_argument("--lang", default="eng+fra", help="Fixed language to compare against")
+  args = parser.parse_args()
+  main(args.paths, args.pages, args.dpi, args.lang)
@@ -0,0 +1,66 @@
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pytesseract
+from PIL import Image
+from pdf2image import convert_from_path
+
+import common  # noqa: F401 (puts the repository root on sys.path)
+import ocr_pdf
+
+
+def load_pages(paths, pages_per_file, dpi):
+  # Sample the first pages of every pdf, or use image files as they are
+  images = []
+  for path in paths:
+    path = Path(path)
+    if path.suffix.lower() == ".pdf":
+      images.extend(convert_from_path(str(path), dpi=dpi, first_page=1, last_page=pages_per_file))
+    else:
+      images.append(Image.open(path).convert("RGB"))
+  return images
+
+
+def mean_confidence(image):
+  # Mean tesseract word confidence, ignoring the layout boxes (confidence -1)
+  data = pytesseract.image_to_data(image,
+                                   lang=ocr_pdf.LANG,
+                                   config=f"--dpi {ocr_pdf.DPI}",
+                                   output_type=pytesseract.Output.DICT)
+  confidences = [float(conf) for conf in data["conf"] if float(conf) >= 0]
+  return float(np.mean(confidences)) if confidences else 0.0
+
+
+def main(paths, profiles, pages_per_file, dpi):
+  ocr_pdf.DPI = dpi
+  images = load_pages(paths, pages_per_file, dpi)
+  if not images:
+    sys.exit("No pages to benchmark")
+  print(f"{len(images)} pages at {dpi} dpi, language {ocr_pdf.LANG}")
+  print(f"{'profile':>8} {'preprocess ms':>14} {'tesseract ms':>13} {'confidence':>11}")
+  for profile in profiles:
+    preprocess_times, ocr_times, confidences = [], [], []
+    for image in images:
+      start = time.perf_counter()
+      processed_image = Image.fromarray(ocr_pdf.preprocess_image(image, profile))
+      preprocess_times.append(time.perf_counter() - start)
+      processed_image.info['dpi'] = (dpi, dpi)
+      start = time.perf_counter()
+      pytesseract.image_to_string(processed_image, lang=ocr_pdf.LANG, config=f"--dpi {dpi}")
+      ocr_times.append(time.perf_counter() - start)
+      confidences.append(mean_confidence(processed_image))
+    print(f"{profile:>8} {np.mean(preprocess_times) * 1000:14.1f} {np.mean(ocr_times) * 1000:13.1f} "
+          f"{np.mean(confidences):11.1f}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare the OCR preprocessing profiles on sample pages.")
+  parser.add_argument("paths", nargs="+", help="Sample pdf or image files")
+  parser.add_argument("--profiles", nargs="+", choices=ocr_pdf.PREPROCESS_PROFILES, default=list(ocr_pdf.PREPROCESS_PROFILES))
+  parser.add_argument("--pages", type=int, default=3, help="Pages sampled from each pdf")
+  parser.add_argument("--dpi", type=int, default=ocr_pdf.DPI)
+  args = parser.parse_args()
+  main(args.paths, args.profiles, args.pages, args.dpi)
@@ -0,0 +1,86 @@
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+
+from common import setup_environment
+from stub_ollama import start_server
+
+
+def percentile(values, q):
+  return float(np.percentile(np.array(values) * 1000, q))
+
+
+def populate(table, rows, dimensions, docs, seed=0):
+  # Clustered random vectors, written in batches
+  rng = np.random.default_rng(seed)
+  centers = rng.normal(size=(64, dimensions)).astype(np.float32)
+  batch_size = 10000
+  for start in range(0, rows, batch_size):
+    count = min(batch_size, rows - start)
+    vectors = centers[rng.integers(0, len(centers), count)] + rng.normal(scale=0.5, size=(count, dimensions))
+    vectors = vectors.astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(start, start + count)
+    table.add(
+        pa.Table.from_pydict(
+            {
+                "doc_id": [f"doc{i % docs}" for i in ids],
+                "chunk_id": ids.tolist(),
+                "content": [f"chunk {i}" for i in ids],
+                "chunk_hash": [f"hash{i}" for i in ids],
+                "embedding": pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), dimensions),
+            },
+            schema=table.schema))
+  return centers
+
+
+def run_queries(queries, k, exact, nprobes, refine_factor=None):
+  from src.search import search_vector
+  latencies = []
+  results = []
+  for vector in queries:
+    start = time.perf_counter()
+    found = search_vector(vector, k, nprobes=nprobes, refine_factor=refine_factor, exact=exact)
+    latencies.append(time.perf_counter() - start)
+    results.append(set(zip(found["doc_id"].to_pylist(), found["chunk_id"].to_pylist())))
+  return results, latencies
+
+
+def main(rows, dimensions, k, num_queries, index_type, nprobes):
+  server, url = start_server(dimensions=dimensions)
+  setup_environment(url)
+  import os
+  os.environ["EMBEDDING_DIM"] = str(dimensions)
+  from src.config import get_embeddings_table
+  from src.search import build_index
+  print(f"Populating {rows} vectors of {dimensions} dimensions ...")
+  centers = populate(get_embeddings_table(), rows, dimensions, docs=max(1, rows // 50))
+  rng = np.random.default_rng(1)
+  queries = centers[rng.integers(0, len(centers), num_queries)] + rng.normal(scale=0.5, size=(num_queries, dimensions))
+  queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+  exact, exact_latencies = run_queries(queries, k, True, nprobes)
+  print(f"brute force:  p50 {percentile(exact_latencies, 50):7.1f}ms  p99 {percentile(exact_latencies, 99):7.1f}ms")
+  start = time.perf_counter()
+  build_index(index_type)
+  print(f"{index_type} index built in {time.perf_counter() - start:.1f}s")
+  for refine_factor in (None, 10):
+    for probes in sorted({max(1, nprobes // 4), nprobes, nprobes * 4}):
+      approximate, latencies = run_queries(queries, k, False, probes, refine_factor)
+      recall = np.mean([len(a & e) / len(e) for a, e in zip(approximate, exact) if e])
+      print(f"nprobes {probes:>4} refine {refine_factor or '-':>4}: recall@{k} {recall:.3f}  "
+            f"p50 {percentile(latencies, 50):7.1f}ms  p99 {percentile(latencies, 99):7.1f}ms")
+  server.shutdown()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark ANN search recall and latency against brute force.")
+  parser.add_argument("--rows", type=int, default=50000)
+  parser.add_argument("--dimensions", type=int, default=1024)
+  parser.add_argument("-k", type=int, default=10)
+  parser.add_argument("--queries", type=int, default=100)
+  parser.add_argument("--type", default="IVF_PQ")
+  parser.add_argument("--nprobes", type=int, default=20)
+  args = parser.parse_args()
+  main(args.rows, args.dimensions, args.k, args.queries, args.type, args.nprobes)
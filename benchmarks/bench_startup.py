@@ -0,0 +1,71 @@
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+from common import REPO_ROOT, setup_environment
+from stub_ollama import start_server
+
+# Entry point: (module to import, first call after the import)
+ENTRY_POINTS = {
+    "src.embed": ("src.embed", "src.embed.get_embedding('startup benchmark')"),
+    "src.metadata": ("src.metadata", "src.metadata.truncate_document('startup benchmark')"),
+    "src.search": ("src.search", "src.search.search('startup benchmark', k=1)"),
+    "export": ("process", "process.export_metadata()"),
+}
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+{call}
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def measure(module, call, work_dir, env):
+  # A fresh interpreter per run, so that nothing is imported or connected yet
+  result = subprocess.run([sys.executable, "-c", SCRIPT.format(module=module, call=call)],
+                          cwd=work_dir,
+                          env=env,
+                          capture_output=True,
+                          text=True)
+  if result.returncode != 0:
+    raise RuntimeError(result.stderr.strip().splitlines()[-1])
+  import_seconds, call_seconds = result.stdout.strip().splitlines()[-1].split()
+  return float(import_seconds), float(call_seconds)
+
+
+def main(entry_points, runs, without_keys):
+  server, url = start_server()
+  db_path = setup_environment(url)
+  env = dict(os.environ, PYTHONPATH=str(REPO_ROOT))
+  if without_keys:
+    # Only the entry points that never call Ollama should work without API keys
+    env.pop("EMBED_API_KEY", None)
+    env.pop("QUERY_API_KEY", None)
+  work_dir = tempfile.mkdtemp(prefix="govdocs-startup-")
+  print(f"{runs} runs per entry point, db at {db_path}")
+  print(f"{'entry point':>13} {'import ms':>10} {'first call ms':>14}")
+  for name in entry_points:
+    module, call = ENTRY_POINTS[name]
+    try:
+      timings = np.array([measure(module, call, work_dir, env) for _ in range(runs)]) * 1000
+    except RuntimeError as e:
+      print(f"{name:>13} failed: {e}")
+      continue
+    import_ms, call_ms = np.median(timings, axis=0)
+    print(f"{name:>13} {import_ms:10.0f} {call_ms:14.0f}")
+  server.shutdown()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure import and first-call latency of the entry points.")
+  parser.add_argument("--entry-points", nargs="+", choices=list(ENTRY_POINTS), default=list(ENTRY_POINTS))
+  parser.add_argument("--runs", type=int, default=3)
+  parser.add_argument("--without-keys", action="store_true", help="Run without the Ollama API keys")
+  args = parser.parse_args()
+  main(args.entry_points, args.runs, args.without_keys)
@@ -0,0 +1,116 @@
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pyarrow as pa
+
+from common import setup_environment
+
+
+def directory_size(path) -> int:
+  return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def random_vectors(rows, dimensions, seed=0) -> np.ndarray:
+  rng = np.random.default_rng(seed)
+  centers = rng.normal(size=(64, dimensions))
+  vectors = centers[rng.integers(0, len(centers), rows)] + rng.normal(scale=0.5, size=(rows, dimensions))
+  return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def build_column(vectors: list[list[float]], vector_type: pa.DataType) -> tuple[pa.Array, float]:
+  # From the nested lists of an Ollama response to an Arrow column
+  from src.embed import vectors_to_arrow
+  start = time.perf_counter()
+  if pa.types.is_fixed_size_list(vector_type):
+    column = vectors_to_arrow(np.asarray(vectors, dtype=np.float32), vector_type)
+  else:
+    column = pa.array(vectors, vector_type)  # the Python list path of variable-length tables
+  return column, time.perf_counter() - start
+
+
+def scan_seconds(table) -> float:
+  from src.embed import vectors_to_numpy
+  start = time.perf_counter()
+  column = table.search().select(["embedding"]).limit(None).to_arrow()["embedding"]
+  if pa.types.is_fixed_size_list(column.type):
+    vectors_to_numpy(column)
+  else:
+    [np.asarray(vector, dtype=np.float32) for vector in column.to_pylist()]
+  return time.perf_counter() - start
+
+
+def search_results(table, queries, k, exact=True, nprobes=20, refine_factor=None) -> tuple[list[set], list[float]]:
+  results, latencies = [], []
+  for query in queries:
+    search = table.search(query, vector_column_name="embedding").distance_type("cosine").limit(k)
+    search = search.select(["chunk_id", "_distance"])
+    if exact:
+      search = search.bypass_vector_index()
+    else:
+      search = search.nprobes(nprobes)
+      if refine_factor:
+        search = search.refine_factor(refine_factor)
+    start = time.perf_counter()
+    found = search.to_arrow()
+    latencies.append(time.perf_counter() - start)
+    results.append(set(found["chunk_id"].to_pylist()))
+  return results, latencies
+
+
+def main(rows, dimensions, k, num_queries):
+  db_path = setup_environment("http://127.0.0.1:9", db_path=tempfile.mkdtemp(prefix="govdocs-storage-"))
+  os.environ["EMBEDDING_DIM"] = str(dimensions)
+  import lancedb
+  from lancedb.index import HnswSq
+  vector_db = lancedb.connect(db_path)
+  vectors = random_vectors(rows, dimensions)
+  response = vectors.tolist()  # what the Ollama client returns
+  queries = random_vectors(num_queries, dimensions, seed=1)
+  layouts = {
+      "list<double>": pa.list_(pa.float64()),
+      "float32": pa.list_(pa.float32(), dimensions),
+      "float16": pa.list_(pa.float16(), dimensions),
+  }
+  print(f"{rows} vectors of {dimensions} dimensions, recall@{k} of {num_queries} brute-force queries against float32")
+  print(f"{'layout':>14} {'build s':>8} {'disk MiB':>9} {'memory MiB':>11} {'scan s':>7} {'query ms':>9} {'recall':>7}")
+  reference = None
+  tables = {}
+  for name, vector_type in layouts.items():
+    column, build = build_column(response, vector_type)
+    # An explicit schema, so that LanceDB does not convert the variable-length lists to a vector column
+    schema = pa.schema([pa.field("chunk_id", pa.int64()), pa.field("embedding", vector_type)])
+    table = vector_db.create_table(name.replace("<", "_").replace(">", ""), schema=schema)
+    table.add(pa.table({"chunk_id": np.arange(rows), "embedding": column}, schema=schema))
+    tables[name] = table
+    query_ms, recall = float("nan"), float("nan")
+    if pa.types.is_fixed_size_list(vector_type):  # variable-length vectors cannot be searched
+      results, latencies = search_results(table, queries, k)
+      if name == "float32":
+        reference = results
+      query_ms = np.median(latencies) * 1000
+      recall = np.mean([len(a & b) / k for a, b in zip(results, reference)])
+    print(f"{name:>14} {build:8.2f} {directory_size(os.path.join(db_path, table.name + '.lance')) / 2**20:9.1f} "
+          f"{column.nbytes / 2**20:11.1f} {scan_seconds(table):7.2f} {query_ms:9.1f} {recall:7.3f}")
+  # int8 codes in the index, with the float32 vectors kept for re-ranking
+  table = tables["float32"]
+  size = directory_size(os.path.join(db_path, table.name + '.lance'))
+  partitions = max(1, int(np.sqrt(rows)))
+  table.create_index("embedding", config=HnswSq(distance_type="cosine", num_partitions=partitions))
+  index_size = directory_size(os.path.join(db_path, table.name + '.lance')) - size
+  for refine_factor in (None, 10):
+    results, latencies = search_results(table, queries, k, False, partitions // 4, refine_factor)
+    recall = np.mean([len(a & b) / k for a, b in zip(results, reference)])
+    name = f"+SQ{' refine' if refine_factor else ' index'}"
+    print(f"{name:>14} {'':>8} {index_size / 2**20:9.1f} {'':>11} {'':>7} {np.median(latencies) * 1000:9.1f} {recall:7.3f}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Disk, memory, scan and search cost of the vector storage layouts.")
+  parser.add_argument("--rows", type=int, default=20000)
+  parser.add_argument("--dimensions", type=int, default=1024)
+  parser.add_argument("-k", type=int, default=10)
+  parser.add_argument("--queries", type=int, default=50)
+  args = parser.parse_args()
+  main(args.rows, args.dimensions, args.k, args.queries)
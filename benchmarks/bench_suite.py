@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from common import setup_environment, synthetic_text
+from stub_ollama import start_server
+
+REGRESSION_TOLERANCE = 0.2  # Throughput drop (or p95 increase) flagged against a baseline
+
+
+def summarize(name, latencies, docs, chunks=0, failures=0):
+  """
+    :return: Throughput and latency figures for one benchmark, latencies in seconds per document.
+    """
+  total = sum(latencies)
+  return {
+      "name": name,
+      "docs_per_sec": docs / total if total else 0.0,
+      "chunks_per_sec": chunks / total if total and chunks else 0.0,
+      "p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies else 0.0,
+      "p95_ms": float(np.percentile(latencies, 95) * 1000) if latencies else 0.0,
+      "failures": failures,
+  }
+
+
+def timed(function, *args):
+  start = time.perf_counter()
+  result = function(*args)
+  return time.perf_counter() - start, result
+
+
+def bench_chunk_text(texts):
+  from src.embed import chunk_text
+  latencies, chunks = [], 0
+  for text in texts:
+    elapsed, result = timed(chunk_text, text)
+    latencies.append(elapsed)
+    chunks += len(result)
+  return summarize("chunk_text", latencies, len(texts), chunks)
+
+
+def bench_embed_document(texts):
+  from src.config import set_parameters
+  from src.embed import chunk_text, embed_document, embedded_docs
+  set_parameters(force_rebuild=True)
+  latencies, chunks, failures = [], 0, 0
+  for i, text in enumerate(texts):
+    elapsed, _ = timed(embed_document, text, f"bench{i}.txt")
+    latencies.append(elapsed)
+    chunks += len(chunk_text(text))
+    failures += f"bench{i}" not in embedded_docs
+  set_parameters()
+  return summarize("embed_document", latencies, len(texts), chunks, failures)
+
+
+def bench_extract_metadata(texts):
+  from src.config import set_parameters
+  from src.metadata import extract_metadata, titled_docs
+  # Bypass the response cache, every document is a new request
+  set_parameters(force_rebuild=True, use_llm_cache=False)
+  latencies, failures = [], 0
+  for i, text in enumerate(texts):
+    elapsed, _ = timed(extract_metadata, text, f"bench{i}.txt")
+    latencies.append(elapsed)
+    failures += f"bench{i}" not in titled_docs
+  set_parameters()
+  return summarize("extract_metadata", latencies, len(texts), failures=failures)
+
+
+def bench_export_metadata(runs, work_dir):
+  from src.config import get_documents_table
+  from process import export_metadata
+  docs = get_documents_table().count_rows() - 1  # without the sample record
+  latencies = []
+  cwd = os.getcwd()
+  os.chdir(work_dir)
+  try:
+    for _ in range(runs):
+      elapsed, _ = timed(export_metadata)
+      latencies.append(elapsed)
+  finally:
+    os.chdir(cwd)
+  return summarize("export_metadata", latencies, docs * runs)
+
+
+def synthetic_page(text, dpi=196, seed=0):
+  """
+    Renders text onto a letter-size page image with some scanner noise.
+    """
+  import cv2
+  from PIL import Image
+  rng = np.random.default_rng(seed)
+  width, height = int(8.5 * dpi), int(11 * dpi)
+  page = np.full((height, width), 245, dtype=np.uint8)
+  words = text.split()
+  line_height = int(dpi * 0.25)
+  y, line = dpi, []
+  for word in words:
+    line.append(word)
+    if len(line) == 10:
+      cv2.putText(page, " ".join(line), (dpi, y), cv2.FONT_HERSHEY_SIMPLEX, dpi / 300, 20, 2, cv2.LINE_AA)
+      line = []
+      y += line_height
+      if y > height - dpi:
+        break
+  noise = rng.normal(0, 8, page.shape)
+  page = np.clip(page + noise, 0, 255).astype(np.uint8)
+  return Image.fromarray(page).convert("RGB")
+
+
+def bench_ocr_page(pages):
+  import ocr_pdf
+  if shutil.which("tesseract") is None:
+    print("ocr_page: skipped, tesseract is not installed")
+    return None
+  latencies = []
+  for i, page in enumerate(pages):
+    elapsed, _ = timed(ocr_pdf.ocr_page, (i, page))
+    latencies.append(elapsed)
+  return summarize("ocr_page", latencies, len(pages))
+
+
+def compare(results, baseline_path):
+  # Flag benchmarks that got slower than the baseline by more than REGRESSION_TOLERANCE
+  with open(baseline_path, encoding="utf-8") as f:
+    baseline = {result["name"]: result for result in json.load(f)}
+  regressions = []
+  for result in results:
+    before = baseline.get(result["name"])
+    if not before:
+      continue
+    if result["docs_per_sec"] < before["docs_per_sec"] * (1 - REGRESSION_TOLERANCE):
+      regressions.append(f"{result['name']}: {before['docs_per_sec']:.1f} -> {result['docs_per_sec']:.1f} docs/sec")
+    if result["p95_ms"] > before["p95_ms"] * (1 + REGRESSION_TOLERANCE):
+      regressions.append(f"{result['name']}: p95 {before['p95_ms']:.0f} -> {result['p95_ms']:.0f} ms")
+  return regressions
+
+
+def main(args):
+  server, url = start_server(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate)
+  db_path = setup_environment(url)
+  work_dir = tempfile.mkdtemp(prefix="govdocs-suite-")
+  os.environ.setdefault("LLM_CACHE_PATH", os.path.join(work_dir, "llm_cache.sqlite"))
+  texts = [synthetic_text(args.paragraphs, seed=i) for i in range(args.docs)]
+  print(f"{args.docs} documents of {args.paragraphs} paragraphs, stub latency {args.latency * 1000:.0f}ms "
+        f"(+{args.jitter * 1000:.0f}ms jitter, {args.failure_rate:.0%} failures), db at {db_path}")
+
+  benchmarks = {
+      "chunk_text": lambda: bench_chunk_text(texts),
+      "embed_document": lambda: bench_embed_document(texts),
+      "extract_metadata": lambda: bench_extract_metadata(texts),
+      "export_metadata": lambda: bench_export_metadata(args.export_runs, work_dir),
+      "ocr_page": lambda: bench_ocr_page([synthetic_page(text, seed=i) for i, text in enumerate(texts[:args.pages])]),
+  }
+  results = []
+  for name in args.only or benchmarks:
+    result = benchmarks[name]()
+    if result is not None:
+      results.append(result)
+
+  print(f"{'benchmark':>17} {'docs/sec':>9} {'chunks/sec':>11} {'p50 ms':>8} {'p95 ms':>8} {'failures':>9}")
+  for result in results:
+    print(f"{result['name']:>17} {result['docs_per_sec']:9.1f} {result['chunks_per_sec']:11.1f} "
+          f"{result['p50_ms']:8.1f} {result['p95_ms']:8.1f} {result['failures']:9d}")
+  server.shutdown()
+
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
+  if args.baseline:
+    regressions = compare(results, args.baseline)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Throughput benchmarks against a local stub Ollama server.")
+  parser.add_argument("--docs", type=int, default=20)
+  parser.add_argument("--paragraphs", type=int, default=100)
+  parser.add_argument("--pages", type=int, default=3, help="Synthetic pages for the ocr_page benchmark")
+  parser.add_argument("--export-runs", type=int, default=3)
+  parser.add_argument("--latency", type=float, default=0.01, help="Seconds added to every stub request")
+  parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds of extra stub latency")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of stub requests that fail")
+  parser.add_argument("--only",
+                      nargs="+",
+                      choices=["chunk_text", "embed_document", "extract_metadata", "export_metadata", "ocr_page"])
+  parser.add_argument("--output", help="Write the results to this JSON file")
+  parser.add_argument("--baseline", help="Compare with the results of an earlier run and fail on regressions")
+  main(parser.parse_args())
@@ -0,0 +1,32 @@
+import os
+import sys
+import random
+import tempfile
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+if str(REPO_ROOT) not in sys.path:
+  sys.path.insert(0, str(REPO_ROOT))
+
+WORDS = ("government ontario ministry report annual program services public health education "
+         "transportation budget estimates policy municipal federal provincial statistics "
+         "community development housing environment agriculture energy review plan").split()
+
+
+def setup_environment(embed_url, query_url=None, db_path=None):
+  """
+    Points the src package at the stub server and a scratch database.
+    Must be called before anything from src is imported.
+    """
+  os.environ["OLLAMA_EMBED_URL"] = embed_url
+  os.environ["OLLAMA_QUERY_URL"] = query_url or embed_url
+  os.environ.setdefault("EMBED_API_KEY", "benchmark")
+  os.environ.setdefault("QUERY_API_KEY", "benchmark")
+  os.environ["VECTOR_DB_PATH"] = db_path or tempfile.mkdtemp(prefix="govdocs-bench-")
+  return os.environ["VECTOR_DB_PATH"]
+
+
+def synthetic_text(paragraphs=200, words_per_paragraph=120, seed=0):
+  rng = random.Random(seed)
+  return "\n\n".join(" ".join(rng.choice(WORDS) for _ in range(words_per_paragraph))
+                     for _ in range(paragraphs))
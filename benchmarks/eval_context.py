@@ -0,0 +1,121 @@
+import json
+import argparse
+import numpy as np
+from pathlib import Path
+
+from common import setup_environment
+
+EXACT_FIELDS = ("level_of_government", "responsible_province", "responsible_city", "publisher", "publish_date",
+                "copyright_year", "ISBN", "ISSN", "category")
+SET_FIELDS = ("languages",)
+OVERLAP_FIELDS = ("title", "summary", "authors", "keywords")  # Compared by word overlap
+MODES = ("truncate", "representative")
+
+
+def words(value) -> set:
+  if isinstance(value, list):
+    value = " ".join(str(item) for item in value)
+  return set(str(value or "").lower().split())
+
+
+def compare(first: dict, second: dict) -> dict:
+  # Agreement per field between the answers of the two modes, from 0 to 1
+  agreement = {}
+  for field in EXACT_FIELDS:
+    agreement[field] = float(str(first.get(field) or "").strip().lower() == str(second.get(field) or "").strip().lower())
+  for field in SET_FIELDS:
+    agreement[field] = float(words(first.get(field)) == words(second.get(field)))
+  for field in OVERLAP_FIELDS:
+    a, b = words(first.get(field)), words(second.get(field))
+    agreement[field] = len(a & b) / len(a | b) if a | b else 1.0
+  return agreement
+
+
+def ask(text, stats_list):
+  # The metadata and category prompts as extract_metadata sends them, without saving anything
+  from src.metadata import (run_prompt, metadata_prompt, category_prompt, truncate_document, clean_metadata_json,
+                            METADATA_FORMAT, CATEGORY_FORMAT)
+  text = truncate_document(text)
+  fields = {}
+  for prompt, label, format in ((metadata_prompt, "metadata", METADATA_FORMAT),
+                                (category_prompt, "category", CATEGORY_FORMAT)):
+    stats = {}
+    answer = run_prompt(prompt(text), label, format, stats, truncate=False)
+    stats_list.append(stats)
+    if answer is None:
+      return None
+    fields.update(clean_metadata_json(json.loads(answer)))
+  return fields
+
+
+def evaluate(files, context_tokens):
+  from src.config import set_parameters
+  from src.embed import embed_document
+  from src.metadata import document_context, get_tokenizer
+  from src.classes import get_id_from_filename
+  results = []
+  for file in files:
+    text = file.read_text(encoding="utf-8")
+    doc_id = get_id_from_filename(file.name)
+    embed_document(text, file.name)  # skipped when the chunks are already stored
+    answers, seconds, tokens = {}, {}, {}
+    for mode in MODES:
+      # Bypass the cache so that every prompt is timed
+      set_parameters(use_llm_cache=False, context_mode=mode, context_tokens=context_tokens)
+      stats_list = []
+      context = document_context(text, doc_id)
+      answers[mode] = ask(context, stats_list)
+      seconds[mode] = sum(stats.get("seconds", 0.0) for stats in stats_list)
+      tokens[mode] = sum(stats.get("prompt_tokens", 0) for stats in stats_list)
+      if not tokens[mode]:
+        tokens[mode] = len(get_tokenizer().encode(context))
+    if None in answers.values():
+      print(f"{doc_id}: no answer, skipped")
+      continue
+    agreement = compare(answers["truncate"], answers["representative"])
+    results.append({"doc_id": doc_id, "seconds": seconds, "prompt_tokens": tokens, "agreement": agreement,
+                    "answers": answers})
+    print(f"{doc_id}: {seconds['truncate']:.1f}s -> {seconds['representative']:.1f}s, "
+          f"{tokens['truncate']} -> {tokens['representative']} prompt tokens, "
+          f"{np.mean(list(agreement.values())):.0%} agreement")
+  return results
+
+
+def report(results):
+  print(f"\n{len(results)} documents")
+  for mode in MODES:
+    seconds = [result["seconds"][mode] for result in results]
+    tokens = [result["prompt_tokens"][mode] for result in results]
+    print(f"{mode:>15}: LLM seconds per document mean {np.mean(seconds):.2f} p50 {np.percentile(seconds, 50):.2f} "
+          f"p95 {np.percentile(seconds, 95):.2f}, prompt tokens mean {np.mean(tokens):.0f}")
+  print("Field agreement (word overlap for title, summary, authors and keywords):")
+  for field in EXACT_FIELDS + SET_FIELDS + OVERLAP_FIELDS:
+    print(f"{field:>22}: {np.mean([result['agreement'][field] for result in results]):.0%}")
+
+
+def main(args):
+  if args.stub:
+    # Dry run of the script: the stub answers do not depend on the document
+    from stub_ollama import start_server
+    server, url = start_server(latency=0.05)
+    setup_environment(url)
+  from src.config import CONTEXT_TOKENS
+  input_path = Path(args.input)
+  files = [input_path] if input_path.is_file() else sorted(input_path.rglob("*.txt"), key=lambda x: x.name)
+  results = evaluate(files[:args.docs], args.context_tokens or CONTEXT_TOKENS)
+  if results:
+    report(results)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+      json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description="Compare the metadata extracted from truncated documents and from representative chunks.")
+  parser.add_argument("input", help="Folder with .txt files or a single .txt file")
+  parser.add_argument("--docs", type=int, default=20, help="Number of documents to evaluate")
+  parser.add_argument("--context-tokens", type=int, help="Token budget of the representative chunks")
+  parser.add_argument("--output", help="Write the answers and scores of every document to this JSON file")
+  parser.add_argument("--stub", action="store_true", help="Use a local stub server and a scratch database")
+  main(parser.parse_args())
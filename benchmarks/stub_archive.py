@@ -0,0 +1,102 @@
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = Path(".")  # folder with the <identifier>.pdf files that are served
+FAILURE_RATE = 0.0  # share of downloads that are cut off half way
+LATENCY = 0.0  # seconds added to every request
+
+
+class StubArchiveHandler(BaseHTTPRequestHandler):
+  """
+    Serves /metadata/<id> and /download/<id>/<id>.pdf like archive.org, with Range support.
+    """
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def send_body(self, body, status=200, content_type="application/json", headers=None):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if LATENCY:
+      time.sleep(LATENCY)
+    parts = self.path.strip("/").split("/")
+    if len(parts) == 2 and parts[0] == "metadata":
+      path = ROOT / f"{parts[1]}.pdf"
+      files = []
+      if path.exists():
+        data = path.read_bytes()
+        files.append({"name": path.name, "size": str(len(data)), "md5": hashlib.md5(data).hexdigest()})
+      self.send_body(json.dumps({"files": files}).encode("utf-8"))
+    elif len(parts) == 3 and parts[0] == "download" and (ROOT / parts[2]).exists():
+      self.send_file((ROOT / parts[2]).read_bytes())
+    else:
+      self.send_body(b'{"error": "not found"}', status=404)
+
+  def send_file(self, data):
+    start = 0
+    if self.headers.get("Range", "").startswith("bytes="):
+      start = int(self.headers["Range"][len("bytes="):].split("-")[0])
+      if start >= len(data):
+        self.send_body(b"", status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+        return
+    body = data[start:]
+    self.send_response(206 if start else 200)
+    self.send_header("Content-Type", "application/pdf")
+    self.send_header("Content-Length", str(len(body)))
+    if start:
+      self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+    self.end_headers()
+    if random.random() < FAILURE_RATE:
+      # send half of the file and drop the connection
+      self.wfile.write(body[:len(body) // 2])
+      self.wfile.flush()
+      self.close_connection = True
+      return
+    self.wfile.write(body)
+
+
+def start_server(root, host="127.0.0.1", port=0, failure_rate=0.0, latency=0.0):
+  """
+    Starts the stub server in a background thread.
+    :return: The server and its base url.
+    """
+  global ROOT, FAILURE_RATE, LATENCY
+  ROOT = Path(root)
+  FAILURE_RATE = failure_rate
+  LATENCY = latency
+  server = ThreadingHTTPServer((host, port), StubArchiveHandler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local stand-in for Internet Archive downloads.")
+  parser.add_argument("root", help="Folder with the <identifier>.pdf files to serve")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of downloads cut off half way")
+  parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+  args = parser.parse_args()
+  server, url = start_server(args.root, args.host, args.port, args.failure_rate, args.latency)
+  print(f"Stub archive server listening on {url}, use {url}/details/<identifier> links in the csv")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -0,0 +1,140 @@
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DIMENSIONS = 1024
+
+
+def fake_vector(text, dimensions=DIMENSIONS):
+  # Deterministic pseudo-random unit vector derived from the text
+  seed = hashlib.sha256(text.encode("utf-8")).digest()
+  values = []
+  counter = 0
+  while len(values) < dimensions:
+    block = hashlib.sha256(seed + counter.to_bytes(4, "little")).digest()
+    values.extend((b - 127.5) / 127.5 for b in block)
+    counter += 1
+  values = values[:dimensions]
+  norm = sum(v * v for v in values)**0.5 or 1.0
+  return [v / norm for v in values]
+
+
+def fake_metadata(prompt):
+  # Deterministic answer that satisfies both the metadata and the category prompts
+  digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+  return {
+      "title": f"Stub document {digest[:8]}",
+      "summary": "A deterministic summary produced by the stub server.",
+      "level_of_government": "provincial",
+      "responsible_province": "Ontario",
+      "responsible_city": "Toronto",
+      "authors": ["Stub Author"],
+      "editors": [],
+      "publisher": "Queen's Printer",
+      "publish_date": "1999-01-01",
+      "publisher_location": "Toronto",
+      "copyright_year": "1999",
+      "ISSN": "",
+      "ISBN": "",
+      "languages": ["en"],
+      "category": "Research and Analysis",
+      "keywords": ["stub", digest[:6]],
+  }
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def send_json(self, payload, status=200):
+    body = json.dumps(payload).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def delay_or_fail(self) -> bool:
+    # Latency and failures are set per server, so that one process can run slow and failing backends
+    latency, jitter = self.server.latency, self.server.jitter
+    if latency or jitter:
+      time.sleep(latency + random.uniform(0, jitter))
+    if self.server.failure_rate and random.random() < self.server.failure_rate:
+      self.send_json({"error": "stub failure"}, status=500)
+      return True
+    return False
+
+  def do_GET(self):
+    # Health checks list the models
+    if self.delay_or_fail():
+      return
+    if self.path == "/api/tags":
+      self.send_json({"models": []})
+    else:
+      self.send_json({"error": f"unknown endpoint {self.path}"}, status=404)
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    request = json.loads(self.rfile.read(length) or b"{}")
+    if self.delay_or_fail():
+      return
+    if self.path == "/api/embed":
+      inputs = request.get("input", "")
+      if isinstance(inputs, str):
+        inputs = [inputs]
+      self.send_json({
+          "model": request.get("model", ""),
+          "embeddings": [fake_vector(text, self.server.dimensions) for text in inputs],
+      })
+    elif self.path == "/api/generate":
+      prompt = request.get("prompt", "")
+      self.send_json({
+          "model": request.get("model", ""),
+          "response": json.dumps(fake_metadata(prompt)),
+          "done": True,
+          "prompt_eval_count": len(prompt.split()),
+          "eval_count": 100,
+      })
+    else:
+      self.send_json({"error": f"unknown endpoint {self.path}"}, status=404)
+
+
+def start_server(host="127.0.0.1", port=0, latency=0.0, dimensions=DIMENSIONS, jitter=0.0, failure_rate=0.0):
+  """
+    Starts the stub server in a background thread.
+    :return: The server and its base url.
+    """
+  server = ThreadingHTTPServer((host, port), StubOllamaHandler)
+  server.daemon_threads = True
+  # Can be changed while the server runs, e.g. to make a backend fail and recover
+  server.latency = latency
+  server.dimensions = dimensions
+  server.jitter = jitter
+  server.failure_rate = failure_rate
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local stand-in for the Ollama API.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=11434)
+  parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+  parser.add_argument("--dimensions", type=int, default=DIMENSIONS, help="Embedding vector size")
+  parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds of random extra latency")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with a server error")
+  args = parser.parse_args()
+  server, url = start_server(args.host, args.port, args.latency, args.dimensions, args.jitter, args.failure_rate)
+  print(f"Stub Ollama server listening on {url}")
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -1,55 +1,210 @@
 import os
 import csv
+import time
+import random
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
+from src import metrics
 
-def download_pdf(url, save_path):
-  response = requests.get(url, stream=True)
-  total_size_in_bytes = int(response.headers.get('content-length', 0))
-  block_size = 1024  #1 Kibibyte
-  progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
+CONCURRENCY = 4  # Number of parallel downloads
+CHUNK_SIZE = 1024 * 1024  # 1 Mebibyte
+MAX_ATTEMPTS = 5  # Attempts per file, each resuming where the previous one stopped
+BACKOFF = 2.0  # Seconds before the first retry, doubled on every attempt
+TIMEOUT = (10, 60)  # Connect and read timeouts in seconds
 
-  with open(save_path, 'wb') as file:
-    for data in response.iter_content(block_size):
-      progress_bar.update(len(data))
-      file.write(data)
-  progress_bar.close()
-  if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-    print("ERROR, something went wrong")
+print_lock = threading.Lock()
 
 
-def main(csv_file_path, number_of_files=None):
+def log(message):
+  with print_lock:
+    tqdm.write(message)
+
+
+def create_session(concurrency=CONCURRENCY):
+  # One keep-alive connection per download slot. urllib3 does not retry: failed downloads are
+  # retried by `download_pdf`, which resumes where the previous attempt stopped
+  adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(concurrency, 1), max_retries=Retry(total=0))
+  session = requests.Session()
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  return session
+
+
+def get_file_info(session, base_url, filename):
+  """
+    Looks up the size and md5 of a file in the Internet Archive item metadata.
+    :return: A dict with size and md5 (either may be None), or None if the metadata is not available.
+    """
+  metadata_url = base_url.replace("/details/", "/metadata/")
+  try:
+    response = session.get(metadata_url, timeout=TIMEOUT)
+    response.raise_for_status()
+    files = response.json().get("files", [])
+  except (requests.RequestException, ValueError) as e:
+    log(f"Could not read metadata at {metadata_url}: {e}")
+    return None
+  for file in files:
+    if file.get("name") == filename:
+      size = file.get("size")
+      return {"size": int(size) if size else None, "md5": file.get("md5")}
+  return None
+
+
+def file_md5(path):
+  digest = hashlib.md5()
+  with open(path, "rb") as file:
+    for block in iter(lambda: file.read(CHUNK_SIZE), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def verify_file(path, file_info):
+  """
+    Compares a downloaded file with the size and md5 from the item metadata.
+    :return: An error message, or None if the file matches (or there is nothing to compare with).
+    """
+  if not file_info:
+    return None
+  size = os.path.getsize(path)
+  if file_info["size"] is not None and size != file_info["size"]:
+    return f"size {size} does not match expected {file_info['size']}"
+  if file_info["md5"] and file_md5(path) != file_info["md5"]:
+    return "md5 checksum does not match"
+  return None
+
+
+def download_pdf(session, url, save_path, file_info=None, show_progress=True):
+  """
+    Downloads to `save_path`.part, resuming a partial file with a Range request,
+    and renames it to `save_path` once it is complete and verified.
+    :return: True if the file was downloaded.
+    """
+  part_path = save_path + ".part"
+  for attempt in range(1, MAX_ATTEMPTS + 1):
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    try:
+      with session.get(url, stream=True, headers=headers, timeout=TIMEOUT) as response:
+        if response.status_code == 416 and offset:
+          pass  # nothing left to download, the partial file is checked below
+        else:
+          response.raise_for_status()
+          if offset and response.status_code != 206:
+            offset = 0  # the server ignored the range, start over
+          total_size_in_bytes = offset + int(response.headers.get('content-length', 0))
+          progress_bar = tqdm(total=total_size_in_bytes,
+                              initial=offset,
+                              unit='iB',
+                              unit_scale=True,
+                              disable=not show_progress)
+          with open(part_path, 'ab' if offset else 'wb') as file:
+            for data in response.iter_content(CHUNK_SIZE):
+              progress_bar.update(len(data))
+              file.write(data)
+          progress_bar.close()
+          if total_size_in_bytes != offset and progress_bar.n != total_size_in_bytes:
+            raise requests.RequestException(f"received {progress_bar.n} of {total_size_in_bytes} bytes")
+    except requests.RequestException as e:
+      delay = BACKOFF * 2**(attempt - 1) * random.uniform(0.5, 1.5)
+      metrics.increment("retries", stage="download")
+      log(f"Download of {url} failed (attempt {attempt} of {MAX_ATTEMPTS}): {e}")
+      if attempt < MAX_ATTEMPTS:
+        time.sleep(delay)
+      continue
+    error = verify_file(part_path, file_info)
+    if error:
+      metrics.increment("retries", stage="download")
+      log(f"ERROR, {url}: {error}, downloading again")
+      os.remove(part_path)
+      continue
+    os.replace(part_path, save_path)
+    metrics.increment("downloaded_bytes", os.path.getsize(save_path))
+    return True
+  metrics.increment("errors", stage="download")
+  log(f"ERROR, giving up on {url} after {MAX_ATTEMPTS} attempts")
+  return False
+
+
+def download_job(session, base_url, save_path, verify, show_progress):
+  # Download one item, checking it against the archive metadata when `verify` is set
+  barcode = base_url.split("/")[-1]
+  pdf_url = f"{base_url.replace('details', 'download')}/{barcode}.pdf"
+  with metrics.span("download", item=barcode), metrics.timer("download"):
+    file_info = get_file_info(session, base_url, f"{barcode}.pdf") if verify else None
+    return download_pdf(session, pdf_url, save_path, file_info, show_progress)
+
+
+def main(csv_file_path, number_of_files=None, concurrency=CONCURRENCY, verify=True, check_existing=False):
   # Determine the directory of the CSV file
   csv_dir = os.path.dirname(os.path.abspath(csv_file_path))
+  session = create_session(concurrency)
 
   with open(csv_file_path, mode='r', newline='', encoding='utf-8') as csvfile:
     reader = csv.DictReader(csvfile)
-    total_files = number_of_files if number_of_files else len(list(reader)) -1
-    current_file = 0
-    csvfile.seek(0)  # Reset the file pointer to the beginning
+    jobs = []
     for row in reader:
       base_url = row['Internet Archive Link']
       if base_url == "Internet Archive Link":
         continue
-      if number_of_files and current_file >= number_of_files:
+      if number_of_files and len(jobs) >= number_of_files:
         break
       # get the barcode from the last part of the base_url
       barcode = base_url.split("/")[-1]
-      pdf_url = f"{base_url.replace('details', 'download')}/{barcode}.pdf"
-      save_path = os.path.join(csv_dir, f"{barcode}.pdf")
-      current_file += 1
-      if not os.path.exists(save_path):
-        print(f"Downloading file {current_file} of {total_files} at {pdf_url} ...")
-        download_pdf(pdf_url, save_path)
-      else:
+      jobs.append((base_url, os.path.join(csv_dir, f"{barcode}.pdf")))
+
+  pending = []
+  for base_url, save_path in jobs:
+    if os.path.exists(save_path):
+      barcode = base_url.split("/")[-1]
+      error = verify_file(save_path, get_file_info(session, base_url, f"{barcode}.pdf")) if check_existing else None
+      if not error:
         print(f"File already exists: {save_path}, skipping.")
+        continue
+      # resume files left incomplete by earlier versions of this script
+      print(f"File {save_path} is incomplete ({error}), resuming.")
+      os.replace(save_path, save_path + ".part")
+    pending.append((base_url, save_path))
+
+  downloaded = 0
+  if concurrency <= 1:
+    for i, (base_url, save_path) in enumerate(pending):
+      print(f"Downloading file {i + 1} of {len(pending)} from {base_url} ...")
+      downloaded += download_job(session, base_url, save_path, verify, show_progress=True)
+  else:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      futures = {
+          executor.submit(download_job, session, base_url, save_path, verify, False): save_path
+          for base_url, save_path in pending
+      }
+      with tqdm(total=len(futures), unit='file') as progress_bar:
+        for future in as_completed(futures):
+          if future.result():
+            downloaded += 1
+            log(f"Downloaded {futures[future]}")
+          progress_bar.update(1)
+  print(f"Downloaded {downloaded} of {len(pending)} files")
 
 
 if __name__ == "__main__":
   import argparse
   parser = argparse.ArgumentParser(description="Download PDF files from Internet Archive.")
   parser.add_argument("csv_file_path", help="Path to the CSV file containing the Internet Archive links")
-  parser.add_argument("number_of_files", help="Optional number of files to download", type=int, default=None)
+  parser.add_argument("number_of_files", help="Optional number of files to download", type=int, nargs="?", default=None)
+  parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Number of parallel downloads")
+  parser.add_argument("--no-verify",
+                      action="store_true",
+                      help="Do not check size and md5 against the Internet Archive metadata")
+  parser.add_argument("--check-existing",
+                      action="store_true",
+                      help="Verify files that already exist and resume the incomplete ones")
+  metrics.add_arguments(parser)
   args = parser.parse_args()
-  main(args.csv_file_path, args.number_of_files)
+  metrics.set_tracing(args.trace is not None)
+  main(args.csv_file_path, args.number_of_files, args.concurrency, not args.no_verify, args.check_existing)
+  metrics.finish(args, print)
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.config import get_vector_db, get_embeddings_schema, EMBEDDING_DIM, VECTOR_DB_PATH, VECTOR_TYPES
+from src.embed import vectors_to_numpy, vectors_to_arrow
+
+TABLE = "embeddings"
+STAGING_TABLE = "embeddings_migrating"  # Holds the converted rows while the table is replaced
+BATCH_SIZE = 10000  # Rows per record batch
+
+
+def table_size(name) -> int:
+  # Bytes on disk of a table's directory
+  total = 0
+  for root, _, files in os.walk(os.path.join(VECTOR_DB_PATH, f"{name}.lance")):
+    total += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+  return total
+
+
+def scan_batches(table, columns=None, batch_size=BATCH_SIZE):
+  query = table.search().limit(None)
+  if columns:
+    query = query.select(columns)
+  for batch in query.to_batches(batch_size):
+    if batch.num_rows:
+      yield batch
+
+
+def measure(table) -> dict:
+  """
+    Disk size, in-memory size of the vector column and the time to scan it into one array.
+    """
+  start_time = time.time()
+  vectors = pa.concat_arrays([batch.column(0) for batch in scan_batches(table, ["embedding"])] or
+                             [pa.array([], table.schema.field("embedding").type)])
+  if pa.types.is_fixed_size_list(vectors.type):
+    vectors_to_numpy(vectors)
+  else:
+    # Variable-length vectors can only be read one list at a time
+    [np.asarray(vector, dtype=np.float32) for vector in vectors.to_pylist()]
+  return {
+      "rows": len(vectors),
+      "type": str(vectors.type),
+      "disk": table_size(table.name),
+      "memory": vectors.nbytes,
+      "scan_seconds": time.time() - start_time,
+  }
+
+
+def convert_batch(batch: pa.RecordBatch, schema: pa.Schema) -> tuple[pa.RecordBatch, int]:
+  """
+    Converts the vectors of a batch to the fixed-size type of `schema`. Rows whose vector
+    does not have EMBEDDING_DIM values (e.g. the sample row that defined old schemas) are dropped.
+    :return: The converted batch and the number of rows dropped.
+    """
+  vectors = batch.column(batch.schema.get_field_index("embedding"))
+  if pa.types.is_fixed_size_list(vectors.type):
+    keep = pa.array(np.full(len(vectors), vectors.type.list_size == EMBEDDING_DIM))
+  else:
+    keep = pc.equal(pc.list_value_length(vectors), EMBEDDING_DIM)
+  keep = pc.and_(keep, pc.is_valid(vectors))
+  batch = batch.filter(keep)
+  vectors = batch.column(batch.schema.get_field_index("embedding"))
+  values = pc.list_flatten(vectors).to_numpy(zero_copy_only=False).reshape(len(vectors), EMBEDDING_DIM)
+  arrays = []
+  for field in schema:
+    if field.name == "embedding":
+      arrays.append(vectors_to_arrow(values, field.type))
+    elif field.name in batch.schema.names:
+      arrays.append(batch.column(batch.schema.get_field_index(field.name)).cast(field.type))
+    else:
+      arrays.append(pa.array([""] * batch.num_rows, field.type))  # chunk_hash of old tables
+  return pa.RecordBatch.from_arrays(arrays, schema=schema), len(keep) - batch.num_rows
+
+
+def copy_table(source, target_name, schema, convert=False) -> int:
+  vector_db = get_vector_db()
+  if target_name in vector_db.table_names():
+    vector_db.drop_table(target_name)
+  target = vector_db.create_table(target_name, schema=schema)
+  dropped = 0
+  for batch in scan_batches(source, list(source.schema.names)):
+    if convert:
+      batch, skipped = convert_batch(batch, schema)
+      dropped += skipped
+    if batch.num_rows:
+      target.add(pa.Table.from_batches([batch]))
+  return dropped
+
+
+def migrate(vector_type="float32"):
+  """
+    Rewrites the embeddings table with fixed-size vectors of `vector_type`. The converted rows are
+    first written to a staging table, so that an interrupted migration can be run again.
+    """
+  vector_db = get_vector_db()
+  schema = get_embeddings_schema(vector_type)
+  names = vector_db.table_names()
+  if STAGING_TABLE in names and (TABLE not in names or vector_db.open_table(TABLE).schema.equals(schema)):
+    logging.info("Resuming a migration that stopped while replacing the table")
+  else:
+    if TABLE not in names:
+      raise ValueError(f"There is no {TABLE} table in {VECTOR_DB_PATH}")
+    table = vector_db.open_table(TABLE)
+    if table.schema.equals(schema):
+      logging.info(f"The {TABLE} table already stores {schema.field('embedding').type} vectors")
+      return
+    before = measure(table)
+    logging.info(f"Converting {before['rows']} rows from {before['type']} to {schema.field('embedding').type} ...")
+    dropped = copy_table(table, STAGING_TABLE, schema, convert=True)
+    if dropped:
+      logging.warning(f"Dropped {dropped} rows whose vectors do not have {EMBEDDING_DIM} values")
+    report("before", before)
+  staging = vector_db.open_table(STAGING_TABLE)
+  if TABLE in vector_db.table_names():
+    vector_db.drop_table(TABLE)
+  copy_table(staging, TABLE, schema)
+  vector_db.drop_table(STAGING_TABLE)
+  report("after", measure(vector_db.open_table(TABLE)))
+  logging.info("Indexes are not copied: rebuild them with `python search.py index` and `python search.py text-index`")
+
+
+def report(label, stats):
+  logging.info(f"{label:>6}: {stats['rows']} rows of {stats['type']}, {stats['disk'] / 2**20:.1f} MiB on disk, "
+               f"{stats['memory'] / 2**20:.1f} MiB of vectors in memory, scanned in {stats['scan_seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(
+      description="Convert the embeddings table to fixed-size float32 or float16 vectors.")
+  parser.add_argument("--type",
+                      choices=VECTOR_TYPES,
+                      default="float32",
+                      help="Value type of the stored vectors (float16 halves the size)")
+  parser.add_argument("--report", action="store_true", help="Only report the size and scan time of the table")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  if args.report:
+    report("now", measure(get_vector_db().open_table(TABLE)))
+  else:
+    migrate(args.type)
@@ -1,50 +1,194 @@
 import argparse
 import os
+import re
+import json
+import hashlib
+import subprocess
 from pathlib import Path
 import cv2
 import numpy as np
 from pdf2image import convert_from_path
 from pdf2image.pdf2image import pdfinfo_from_path
 import pytesseract
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from multiprocessing import Pool, cpu_count
 from PIL import Image, ImageEnhance
 
+from src import metrics
+
 DEBUG = False
 FORCE = False
 DPI = 196  # 256 for high quality, 196 for medium quality, 120 for low quality
 CONTRAST = 1.1  # lower than 1.0 to reduce contrast and brigtness
-LANG = "eng+fra"
+LANG = "eng+fra"  # "auto" picks eng, fra or eng+fra for every page
 MAX_WORKERS = 16
+PREPROCESS = "full"  # Image preprocessing profile, see PREPROCESS_PROFILES
+PREPROCESS_PROFILES = ("none", "fast", "full", "auto")
+NOISE_THRESHOLD = 6.0  # Estimated noise (grey levels) above which the auto profile denoises a page
+STREAM = False  # Rasterise pages inside the OCR workers, one page at a time
+DOC_WORKERS = 4  # Number of documents feeding pages to the shared worker pool in stream mode
+TEXT_LAYER = False  # Use the embedded text layer of a page when it looks good enough
+MIN_TEXT_CHARS = 200  # Minimum number of characters in a usable text layer
+MIN_WORD_RATIO = 0.7  # Minimum share of tokens that look like real words
+MIN_STOPWORD_RATIO = 0.05  # Minimum share of common English/French words
+EN_STOPWORDS = set("the of and to in is for that by with as be are this from or at an it was".split())
+FR_STOPWORDS = set("le la les de des du et en un une est pour dans par sur au aux que qui ne pas se ce il".split())
+STOPWORDS = EN_STOPWORDS | FR_STOPWORDS | {"a", "on"}
+DETECT_SCALE = 0.5  # Size of the page image used for language detection
+MIN_DETECT_STOPWORDS = 8  # Fewer stopwords than this and the page is OCR'd with eng+fra
+MIN_LANG_SHARE = 0.85  # Share of the stopwords needed to OCR a page with a single language
+WORD_RE = re.compile(r"[^\W\d_]{1,20}(['’-][^\W\d_]{1,20})?")
 
 
 def remove_bleed_through(image):
   # Convert to grayscale
-  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
   # Apply slight non-local means denoising
-  denoised = cv2.fastNlMeansDenoising(gray, None, 8, 7, 21)
-  # Smooth the result for cleaner output
-  smoothed = cv2.medianBlur(denoised, 1)
-  return smoothed
+  return cv2.fastNlMeansDenoising(gray, None, 8, 7, 21)
+
+
+def adjust_exposure(gray, factor):
+  """
+    Same result as PIL's Brightness and then Contrast enhancement by `factor`,
+    applied to a grayscale image as a single lookup table.
+    """
+  levels = np.round(np.clip(np.arange(256) * factor, 0, 255))
+  histogram = np.bincount(gray.ravel(), minlength=256)
+  mean = int((histogram * levels).sum() / max(histogram.sum(), 1) + 0.5)
+  lut = np.clip(mean + factor * (levels - mean), 0, 255).astype(np.uint8)
+  return cv2.LUT(gray, lut)
+
+
+def estimate_noise(gray):
+  # Standard deviation of the noise (Immerkaer's method), on a downscaled copy for speed
+  height, width = gray.shape
+  if width > 1000:
+    gray = cv2.resize(gray, (1000, int(height * 1000 / width)), interpolation=cv2.INTER_AREA)
+  kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+  response = np.abs(cv2.filter2D(gray.astype(np.float32), -1, kernel))[1:-1, 1:-1]
+  return float(response.sum() * np.sqrt(np.pi / 2) / (6 * response.size))
+
+
+def preprocess_image(image, profile=None):
+  """
+    Prepares a page image for tesseract with one of the PREPROCESS_PROFILES:
+    none: unchanged, fast: exposure lookup table and adaptive threshold,
+    full: PIL exposure adjustment and non-local means denoising,
+    auto: exposure lookup table, and denoising only for pages with noise above NOISE_THRESHOLD.
+    """
+  profile = profile or PREPROCESS
+  if profile == "none":
+    return np.array(image)
+  if profile == "full":
+    # adjust exposure
+    if CONTRAST != 1.0:
+      brightness_enhancer = ImageEnhance.Brightness(image)
+      brightened_image = brightness_enhancer.enhance(CONTRAST)
+      contrast_enhancer = ImageEnhance.Contrast(brightened_image)
+      contrasted_image = contrast_enhancer.enhance(CONTRAST)
+    else:
+      contrasted_image = image
+    # remove noise
+    return remove_bleed_through(np.array(contrasted_image))
+  gray = np.array(image.convert("L"))
+  if CONTRAST != 1.0:
+    gray = adjust_exposure(gray, CONTRAST)
+  if profile == "fast":
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+  if estimate_noise(gray) > NOISE_THRESHOLD:
+    return remove_bleed_through(gray)
+  return gray
+
+
+def detect_language(processed_image):
+  """
+    Quick English-only pass over a downscaled copy of the page, then picks the tesseract
+    language from the share of English and French stopwords in the result.
+    :return: "eng", "fra", or "eng+fra" for mixed pages and pages with too little text to tell.
+    """
+  dpi = int(DPI * DETECT_SCALE)
+  small_image = processed_image.resize((max(1, int(processed_image.width * DETECT_SCALE)),
+                                        max(1, int(processed_image.height * DETECT_SCALE))))
+  text = pytesseract.image_to_string(small_image, lang="eng", config=f"--dpi {dpi}")
+  tokens = [token.strip(".,;:!?()[]\"'«»“”").lower() for token in text.split()]
+  english = sum(1 for token in tokens if token in EN_STOPWORDS)
+  french = sum(1 for token in tokens if token in FR_STOPWORDS)
+  if english + french < MIN_DETECT_STOPWORDS:
+    return "eng+fra"
+  if english / (english + french) >= MIN_LANG_SHARE:
+    return "eng"
+  if french / (english + french) >= MIN_LANG_SHARE:
+    return "fra"
+  return "eng+fra"
+
+
+def ocr_image(image):
+  with metrics.timer("preprocess"):
+    processed_image = Image.fromarray(preprocess_image(image))
+  processed_image.info['dpi'] = (DPI, DPI)
+  if LANG == "auto":
+    with metrics.timer("language_detect"):
+      lang = detect_language(processed_image)
+  else:
+    lang = LANG
+  if DEBUG and LANG == "auto":
+    print(f"Detected language {lang}")
+  with metrics.timer("tesseract"):
+    return pytesseract.image_to_string(processed_image, lang=lang, config=f"--dpi {DPI}")
 
 
 def ocr_page(args):
   i, image = args
   print(f"Processing page {i} ...")
-  # adjust exposure
-  if CONTRAST != 1.0:
-    brightness_enhancer = ImageEnhance.Brightness(image)
-    brightened_image = brightness_enhancer.enhance(CONTRAST)
-    contrast_enhancer = ImageEnhance.Contrast(brightened_image)
-    contrasted_image = contrast_enhancer.enhance(CONTRAST)
-  else:
-    contrasted_image = image
-  # remove noise
-  denoised_image = remove_bleed_through(np.array(contrasted_image))
-  processed_image = Image.fromarray(denoised_image)
-  processed_image.info['dpi'] = (DPI, DPI)
-  ocr_text = pytesseract.image_to_string(processed_image, lang=LANG, config=f"--dpi {DPI}")
-  return (i + 1, ocr_text)  # Return page number and OCR text as a tuple
+  ocr_text = ocr_image(image)
+  metrics.increment("pages", source="ocr")
+  # Return page number and OCR text as a tuple, with the worker's metrics for the parent process
+  return (i + 1, ocr_text, metrics.collect())
+
+
+def extract_text_layer(filepath, page_num):
+  # Text embedded in the pdf page, via poppler's pdftotext
+  try:
+    result = subprocess.run(["pdftotext", "-f", str(page_num), "-l", str(page_num), "-enc", "UTF-8", str(filepath), "-"],
+                            capture_output=True,
+                            timeout=60)
+    return result.stdout.decode("utf-8", errors="ignore") if result.returncode == 0 else ""
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+
+
+def usable_text_layer(text):
+  """
+    Heuristic check that a text layer is real text rather than empty or garbage OCR:
+    enough characters, mostly word-like tokens and some common English or French words.
+    """
+  if len(text.strip()) < MIN_TEXT_CHARS:
+    return False
+  tokens = [token.strip(".,;:!?()[]\"'«»“”") for token in text.split()]
+  tokens = [token for token in tokens if token]
+  if not tokens:
+    return False
+  words = sum(1 for token in tokens if WORD_RE.fullmatch(token))
+  stopwords = sum(1 for token in tokens if token.lower() in STOPWORDS)
+  return words / len(tokens) >= MIN_WORD_RATIO and stopwords / len(tokens) >= MIN_STOPWORD_RATIO
+
+
+def ocr_pdf_page(args):
+  # Rasterise and OCR a single page in the worker, so that only text crosses the process boundary
+  filepath, page_num = args
+  if TEXT_LAYER:
+    with metrics.timer("text_layer"):
+      text = extract_text_layer(filepath, page_num)
+    if usable_text_layer(text):
+      print(f"Using text layer of page {page_num} ...")
+      metrics.increment("pages", source="text")
+      return (page_num, text, "text", metrics.collect())
+  print(f"Processing page {page_num} ...")
+  with metrics.timer("rasterise"):
+    image = convert_from_path(filepath, dpi=DPI, first_page=page_num, last_page=page_num)[0]
+  ocr_text = ocr_image(image)
+  metrics.increment("pages", source="ocr")
+  return (page_num, ocr_text, "ocr", metrics.collect())
 
 
 def extract_images(pages, filepath, dpi):
@@ -52,16 +196,12 @@ def extract_images(pages, filepath, dpi):
 
 
 def extract_images_from_pdf(filepath, dpi, first_page=1, last_page=None):
-  # set total_pages to last_page if it is not None
-  if last_page is not None:
-    total_pages = last_page
-  else:
-    total_pages = pdfinfo_from_path(filepath)['Pages']
+  # set last_page to the last page of the pdf if it is None
+  if last_page is None:
+    last_page = pdfinfo_from_path(filepath)['Pages']
   # Split the pages into chunks for parallel processing
-  page_chunks = [
-      range(i, min(i + (total_pages // MAX_WORKERS) + 1, total_pages + 1))
-      for i in range(1, total_pages + 1, (total_pages // MAX_WORKERS) + 1)
-  ]
+  step = (last_page - first_page + 1) // MAX_WORKERS + 1
+  page_chunks = [range(i, min(i + step, last_page + 1)) for i in range(first_page, last_page + 1, step)]
   # Use a multiprocessing Pool to process the chunks
   with Pool(MAX_WORKERS) as pool:
     results = pool.starmap(extract_images, [(pages, filepath, dpi) for pages in page_chunks])
@@ -70,6 +210,192 @@ def extract_images_from_pdf(filepath, dpi, first_page=1, last_page=None):
   return images
 
 
+def write_text(output_txt_path, ocr_texts):
+  # Write to a temporary file first so that a partial text file is never mistaken for a finished one
+  tmp_path = output_txt_path.with_name(output_txt_path.name + ".tmp")
+  with open(tmp_path, 'w') as f:
+    for page_num, text, *_ in ocr_texts:
+      f.write(f"Page {page_num}:\n{text}\n\n")  # Write page number and OCR text to the file
+  os.replace(tmp_path, output_txt_path)
+  print(f"OCR completed and saved to {output_txt_path}")
+
+
+def text_hash(text):
+  return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class PageCheckpoint:
+  """
+    Append-only sidecar next to the text file with one JSON line per finished page.
+    The first line records the pdf and the OCR settings; a checkpoint written for a
+    different file or with different settings is discarded.
+    """
+
+  def __init__(self, filepath, output_txt_path):
+    self.path = output_txt_path.with_name(output_txt_path.stem + ".pages.jsonl")
+    stat = filepath.stat()
+    self.header = {
+        "pdf": str(filepath),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "settings": {
+            "dpi": DPI,
+            "contrast": CONTRAST,
+            "lang": LANG,
+            "preprocess": PREPROCESS,
+            "text_layer": TEXT_LAYER
+        },
+    }
+    self.file = None
+
+  def load(self):
+    """
+      :return: A dict of page number to (text, source) for the pages that are already done.
+      """
+    pages = {}
+    if not self.path.exists():
+      return pages
+    with open(self.path, encoding="utf-8") as f:
+      lines = f.read().splitlines()
+    try:
+      if not lines or json.loads(lines[0]) != self.header:
+        print(f"Discarding outdated checkpoint {self.path}")
+        self.remove()
+        return pages
+    except ValueError:
+      self.remove()
+      return pages
+    for line in lines[1:]:
+      try:
+        page = json.loads(line)
+      except ValueError:
+        continue  # Torn write of the last page before a crash
+      if text_hash(page["text"]) == page["sha1"]:
+        pages[page["page"]] = (page["text"], page["source"])
+    return pages
+
+  def drop_torn_line(self):
+    # A crash in the middle of a write leaves a last line without a newline; cut it off
+    # so that the next record starts on a line of its own
+    with open(self.path, "rb+") as f:
+      data = f.read()
+      if data and not data.endswith(b"\n"):
+        f.truncate(data.rfind(b"\n") + 1)
+
+  def append(self, page_num, text, source):
+    if self.file is None:
+      if self.path.exists():
+        self.drop_torn_line()
+      new_file = not self.path.exists() or self.path.stat().st_size == 0
+      self.file = open(self.path, "a", encoding="utf-8")
+      if new_file:
+        self.file.write(json.dumps(self.header) + "\n")
+    self.file.write(json.dumps({"page": page_num, "sha1": text_hash(text), "source": source, "text": text}) + "\n")
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def remove(self):
+    self.close()
+    self.path.unlink(missing_ok=True)
+
+
+def count_pages(filepath):
+  total_pages = pdfinfo_from_path(filepath)['Pages']
+  if DEBUG:  # OCR only the first 30 pages
+    total_pages = min(total_pages, 30)
+  return total_pages
+
+
+def ocr_document(filepath, output_txt_path, executor):
+  """
+    Queues the pages of the pdf that are not checkpointed yet on the shared executor and
+    writes the text file once the last page is done.
+    Pages of other documents queued on the same executor keep the workers busy while this one finishes.
+    """
+  with metrics.span("ocr_document", pdf=filepath.name):
+    return _ocr_document(filepath, output_txt_path, executor)
+
+
+def _ocr_document(filepath, output_txt_path, executor):
+  checkpoint = PageCheckpoint(filepath, output_txt_path)
+  futures = []
+  try:
+    total_pages = count_pages(filepath)
+    done = checkpoint.load()
+    missing = [page_num for page_num in range(1, total_pages + 1) if page_num not in done]
+    if done:
+      print(f"Resuming {filepath.name}: {total_pages - len(missing)} of {total_pages} pages already done.")
+    else:
+      print(f"{total_pages} pages found in {filepath.name}. Starting OCR.")
+    futures = [executor.submit(ocr_pdf_page, (filepath, page_num)) for page_num in missing]
+    for future in as_completed(futures):
+      page_num, text, source, snapshot = future.result()
+      metrics.merge(snapshot)
+      checkpoint.append(page_num, text, source)
+      done[page_num] = (text, source)
+  except Exception as e:
+    for future in futures:
+      future.cancel()
+    checkpoint.close()
+    metrics.increment("errors", stage="ocr")
+    print(f"Error processing {filepath.name}: {e}")
+    return None
+  ocr_texts = [(page_num, *done[page_num]) for page_num in range(1, total_pages + 1)]
+  write_text(output_txt_path, ocr_texts)
+  checkpoint.remove()
+  text_pages = sum(1 for _, _, source in ocr_texts if source == "text")
+  if TEXT_LAYER:
+    print(f"{text_pages} of {total_pages} pages of {filepath.name} used the embedded text layer.")
+  return text_pages, total_pages
+
+
+def ocr_rasterised(filepath, output_txt_path):
+  """
+    Default mode: rasterises the pages that are not checkpointed yet in one go and OCRs them on a
+    pool of workers. Every page is checkpointed as soon as it is done, so that a crash only loses
+    the pages in flight and the next run resumes with the missing ones.
+    """
+  checkpoint = PageCheckpoint(filepath, output_txt_path)
+  try:
+    total_pages = count_pages(filepath)
+    done = checkpoint.load()
+    missing = [page_num for page_num in range(1, total_pages + 1) if page_num not in done]
+    if done:
+      print(f"Resuming {filepath.name}: {total_pages - len(missing)} of {total_pages} pages already done.")
+    if missing:
+      with metrics.timer("rasterise_document"):
+        images = extract_images_from_pdf(filepath, dpi=DPI, first_page=missing[0], last_page=missing[-1])
+      print(f"{len(missing)} pages to OCR in {filepath.name}. Starting OCR.")
+      pages = [(page_num - 1, image) for page_num, image in enumerate(images, missing[0]) if page_num not in done]
+      with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=metrics.reset) as executor:
+        for future in as_completed([executor.submit(ocr_page, page) for page in pages]):
+          page_num, text, snapshot = future.result()
+          metrics.merge(snapshot)
+          checkpoint.append(page_num, text, "ocr")
+          done[page_num] = (text, "ocr")
+  finally:
+    checkpoint.close()
+  write_text(output_txt_path, [(page_num, *done[page_num]) for page_num in range(1, total_pages + 1)])
+  checkpoint.remove()
+
+
+def ocr_corpus(jobs):
+  # One worker pool for the whole run, fed with pages from up to DOC_WORKERS documents at once
+  with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=metrics.reset) as executor:
+    executor.submit(int).result()  # Start the workers before any document threads exist
+    with ThreadPoolExecutor(max_workers=DOC_WORKERS) as documents:
+      results = [result for result in documents.map(lambda job: ocr_document(*job, executor), jobs) if result]
+  if TEXT_LAYER:
+    text_pages = sum(text_pages for text_pages, _ in results)
+    total_pages = sum(total_pages for _, total_pages in results)
+    print(f"Skipped OCR for {text_pages} of {total_pages} pages that had a usable text layer.")
+
+
 def ocr_pdf(input_path):
   input_path = Path(input_path)
   if input_path.is_file():
@@ -83,6 +409,7 @@ def ocr_pdf(input_path):
   num_files = len(files)
   print(f"Found {num_files} pdf files in {input_path}")
   current_file = 0
+  jobs = []
   for file in files:
     current_file += 1
     filepath = file.resolve()
@@ -93,19 +420,15 @@ def ocr_pdf(input_path):
     if output_txt_path.exists() and not FORCE:
       print(f"Text file {output_txt_path} already exists. Skipping.")
       continue
+    if STREAM:
+      jobs.append((filepath, output_txt_path))
+      continue
     print(f"Extracting images from {file.name} ({current_file} of {num_files}) ...")
-    if DEBUG:  # Extract only the first 30 images
-      images = extract_images_from_pdf(filepath, dpi=DPI, first_page=1, last_page=30)
-    else:  # Extract all images
-      images = extract_images_from_pdf(filepath, dpi=DPI)
-    print(f"{len(images)} pages found. Starting OCR.")
-    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-      ocr_texts = list(executor.map(ocr_page, enumerate(images)))
-
-    with open(output_txt_path, 'w') as f:
-      for page_num, text in ocr_texts:
-        f.write(f"Page {page_num}:\n{text}\n\n")  # Write page number and OCR text to the file
-    print(f"OCR completed and saved to {output_txt_path}")
+    with metrics.span("ocr_document", pdf=file.name):
+      ocr_rasterised(filepath, output_txt_path)
+  if jobs:
+    print(f"Starting OCR of {len(jobs)} pdf files with one pool of {MAX_WORKERS} workers.")
+    ocr_corpus(jobs)
 
 
 if __name__ == "__main__":
@@ -119,14 +442,28 @@ if __name__ == "__main__":
   parser.add_argument("--lang",
                       type=str,
                       default='eng+fra',
-                      help="Tesseract language string for OCR (optional)")
+                      help="Tesseract language string for OCR, or auto to detect it per page (optional)")
+  parser.add_argument("--preprocess",
+                      choices=PREPROCESS_PROFILES,
+                      default="full",
+                      help="Image preprocessing profile (optional)")
   parser.add_argument("--debug", action='store_true', help="Enable debug mode (optional)")
+  parser.add_argument("--stream",
+                      action='store_true',
+                      help="Rasterise each page in its OCR worker to bound memory use, with one worker pool for all files (optional)")
+  parser.add_argument("--text-layer",
+                      action='store_true',
+                      help="Use the embedded text of pages that have a usable text layer instead of OCR, implies --stream (optional)")
   parser.add_argument("--force",
                       action='store_true',
                       help="Process OCR even if text file exist already (optional)")
+  metrics.add_arguments(parser)
   args = parser.parse_args()
   DEBUG = args.debug
+  PREPROCESS = args.preprocess
   FORCE = args.force
+  TEXT_LAYER = args.text_layer
+  STREAM = args.stream or args.text_layer
   if args.dpi is not None:
     DPI = args.dpi
   if args.contrast is not None:
@@ -135,4 +472,6 @@ if __name__ == "__main__":
     LANG = args.lang
   MAX_WORKERS = min(cpu_count(), MAX_WORKERS)
   print(f"Using {MAX_WORKERS} workers.")
+  metrics.set_tracing(args.trace is not None)
   ocr_pdf(input_path=args.input_path)
+  metrics.finish(args, print)
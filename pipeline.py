@@ -0,0 +1,272 @@
+import csv
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import ocr_pdf
+from get_ia_files import create_session, download_job
+from process import export_metadata
+from src import metrics
+from src.config import set_parameters, CONTEXT_MODES, CONTEXT_TOKENS
+from src.state import PipelineState, STAGES
+from src.embed import embed_document, embedded_docs
+from src.metadata import extract_metadata, titled_docs, log_single_call_summary, log_tokenizer_summary, response_cache
+
+STATE_PATH = "pipeline_state.sqlite"
+QUEUE_SIZE = 8  # Documents waiting in front of each stage before the previous stage blocks
+
+
+class Stage:
+  """
+    A pool of worker threads that takes documents from a bounded queue, runs `function` on them
+    and passes the documents that succeeded on to the next stage.
+    `function` returns None on success or an error message.
+    """
+
+  def __init__(self, name, function, workers, queue_size=QUEUE_SIZE):
+    self.name = name
+    self.function = function
+    self.workers = max(workers, 1)
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.next = None
+    self.threads = []
+    self.completed = 0
+    self.failed = 0
+    self.busy_seconds = 0.0
+    self._lock = threading.Lock()
+
+  def start(self, state: PipelineState):
+    self.threads = [
+        threading.Thread(target=self.run, args=(state,), name=f"{self.name}-{i}", daemon=True)
+        for i in range(self.workers)
+    ]
+    for thread in self.threads:
+      thread.start()
+
+  def run(self, state: PipelineState):
+    while True:
+      wait_start = time.time()
+      document = self.queue.get()
+      if document is None:
+        return
+      waited = time.time() - wait_start
+      start_time = time.time()
+      try:
+        with metrics.span(self.name, doc_id=document["doc_id"]):
+          error = self.function(document)
+      except Exception as e:
+        error = str(e)
+      elapsed = time.time() - start_time
+      metrics.observe(f"pipeline_{self.name}", elapsed)
+      metrics.observe(f"queue_wait_{self.name}", waited)
+      with self._lock:
+        self.busy_seconds += elapsed
+        if error:
+          self.failed += 1
+        else:
+          self.completed += 1
+      if error:
+        metrics.increment("errors", stage=self.name)
+        logging.error(f"{self.name} failed for {document['doc_id']}: {error}")
+        state.fail(document["doc_id"], self.name, error)
+        continue
+      logging.info(f"{self.name} done for {document['doc_id']} in {elapsed:.1f}s")
+      state.complete(document["doc_id"], self.name)
+      if self.next:
+        self.next.queue.put(document)  # blocks while the next stage is busy
+
+  def stop(self):
+    # Let the workers drain the queue, then wait for them
+    for _ in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+
+
+def read_documents(csv_file_path, number_of_files=None) -> list[dict]:
+  # Same file layout as get_ia_files.py and ocr_pdf.py: pdfs next to the csv file, text files in ../text
+  csv_dir = Path(csv_file_path).resolve().parent
+  text_dir = csv_dir.parent / "text"
+  text_dir.mkdir(parents=True, exist_ok=True)
+  documents = []
+  with open(csv_file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+    for row in csv.DictReader(csvfile):
+      base_url = row['Internet Archive Link']
+      if base_url == "Internet Archive Link":
+        continue
+      if number_of_files and len(documents) >= number_of_files:
+        break
+      barcode = base_url.split("/")[-1]
+      documents.append({
+          "doc_id": barcode,
+          "base_url": base_url,
+          "pdf_path": csv_dir / f"{barcode}.pdf",
+          "txt_path": text_dir / f"{barcode}.txt",
+      })
+  return documents
+
+
+def read_text(document) -> str:
+  with document["txt_path"].open('r', encoding='utf-8') as f:
+    return f.read()
+
+
+def build_stages(session, executor, workers: dict, queue_size=QUEUE_SIZE) -> list[Stage]:
+  """
+    Creates the download, OCR, embedding and metadata stages, each with its own number of workers.
+    :return: The stages in pipeline order, connected to each other.
+    """
+
+  def download(document):
+    if document["pdf_path"].exists():
+      return None
+    if not download_job(session, document["base_url"], str(document["pdf_path"]), True, False):
+      return "download failed"
+    return None
+
+  def ocr(document):
+    if document["txt_path"].exists() and not ocr_pdf.FORCE:
+      return None
+    if ocr_pdf.ocr_document(document["pdf_path"], document["txt_path"], executor) is None:
+      return "OCR failed"
+    return None
+
+  def embed(document):
+    embed_document(read_text(document), document["txt_path"].name)
+    if document["doc_id"] not in embedded_docs:
+      return "no embeddings stored"
+    return None
+
+  def metadata(document):
+    extract_metadata(read_text(document), document["txt_path"].name)
+    if document["doc_id"] not in titled_docs:
+      return "no metadata stored"
+    return None
+
+  functions = {"download": download, "ocr": ocr, "embed": embed, "metadata": metadata}
+  stages = [Stage(name, functions[name], workers[name], queue_size) for name in STAGES]
+  for stage, next_stage in zip(stages, stages[1:]):
+    stage.next = next_stage
+  return stages
+
+
+def main(csv_file_path, number_of_files=None, workers=None, queue_size=QUEUE_SIZE, state_path=STATE_PATH, force=False):
+  workers = workers or {"download": 4, "ocr": ocr_pdf.DOC_WORKERS, "embed": 2, "metadata": 2}
+  state = PipelineState(state_path)
+  if force:
+    state.reset()
+  documents = read_documents(csv_file_path, number_of_files)
+  start_time = time.time()
+  with ProcessPoolExecutor(max_workers=ocr_pdf.MAX_WORKERS, initializer=metrics.reset) as executor:
+    executor.submit(int).result()  # Start the OCR workers before any stage threads exist
+    stages = build_stages(create_session(workers["download"]), executor, workers, queue_size)
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+      stage.start(state)
+    skipped = 0
+    for document in documents:
+      # Documents continue after the last stage they completed in an earlier run
+      stage = state.next_stage(document["doc_id"])
+      if stage is None:
+        skipped += 1
+        continue
+      by_name[stage].queue.put(document)
+    if skipped:
+      logging.info(f"Skipped {skipped} documents that went through every stage in an earlier run")
+    for stage in stages:
+      stage.stop()
+  elapsed = time.time() - start_time
+  logging.info(f"Pipeline finished in {elapsed:.1f}s")
+  for stage in stages:
+    utilisation = stage.busy_seconds / (elapsed * stage.workers) if elapsed else 0.0
+    logging.info(f"{stage.name:>9}: {stage.completed} done, {stage.failed} failed, "
+                 f"{stage.workers} workers {utilisation:.0%} busy")
+  summary = state.summary()
+  logging.info(f"Documents by last completed stage: {summary['completed']}")
+  if summary["failed"]:
+    logging.info(f"Documents by failed stage: {summary['failed']}")
+  log_single_call_summary()
+  log_tokenizer_summary()
+  response_cache.log_summary()
+  export_metadata()
+
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(
+      description="Download, OCR, embed and extract metadata for the documents in a csv file, as a pipeline.")
+  parser.add_argument("csv_file_path", help="Path to the CSV file containing the Internet Archive links")
+  parser.add_argument("number_of_files", help="Optional number of files to process", type=int, nargs="?", default=None)
+  parser.add_argument("--download-workers", type=int, default=4, help="Number of parallel downloads")
+  parser.add_argument("--ocr-workers",
+                      type=int,
+                      default=ocr_pdf.DOC_WORKERS,
+                      help="Number of documents OCR'd at the same time")
+  parser.add_argument("--ocr-processes",
+                      type=int,
+                      default=ocr_pdf.MAX_WORKERS,
+                      help="Number of OCR worker processes shared by all documents")
+  parser.add_argument("--embed-workers", type=int, default=2, help="Number of documents embedded at the same time")
+  parser.add_argument("--metadata-workers",
+                      type=int,
+                      default=2,
+                      help="Number of documents sent for metadata extraction at the same time")
+  parser.add_argument("--queue-size",
+                      type=int,
+                      default=QUEUE_SIZE,
+                      help="Documents waiting in front of each stage before the previous stage blocks")
+  parser.add_argument("--state", default=STATE_PATH, help="SQLite file with the progress of every document")
+  parser.add_argument("--dpi", type=int, help="DPI setting for pdf OCR (optional)")
+  parser.add_argument("--lang", type=str, help="Tesseract language string for OCR, or auto (optional)")
+  parser.add_argument("--preprocess", choices=ocr_pdf.PREPROCESS_PROFILES, help="Image preprocessing profile (optional)")
+  parser.add_argument("--text-layer", action="store_true", help="Use a page's embedded text layer when it is usable")
+  parser.add_argument("--single-call",
+                      action="store_true",
+                      help="Extract metadata, category and keywords with one prompt per document")
+  parser.add_argument("--context",
+                      choices=CONTEXT_MODES,
+                      default="truncate",
+                      help="Send the beginning of each document with the metadata prompts, "
+                      "or its first chunks and the chunks closest to its centroid (representative)")
+  parser.add_argument("--context-tokens",
+                      type=int,
+                      default=CONTEXT_TOKENS,
+                      help="Token budget of the representative chunks")
+  parser.add_argument("--force", action="store_true", help="Redo OCR, embedding and metadata for every document")
+  parser.add_argument("--debug", action="store_true", help="Executes the script in debug mode")
+  metrics.add_arguments(parser)
+  args = parser.parse_args()
+  set_parameters(debug=args.debug,
+                 force_rebuild=args.force,
+                 single_call=args.single_call,
+                 context_mode=args.context,
+                 context_tokens=args.context_tokens)
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(message)s')
+  if not args.debug:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+  ocr_pdf.DEBUG = args.debug
+  ocr_pdf.FORCE = args.force
+  ocr_pdf.MAX_WORKERS = args.ocr_processes
+  ocr_pdf.TEXT_LAYER = args.text_layer
+  if args.dpi is not None:
+    ocr_pdf.DPI = args.dpi
+  if args.lang is not None:
+    ocr_pdf.LANG = args.lang
+  if args.preprocess is not None:
+    ocr_pdf.PREPROCESS = args.preprocess
+  metrics.set_tracing(args.trace is not None)
+  main(args.csv_file_path,
+       args.number_of_files,
+       workers={
+           "download": args.download_workers,
+           "ocr": args.ocr_workers,
+           "embed": args.embed_workers,
+           "metadata": args.metadata_workers,
+       },
+       queue_size=args.queue_size,
+       state_path=args.state,
+       force=args.force)
+  metrics.finish(args)
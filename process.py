@@ -1,12 +1,14 @@
 import os
-import json
+import asyncio
 import logging
-import numpy as np
 from pathlib import Path
 
-from src.config import set_parameters, get_documents_table
-from src.embed import embed_document
-from src.metadata import extract_metadata
+from src import metrics
+from src.config import set_parameters, CONTEXT_MODES, CONTEXT_TOKENS, DEDUP_PATH
+from src.dedup import find_groups, share_results, DuplicateGroups, DEDUP_MODES, THRESHOLD
+from src.export import export_documents, EXPORT_FORMATS
+from src.embed import embed_document, embed_document_async
+from src.metadata import extract_metadata, extract_metadata_async, log_single_call_summary, log_tokenizer_summary, response_cache
 
 
 def embed_documents(files):
@@ -15,7 +17,8 @@ def embed_documents(files):
     try:
       with file.open('r', encoding='utf-8') as f:
         text = f.read()
-      embed_document(text, file.name)
+      with metrics.span("document", file=file.name), metrics.timer("embed_document"):
+        embed_document(text, file.name)
     except Exception as e:
       logging.error(f"Error embedding {file.name}: {e}")
 
@@ -26,43 +29,78 @@ def generate_metadata(files):
     try:
       with file.open('r', encoding='utf-8') as f:
         text = f.read()
-      extract_metadata(text, file.name)
+      with metrics.span("document", file=file.name), metrics.timer("extract_metadata"):
+        extract_metadata(text, file.name)
     except Exception as e:
       logging.error(f"Error generating metadata for {file.name}: {e}")
 
 
-def export_metadata():
+async def process_document_async(file, embed_limiter, query_limiter, doc_limiter):
+  async with doc_limiter:
+    try:
+      text = await asyncio.to_thread(file.read_text, encoding='utf-8')
+    except Exception as e:
+      logging.error(f"Error reading {file.name}: {e}")
+      return
+    with metrics.span("document", file=file.name):
+      logging.info(f"Embedding  {file.name}...")
+      try:
+        with metrics.timer("embed_document"):
+          await embed_document_async(text, file.name, embed_limiter)
+      except Exception as e:
+        logging.error(f"Error embedding {file.name}: {e}")
+      logging.info(f"Generating metadata for {file.name}...")
+      try:
+        with metrics.timer("extract_metadata"):
+          await extract_metadata_async(text, file.name, query_limiter)
+      except Exception as e:
+        logging.error(f"Error generating metadata for {file.name}: {e}")
+
+
+async def process_documents_async(files, concurrency):
+  # Keep up to `concurrency` embed and generate requests in flight, so that the embedding
+  # of one document overlaps with the metadata extraction of another
+  embed_limiter = asyncio.Semaphore(concurrency)
+  query_limiter = asyncio.Semaphore(concurrency)
+  doc_limiter = asyncio.Semaphore(concurrency * 2)
+  await asyncio.gather(
+      *(process_document_async(file, embed_limiter, query_limiter, doc_limiter) for file in files))
+
+
+def skip_duplicates(files, threshold, store: DuplicateGroups):
+  """
+    Groups the near-duplicate documents and records the groups in `store`.
+    :return: The files to process, without the duplicates of their group's representative, and the groups.
+    """
+  with metrics.timer("dedup"):
+    groups = find_groups(files, threshold)
+  store.record(files, groups)
+  duplicates = {file for group in groups for file, _ in group["members"]}
+  logging.info(f"{len(duplicates)} of {len(files)} documents are near-duplicates in {len(groups)} groups, "
+               f"only the representative of each group is processed")
+  metrics.increment("skipped_duplicates", len(duplicates))
+  return [file for file in files if file not in duplicates], groups
+
+
+def export_metadata(formats=("json", "csv"), since_version=None):
   try:
-    # Convert the table to a pandas DataFrame
-    data = get_documents_table().to_pandas()
-    # Exclude the first record (sample data)
-    data = data.iloc[1:]
-    # Drop the filename column
-    data = data.drop(columns=["filename"])
-    # Put the doc_id column first
-    data = data[["doc_id"] + [col for col in data.columns if col != "doc_id"]]
-    # Order the data by doc_id
-    data = data.sort_values(by="doc_id")
-    # Convert ndarray or other non-serializable objects to Python lists
-    for column in data.columns:
-      if data[column].apply(lambda x: isinstance(x, (list, np.ndarray))).any():
-        data[column] = data[column].apply(lambda x: list(x) if isinstance(x, np.ndarray) else x)
-    # Export to JSON
-    with open("metadata.json", 'w', encoding='utf-8') as json_file:
-      metadata = data.to_dict(orient="records")
-      json.dump(metadata, json_file, ensure_ascii=False, indent=2)
-    # Convert lists to strings
-    for column in data.columns:
-      if data[column].apply(lambda x: isinstance(x, list)).any():
-        data[column] = data[column].apply(lambda x: ", ".join(x))
-    # Write the DataFrame to a CSV file
-    data.to_csv("metadata.csv", index=False, encoding='utf-8')
-    print(f"Metadata successfully exported to metadata.csv and metadata.json")
+    # Stream the documents table into the export files, one record batch at a time
+    with metrics.timer("export"):
+      result = export_documents(formats, since_version=since_version)
+    files = " and ".join(result[export_format] for export_format in formats)
+    print(f"Metadata of {result['documents']} documents successfully exported to {files} "
+          f"(documents table version {result['version']})")
   except Exception as e:
     print(f"Error exporting metadata: {e}")
 
 
-def main(input_path):
+def main(input_path,
+         concurrency=0,
+         export_formats=("json", "csv"),
+         since_version=None,
+         dedup=None,
+         dedup_threshold=THRESHOLD,
+         dedup_path=DEDUP_PATH):
   if not os.path.exists(input_path):
     logging.info("The specified folder or file does not exist.")
   else:
@@ -73,24 +111,99 @@ def main(input_path):
       files = list(input_path.rglob("*.txt"))
       files.sort(key=lambda x: x.name)
 
-    embed_documents(files)
-    generate_metadata(files)
-    export_metadata()
+    groups = []
+    if dedup:
+      store = DuplicateGroups(dedup_path)
+      files, groups = skip_duplicates(files, dedup_threshold, store)
+    if concurrency > 0:
+      asyncio.run(process_documents_async(files, concurrency))
+    else:
+      embed_documents(files)
+      generate_metadata(files)
+    if groups:
+      share_results(groups, dedup, store)
+      logging.info(f"Duplicate groups in {dedup_path}: {store.summary()}")
+    log_single_call_summary()
+    log_tokenizer_summary()
+    response_cache.log_summary()
+    export_metadata(export_formats, since_version)
 
 
 if __name__ == "__main__":
   import argparse
   parser = argparse.ArgumentParser(description="Embed documents and generate summaries/titles.")
   parser.add_argument("input",
+                      nargs="?",
                       help="Path to the folder containing .txt files or a single .txt file")
   parser.add_argument("--force",
                       action="store_true",
                       help="Force embedding even if embeddings already exist")
   parser.add_argument("--debug", action="store_true", help="Executes the script in debug mode")
+  parser.add_argument("--embed-batch-size",
+                      type=int,
+                      default=16,
+                      help="Number of chunks sent per embedding request (1 = one request per chunk)")
+  parser.add_argument("--concurrency",
+                      type=int,
+                      default=0,
+                      help="Number of Ollama requests kept in flight per model (0 = sequential)")
+  parser.add_argument("--single-call",
+                      action="store_true",
+                      help="Extract metadata, category and keywords with one prompt per document")
+  parser.add_argument("--context",
+                      choices=CONTEXT_MODES,
+                      default="truncate",
+                      help="Send the beginning of each document with the metadata prompts, "
+                      "or its first chunks and the chunks closest to its centroid (representative)")
+  parser.add_argument("--context-tokens",
+                      type=int,
+                      default=CONTEXT_TOKENS,
+                      help="Token budget of the representative chunks")
+  parser.add_argument("--no-cache",
+                      action="store_true",
+                      help="Bypass the LLM response cache (answers are neither read nor stored)")
+  parser.add_argument("--clear-cache", action="store_true", help="Empty the LLM response cache before processing")
+  parser.add_argument("--export-only", action="store_true", help="Only export the metadata that is already stored")
+  parser.add_argument("--export-formats",
+                      nargs="+",
+                      choices=EXPORT_FORMATS,
+                      default=["json", "csv"],
+                      help="Files written by the metadata export")
+  parser.add_argument("--since-version",
+                      type=int,
+                      help="Only export documents added or changed after this documents table version")
+  parser.add_argument("--dedup",
+                      choices=DEDUP_MODES,
+                      help="Only process one representative of every group of near-duplicate documents, then copy "
+                      "its metadata and chunks to the others (copy) or only its metadata (link)")
+  parser.add_argument("--dedup-threshold",
+                      type=float,
+                      default=THRESHOLD,
+                      help="Estimated share of common 5-word shingles from which documents are near-duplicates")
+  parser.add_argument("--dedup-groups",
+                      default=DEDUP_PATH,
+                      help="SQLite file in which the group of every near-duplicate document is recorded")
+  metrics.add_arguments(parser)
   args = parser.parse_args()
-  set_parameters(args.debug, args.force)
+  set_parameters(debug=args.debug,
+                 force_rebuild=args.force,
+                 embed_batch_size=args.embed_batch_size,
+                 single_call=args.single_call,
+                 use_llm_cache=not args.no_cache,
+                 context_mode=args.context,
+                 context_tokens=args.context_tokens)
   logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(message)s')
   if not args.debug:
     logging.getLogger("httpx").setLevel(logging.WARNING)
     print("Disabled INFO messages for Ollama requests.")
-  main(args.input)
+  metrics.set_tracing(args.trace is not None)
+  if args.clear_cache:
+    response_cache.clear()
+  if args.export_only:
+    export_metadata(args.export_formats, args.since_version)
+  elif args.input is None:
+    parser.error("the input path is required unless --export-only is given")
+  else:
+    main(args.input, args.concurrency, args.export_formats, args.since_version, args.dedup, args.dedup_threshold,
+         args.dedup_groups)
+  metrics.finish(args)
@@ -0,0 +1,61 @@
+import json
+import logging
+
+from src.search import build_index, build_fts_index, refresh_index, search, INDEX_TYPES, SEARCH_MODES
+
+
+def print_results(results, as_json=False):
+  if as_json:
+    print(json.dumps(results, ensure_ascii=False, indent=2, default=str))
+    return
+  for rank, chunk in enumerate(results, 1):
+    document = chunk["document"] or {}
+    if chunk.get("_relevance") is not None:
+      score = f"relevance {chunk['_relevance']:.4f}"
+    elif chunk.get("_score") is not None:
+      score = f"score {chunk['_score']:.2f}"
+    else:
+      score = f"distance {chunk['_distance']:.4f}"
+    print(f"{rank}. {chunk['doc_id']} chunk {chunk['chunk_id']} ({score})")
+    if document.get("title"):
+      print(f"   {document['title']}")
+    if chunk.get("duplicates"):
+      print(f"   Also in: {', '.join(duplicate['doc_id'] for duplicate in chunk['duplicates'])}")
+    print(f"   {chunk['content'][:200]}...\n")
+
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description="Build the vector index and search the embedded documents.")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  index_parser = subparsers.add_parser("index", help="Build or replace the vector index")
+  index_parser.add_argument("--type", default="IVF_PQ", choices=INDEX_TYPES, help="Index type")
+  index_parser.add_argument("--partitions", type=int, help="Number of IVF partitions (default: sqrt of the rows)")
+  index_parser.add_argument("--sub-vectors", type=int, help="Number of PQ sub-vectors (default: dimensions / 16)")
+  subparsers.add_parser("text-index", help="Build or replace the full-text index on the chunk content")
+  subparsers.add_parser("refresh", help="Add new rows to the existing indexes")
+  query_parser = subparsers.add_parser("query", help="Search the chunks that best match a query")
+  query_parser.add_argument("text", help="Query text")
+  query_parser.add_argument("-k", type=int, default=10, help="Number of chunks to return")
+  query_parser.add_argument("--where",
+                            help="Filter on the documents table, e.g. \"level_of_government = 'federal'\"")
+  query_parser.add_argument("--mode",
+                            choices=SEARCH_MODES,
+                            default="vector",
+                            help="Vector similarity, full-text (BM25) or hybrid search fusing both rankings")
+  query_parser.add_argument("--nprobes", type=int, default=20, help="Number of IVF partitions to search")
+  query_parser.add_argument("--refine-factor", type=int, help="Re-rank k * refine-factor candidates exactly")
+  query_parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+  parser.add_argument("--debug", action="store_true", help="Executes the script in debug mode")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(message)s')
+  if not args.debug:
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+  if args.command == "index":
+    build_index(args.type, args.partitions, args.sub_vectors)
+  elif args.command == "text-index":
+    build_fts_index()
+  elif args.command == "refresh":
+    refresh_index()
+  else:
+    print_results(search(args.text, args.k, args.where, args.nprobes, args.refine_factor, args.mode), args.json)
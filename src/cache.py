@@ -0,0 +1,106 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+def prompt_key(model: str, options: dict, format, prompt: str) -> str:
+  # Content address of a generate request: identical requests give identical answers at temperature 0
+  payload = json.dumps({"model": model, "options": options, "format": format}, sort_keys=True)
+  digest = hashlib.sha256(payload.encode("utf-8"))
+  digest.update(b"\0")
+  digest.update(prompt.encode("utf-8"))
+  return digest.hexdigest()
+
+
+class ResponseCache:
+  """
+    Persistent LLM response cache in a SQLite file.
+    Entries are evicted least recently used first once the answers exceed `max_bytes`.
+    """
+
+  def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.enabled = True
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._connection = None
+    self._total_bytes = 0
+
+  @property
+  def connection(self):
+    if self._connection is None:
+      self._connection = sqlite3.connect(self.path, check_same_thread=False)
+      self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                               "key TEXT PRIMARY KEY, answer TEXT NOT NULL, "
+                               "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+      self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+      self._connection.commit()
+      self._total_bytes = self._connection.execute(
+          "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    return self._connection
+
+  def get(self, key: str, validate=None) -> str | None:
+    """
+      Looks up a stored answer. An answer that `validate` rejects is removed and counted as a miss.
+      :return: The answer, or None if there is none.
+      """
+    if not self.enabled:
+      return None
+    with self._lock:
+      row = self.connection.execute("SELECT answer, size FROM responses WHERE key = ?", (key,)).fetchone()
+      if row is not None and validate is not None and not validate(row[0]):
+        self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.connection.commit()
+        self._total_bytes -= row[1]
+        row = None
+      if row is None:
+        self.misses += 1
+        return None
+      self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+      self.connection.commit()
+      self.hits += 1
+      return row[0]
+
+  def put(self, key: str, answer: str):
+    if not self.enabled or answer is None:
+      return
+    size = len(answer.encode("utf-8"))
+    with self._lock:
+      previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+      self.connection.execute("INSERT OR REPLACE INTO responses (key, answer, size, last_used) VALUES (?, ?, ?, ?)",
+                              (key, answer, size, time.time()))
+      self._total_bytes += size - (previous[0] if previous else 0)
+      self._evict()
+      self.connection.commit()
+
+  def _evict(self):
+    while self._total_bytes > self.max_bytes:
+      rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 100").fetchall()
+      if not rows:
+        self._total_bytes = 0
+        return
+      for key, size in rows:
+        self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._total_bytes -= size
+        if self._total_bytes <= self.max_bytes:
+          return
+
+  def clear(self):
+    with self._lock:
+      self.connection.execute("DELETE FROM responses")
+      self.connection.commit()
+      self._total_bytes = 0
+
+  def __len__(self) -> int:
+    with self._lock:
+      return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+  def log_summary(self):
+    if self.hits or self.misses:
+      logging.info(f"LLM response cache: {self.hits} hits, {self.misses} misses, "
+                   f"{self._total_bytes / 1024:.0f} KiB in {self.path}")
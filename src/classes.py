@@ -45,6 +45,12 @@ def new_MetaInfo() -> MetaInfo:
                   summary="")
 
 
+class MetaInfoCategory(MetaInfo):
+  # All fields that the single-call metadata prompt asks for
+  category: Optional[str] = None
+  keywords: Optional[List[str]] = None
+
+
 class GovDoc(MetaInfo):
   doc_id: str
   filename: str
@@ -65,6 +71,7 @@ class Embedding(BaseModel):
   doc_id: str
   chunk_id: int
   content: str
+  chunk_hash: str
   embedding: list[float]
 
 
@@ -73,4 +80,4 @@ def create_Embedding(json: dict) -> Embedding:
 
 
 def new_Embedding() -> Embedding:
-  return Embedding(doc_id="", chunk_id=0, content="", embedding=[0.0])
+  return Embedding(doc_id="", chunk_id=0, content="", chunk_hash="", embedding=[0.0])
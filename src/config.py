@@ -1,27 +1,31 @@
 import os
-from ollama import Client
-import lancedb
+import threading
 from dotenv import load_dotenv
-from src.classes import new_GovDoc, new_Embedding
 
 load_dotenv()
 
-OLLAMA_EMBED_URL = os.getenv('OLLAMA_EMBED_URL')
+OLLAMA_EMBED_URL = os.getenv('OLLAMA_EMBED_URL')  # One url or several separated by commas
 EMBEDDING_MODEL = "snowflake-arctic-embed2:latest"
+EMBEDDING_DIM = int(os.getenv('EMBEDDING_DIM', 1024))  # Vector size of EMBEDDING_MODEL
+VECTOR_TYPES = ("float32", "float16")
+VECTOR_TYPE = os.getenv('VECTOR_TYPE', "float32")  # Value type of the vectors in new embeddings tables
 EMBED_API_KEY = os.getenv('EMBED_API_KEY')
-if not EMBED_API_KEY:
-  raise ValueError("EMBED_API_KEY not found in environment variables")
-EMBED_HEADERS = {"Authorization": f"Bearer {EMBED_API_KEY}"}
-OLLAMA_QUERY_URL = os.getenv('OLLAMA_QUERY_URL')
+OLLAMA_QUERY_URL = os.getenv('OLLAMA_QUERY_URL')  # One url or several separated by commas
 QUERY_API_KEY = os.getenv('QUERY_API_KEY')
-if not QUERY_API_KEY:
-  raise ValueError("QUERY_API_KEY not found in environment variables")
-QUERY_HEADERS = {"Authorization": f"Bearer {QUERY_API_KEY}"}
 CONTEXT_WINDOW = 4096
 PROMPT_OPTIONS = {"temperature": 0.0, "num_ctx": CONTEXT_WINDOW}
-VECTOR_DB_PATH = "./lance_db"
+VECTOR_DB_PATH = os.getenv('VECTOR_DB_PATH', "./lance_db")
 FORCE_REBUILD = False  # Set to True to rebuild the vector store from scratch
 DEBUG = False
+EMBED_BATCH_SIZE = 16  # Number of chunks sent per embedding request
+SINGLE_CALL = False  # Extract metadata, category and keywords with one prompt
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', "./llm_cache.sqlite")
+DEDUP_PATH = os.getenv('DEDUP_PATH', "./duplicates.sqlite")  # Groups of near-duplicate documents
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+USE_LLM_CACHE = True  # Reuse stored answers for identical model, options and prompt
+CONTEXT_MODES = ("truncate", "representative")
+CONTEXT_MODE = "truncate"  # Document text sent with the metadata prompts: its beginning, or representative chunks
+CONTEXT_TOKENS = 2048  # Token budget of the representative chunks, about half of the truncated text
 
 # QUERY_MODEL = "llama3.3:70b-instruct-q6_K"
 # QUERY_MODEL = "llama3.2-vision:11b-instruct-q8_0"
@@ -33,19 +37,52 @@ QUERY_MODEL = "phi4:14b-q8_0"
 # QUERY_MODEL = "deepseek-r1:32b-qwen-distill-q8_0"
 # QUERY_MODEL = "phi4:latest"
 
-# Initialize Ollama clients
-ollama_embed = Client(
-    host=OLLAMA_EMBED_URL,
-    headers=EMBED_HEADERS,
-    timeout=60,
-)
-ollama_query = Client(
-    host=OLLAMA_QUERY_URL,
-    headers=QUERY_HEADERS,
-    timeout=60,
-)
-# Initialize LanceDB
-vector_db = lancedb.connect(VECTOR_DB_PATH)
+# Clients, the vector store and its tables are created on first use, so that
+# importing a module does not connect to anything or need the API keys
+_resources = {}
+_resources_lock = threading.RLock()
+
+def _api_headers(name, api_key):
+  if not api_key:
+    raise ValueError(f"{name} not found in environment variables")
+  return {"Authorization": f"Bearer {api_key}"}
+
+def _resource(name, create):
+  if name not in _resources:
+    with _resources_lock:
+      if name not in _resources:
+        _resources[name] = create()
+  return _resources[name]
+
+def get_ollama_embed():
+  from src.endpoints import EndpointPool, parse_urls
+  return _resource("ollama_embed", lambda: EndpointPool(
+      "embed",
+      parse_urls(OLLAMA_EMBED_URL),
+      headers=_api_headers("EMBED_API_KEY", EMBED_API_KEY),
+      timeout=60,
+  ))
+
+def get_ollama_query():
+  from src.endpoints import EndpointPool, parse_urls
+  return _resource("ollama_query", lambda: EndpointPool(
+      "query",
+      parse_urls(OLLAMA_QUERY_URL),
+      headers=_api_headers("QUERY_API_KEY", QUERY_API_KEY),
+      timeout=60,
+  ))
+
+def get_ollama_embed_async():
+  from src.endpoints import AsyncEndpointPool
+  return _resource("ollama_embed_async", lambda: AsyncEndpointPool(get_ollama_embed()))
+
+def get_ollama_query_async():
+  from src.endpoints import AsyncEndpointPool
+  return _resource("ollama_query_async", lambda: AsyncEndpointPool(get_ollama_query()))
+
+def get_vector_db():
+  import lancedb
+  return _resource("vector_db", lambda: lancedb.connect(VECTOR_DB_PATH))
 
 def get_debug():
   return DEBUG
@@ -53,13 +90,46 @@ def get_debug():
 def get_force_rebuild():
   return FORCE_REBUILD
 
-def set_parameters(debug: bool = False, force_rebuild: bool = False):
-  global DEBUG, FORCE_REBUILD
+def get_embed_batch_size():
+  return EMBED_BATCH_SIZE
+
+def get_single_call():
+  return SINGLE_CALL
+
+def get_use_llm_cache():
+  return USE_LLM_CACHE
+
+def get_context_mode():
+  return CONTEXT_MODE
+
+def get_context_tokens():
+  return CONTEXT_TOKENS
+
+def set_parameters(debug: bool = False,
+                   force_rebuild: bool = False,
+                   embed_batch_size: int = EMBED_BATCH_SIZE,
+                   single_call: bool = SINGLE_CALL,
+                   use_llm_cache: bool = USE_LLM_CACHE,
+                   context_mode: str = CONTEXT_MODE,
+                   context_tokens: int = CONTEXT_TOKENS):
+  global DEBUG, FORCE_REBUILD, EMBED_BATCH_SIZE, SINGLE_CALL, USE_LLM_CACHE, CONTEXT_MODE, CONTEXT_TOKENS
+  if context_mode not in CONTEXT_MODES:
+    raise ValueError(f"Unknown context mode {context_mode}, use one of {', '.join(CONTEXT_MODES)}")
   DEBUG = debug
   FORCE_REBUILD = force_rebuild
+  EMBED_BATCH_SIZE = max(1, embed_batch_size)
+  SINGLE_CALL = single_call
+  USE_LLM_CACHE = use_llm_cache
+  CONTEXT_MODE = context_mode
+  CONTEXT_TOKENS = max(1, context_tokens)
 
 def get_documents_table():
+  return _resource("documents_table", _open_documents_table)
+
+def _open_documents_table():
+  vector_db = get_vector_db()
   if "documents" not in vector_db.table_names():
+    from src.classes import new_GovDoc
     # Provide a sample record to define the schema
     sample_data = [new_GovDoc().model_dump()]
     documents_table = vector_db.create_table("documents", sample_data)
@@ -67,11 +137,31 @@ def get_documents_table():
     documents_table = vector_db.open_table("documents")
   return documents_table
 
+def get_embeddings_schema(vector_type=None):
+  import pyarrow as pa
+  # Mirrors the Embedding model so that chunks can be written as one Arrow batch.
+  # Vectors are fixed-size so that the column can be indexed and searched.
+  vector_type = vector_type or VECTOR_TYPE
+  if vector_type not in VECTOR_TYPES:
+    raise ValueError(f"Unknown vector type {vector_type}, use one of {', '.join(VECTOR_TYPES)}")
+  return pa.schema([
+      pa.field("doc_id", pa.string()),
+      pa.field("chunk_id", pa.int64()),
+      pa.field("content", pa.string()),
+      pa.field("chunk_hash", pa.string()),
+      pa.field("embedding", pa.list_(getattr(pa, vector_type)(), EMBEDDING_DIM)),
+  ])
+
 def get_embeddings_table():
+  return _resource("embeddings_table", _open_embeddings_table)
+
+def _open_embeddings_table():
+  vector_db = get_vector_db()
   if "embeddings" not in vector_db.table_names():
-    # Provide a sample record to define the schema
-    sample_data = [new_Embedding().model_dump()]
-    embeddings_table = vector_db.create_table("embeddings", sample_data)
+    embeddings_table = vector_db.create_table("embeddings", schema=get_embeddings_schema())
   else:
     embeddings_table = vector_db.open_table("embeddings")
+    if "chunk_hash" not in embeddings_table.schema.names:
+      # Tables created before chunk hashes existed; their chunks are re-embedded when forced
+      embeddings_table.add_columns({"chunk_hash": "''"})
   return embeddings_table
@@ -0,0 +1,47 @@
+import numpy as np
+
+from src.config import get_embeddings_table
+from src.doneset import sql_quote
+from src.embed import vectors_to_numpy
+
+FIRST_CHUNKS = 1  # Chunks from the start of the document, where the title page and front matter are
+GAP_MARKER = "\n\n[...]\n\n"  # Separates chunks that are not next to each other in the document
+
+
+def stored_chunks(doc_id):
+  """
+    Reads the chunks and vectors that `embed_document` stored for a document.
+    :return: The chunk texts and an array of their vectors, in document order.
+    """
+  chunks = get_embeddings_table().search().where(f"doc_id = {sql_quote(doc_id)}") \
+      .select(["chunk_id", "content", "embedding"]).limit(None).to_arrow()
+  chunks = chunks.sort_by("chunk_id")
+  contents = chunks["content"].to_pylist()
+  return contents, vectors_to_numpy(chunks["embedding"]).astype(np.float32)
+
+
+def select_chunks(vectors, token_counts, max_tokens, first_chunks=FIRST_CHUNKS) -> list[int]:
+  """
+    Takes the first chunks of the document, then the chunks closest to the centroid of all its
+    vectors, as long as they fit in `max_tokens`.
+    :return: The indexes of the selected chunks, in document order.
+    """
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  normalized = vectors / np.where(norms == 0, 1, norms)
+  centroid = normalized.mean(axis=0)
+  similarity = normalized @ centroid
+  first = list(range(min(first_chunks, len(vectors))))
+  closest = [int(i) for i in np.argsort(-similarity) if i >= first_chunks]
+  selected, used = [], 0
+  for i in first + closest:
+    if used + token_counts[i] <= max_tokens:
+      selected.append(i)
+      used += token_counts[i]
+  return sorted(selected)
+
+
+def join_chunks(contents, selected) -> str:
+  text = contents[selected[0]]
+  for previous, i in zip(selected, selected[1:]):
+    text += ("\n\n" if i == previous + 1 else GAP_MARKER) + contents[i]
+  return text
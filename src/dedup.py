@@ -0,0 +1,277 @@
+import re
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+import numpy as np
+import pyarrow as pa
+
+from src import metrics
+from src.classes import GovDoc, get_id_from_filename
+from src.config import get_documents_table, get_embeddings_table, get_force_rebuild
+from src.doneset import sql_quote
+from src.embed import embedded_docs
+from src.metadata import titled_docs, save_metadata
+
+NUM_PERM = 128  # Size of a MinHash signature
+SHINGLE_SIZE = 5  # Words per shingle
+THRESHOLD = 0.8  # Estimated Jaccard similarity from which two documents are duplicates
+MIN_SHINGLES = 20  # Shorter texts (e.g. failed OCR) are never grouped
+SHINGLE_BLOCK = 8192  # Shingles permuted at a time, bounds the memory used for long documents
+DEDUP_MODES = ("copy", "link")
+SHINGLE_MULTIPLIER = np.uint64(1099511628211)  # Combines the word hashes of a shingle (the 64-bit FNV prime)
+
+# The permutations are fixed so that signatures do not depend on the run
+_rng = np.random.default_rng(1)
+PERM_A = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)  # odd multipliers
+PERM_B = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text, size=SHINGLE_SIZE) -> np.ndarray:
+  """
+    Hashes of the distinct word n-grams of the text, ignoring case and punctuation.
+    Every word is hashed once, and the hashes of the n-grams are combined from them with numpy.
+    """
+  words = re.findall(r"\w+", text.lower())
+  count = len(words) - size + 1
+  if count <= 0:
+    return np.empty(0, dtype=np.uint64)
+  vocabulary = {word: zlib.crc32(word.encode("utf-8")) for word in set(words)}
+  hashes = np.fromiter((vocabulary[word] for word in words), dtype=np.uint64, count=len(words))
+  grams = np.zeros(count, dtype=np.uint64)
+  for i in range(size):
+    grams = grams * SHINGLE_MULTIPLIER + hashes[i:i + count]  # modulo 2^64
+  return np.unique(grams)
+
+
+def minhash(hashes: np.ndarray) -> np.ndarray:
+  """
+    MinHash signature of a set of shingle hashes: the minimum of each of NUM_PERM random
+    multiply-shift hash functions, the top 32 bits of (a * x + b) mod 2^64.
+    """
+  signature = np.full(NUM_PERM, np.iinfo(np.uint64).max, dtype=np.uint64)
+  for start in range(0, len(hashes), SHINGLE_BLOCK):
+    block = hashes[start:start + SHINGLE_BLOCK]
+    permuted = (np.outer(PERM_A, block) + PERM_B[:, None]) >> np.uint64(32)
+    signature = np.minimum(signature, permuted.min(axis=1))
+  return signature
+
+
+def similarity(first: np.ndarray, second: np.ndarray) -> float:
+  # Share of equal MinHash values, an estimate of the Jaccard similarity of the shingle sets
+  return float(np.mean(first == second))
+
+
+def band_layout(threshold, num_perm=NUM_PERM) -> tuple[int, int]:
+  """
+    Splits the signature into bands of rows for LSH. Two documents become candidates when one
+    band is identical, which happens around a similarity of (1 / bands) ^ (1 / rows); the layout
+    with the highest such point below `threshold` keeps few candidates while missing few pairs.
+    :return: The number of bands and of rows per band.
+    """
+  layouts = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+  below = [(bands, rows) for bands, rows in layouts if (1 / bands)**(1 / rows) <= threshold]
+  return max(below, key=lambda layout: (1 / layout[0])**(1 / layout[1]))
+
+
+class MinHashIndex:
+  """
+    LSH index of MinHash signatures. Documents that share a band are candidates, and
+    candidates are matches if their estimated similarity reaches the threshold.
+    """
+
+  def __init__(self, threshold=THRESHOLD):
+    self.threshold = threshold
+    self.bands, self.rows = band_layout(threshold)
+    self.signatures = {}
+    self._buckets = [{} for _ in range(self.bands)]
+
+  def add(self, key, signature: np.ndarray) -> list[tuple]:
+    """
+      Adds a document to the index.
+      :return: The documents added before that match it, with their similarity.
+      """
+    candidates = set()
+    for band, buckets in enumerate(self._buckets):
+      keys = buckets.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), [])
+      candidates.update(keys)
+      keys.append(key)
+    self.signatures[key] = signature
+    matches = [(other, similarity(signature, self.signatures[other])) for other in candidates]
+    return [(other, score) for other, score in matches if score >= self.threshold]
+
+
+def find_groups(files, threshold=THRESHOLD) -> list[dict]:
+  """
+    Groups near-duplicate text files, such as reprints and new editions of a publication.
+    Matching documents are linked, and a group is a set of linked documents. Its representative
+    is the document with the most shingles, i.e. the most complete text. Documents that only joined
+    the group through another member and are below `threshold` to the representative are left out.
+    :return: One dict per group of two or more files, with the `representative` file and its
+    `members`, a list of (file, similarity to the representative).
+    """
+  index = MinHashIndex(threshold)
+  parents = list(range(len(files)))
+  sizes = []
+
+  def root(i):
+    while parents[i] != i:
+      parents[i] = parents[parents[i]]
+      i = parents[i]
+    return i
+
+  for i, file in enumerate(files):
+    with file.open('r', encoding='utf-8') as f:
+      hashes = shingles(f.read())
+    sizes.append(len(hashes))
+    if len(hashes) < MIN_SHINGLES:
+      continue
+    for other, _ in index.add(i, minhash(hashes)):
+      parents[root(other)] = root(i)
+  components = {}
+  for i in range(len(files)):
+    components.setdefault(root(i), []).append(i)
+  groups = []
+  for indexes in components.values():
+    if len(indexes) < 2:
+      continue
+    representative = max(indexes, key=lambda i: (sizes[i], -i))
+    signature = index.signatures[representative]
+    members = [(files[i], similarity(signature, index.signatures[i])) for i in indexes if i != representative]
+    members = [(file, score) for file, score in members if score >= threshold]
+    if not members:
+      continue
+    groups.append({"representative": files[representative], "members": members})
+  return groups
+
+
+class DuplicateGroups:
+  """
+    Group membership of the near-duplicate documents in a SQLite file, so that every
+    document that was not processed itself can be traced to the one that was.
+    """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._connection = None
+
+  @property
+  def connection(self):
+    if self._connection is None:
+      self._connection = sqlite3.connect(self.path, check_same_thread=False)
+      self._connection.execute("CREATE TABLE IF NOT EXISTS duplicates ("
+                               "doc_id TEXT PRIMARY KEY, representative TEXT NOT NULL, "
+                               "similarity REAL NOT NULL, status TEXT NOT NULL, updated REAL NOT NULL)")
+      self._connection.execute("CREATE INDEX IF NOT EXISTS duplicates_representative ON duplicates (representative)")
+      self._connection.commit()
+    return self._connection
+
+  def record(self, files, groups: list[dict]):
+    """
+      Replaces the membership of the given files with `groups`. Representatives are stored as
+      members of their own group, files that are not in any group are removed.
+      """
+    now = time.time()
+    rows = []
+    for group in groups:
+      representative = get_id_from_filename(group["representative"].name)
+      rows.append((representative, representative, 1.0, "representative", now))
+      rows.extend((get_id_from_filename(file.name), representative, score, "pending", now)
+                  for file, score in group["members"])
+    with self._lock:
+      self.connection.executemany("DELETE FROM duplicates WHERE doc_id = ?",
+                                  [(get_id_from_filename(file.name),) for file in files])
+      self.connection.executemany("INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?, ?, ?)", rows)
+      self.connection.commit()
+
+  def set_status(self, doc_id: str, status: str):
+    with self._lock:
+      self.connection.execute("UPDATE duplicates SET status = ?, updated = ? WHERE doc_id = ?",
+                              (status, time.time(), doc_id))
+      self.connection.commit()
+
+  def linked_members(self, representatives) -> dict[str, list[str]]:
+    """
+      The duplicates without chunks of their own, that search results for their representative stand for.
+      :return: A dict of representative to the doc_ids of its linked duplicates.
+      """
+    representatives = list(representatives)
+    with self._lock:
+      rows = self.connection.execute(
+          f"SELECT representative, doc_id FROM duplicates WHERE status = 'linked' AND representative IN "
+          f"({', '.join('?' * len(representatives))}) ORDER BY doc_id", representatives).fetchall()
+    members = {}
+    for representative, doc_id in rows:
+      members.setdefault(representative, []).append(doc_id)
+    return members
+
+  def summary(self) -> dict:
+    """
+      :return: The number of groups, and the number of duplicates per status.
+      """
+    with self._lock:
+      groups = self.connection.execute("SELECT COUNT(*) FROM duplicates WHERE status = 'representative'").fetchone()
+      statuses = dict(self.connection.execute("SELECT status, COUNT(*) FROM duplicates "
+                                              "WHERE status != 'representative' GROUP BY status").fetchall())
+    return {"groups": groups[0], "duplicates": statuses}
+
+
+def copy_metadata(representative_id, doc_id, filename) -> bool:
+  found = get_documents_table().search().where(f"doc_id = {sql_quote(representative_id)}").limit(1).to_list()
+  if not found or not found[0].get("title"):
+    return False
+  record = {name: found[0].get(name) for name in GovDoc.model_fields}
+  record.update(doc_id=doc_id, filename=filename)
+  save_metadata(GovDoc(**record))
+  return True
+
+
+def copy_embeddings(representative_id, doc_id) -> bool:
+  table = get_embeddings_table()
+  rows = table.search().where(f"doc_id = {sql_quote(representative_id)}").select(table.schema.names) \
+      .limit(None).to_arrow()
+  if rows.num_rows == 0:
+    return False
+  rows = rows.set_column(rows.schema.get_field_index("doc_id"), table.schema.field("doc_id"),
+                         pa.array([doc_id] * rows.num_rows, pa.string()))
+  with metrics.timer("db_write", table="embeddings"):
+    if doc_id in embedded_docs:
+      table.delete(f"doc_id = {sql_quote(doc_id)}")
+    table.add(rows.select(table.schema.names))
+  embedded_docs.add(doc_id)
+  return True
+
+
+def share_results(groups: list[dict], mode: str, store: DuplicateGroups):
+  """
+    Gives the duplicates of every group the metadata of their representative and, in `copy` mode,
+    its chunks and vectors. In `link` mode duplicates have no chunks: search results for the
+    representative list them as its duplicates (see `DuplicateGroups.linked_members`).
+    Duplicates that already have their own results are left alone unless rebuilding is forced.
+    """
+  for group in groups:
+    representative_id = get_id_from_filename(group["representative"].name)
+    for file, _ in group["members"]:
+      doc_id = get_id_from_filename(file.name)
+      needs_metadata = doc_id not in titled_docs or get_force_rebuild()
+      needs_embeddings = mode == "copy" and (doc_id not in embedded_docs or get_force_rebuild())
+      status = "copied" if mode == "copy" else "linked"
+      if not needs_metadata and not needs_embeddings:
+        store.set_status(doc_id, "existing")
+        metrics.increment("duplicates", status="existing")
+        continue
+      try:
+        with metrics.timer("dedup_share"):
+          if needs_metadata and not copy_metadata(representative_id, doc_id, file.name):
+            status = "failed"
+          if needs_embeddings and not copy_embeddings(representative_id, doc_id):
+            status = "failed"
+        if status == "failed":
+          logging.error(f"No results of {representative_id} to share with its duplicate {doc_id}")
+      except Exception as e:
+        logging.error(f"Error sharing the results of {representative_id} with {doc_id}: {e}")
+        status = "failed"
+      store.set_status(doc_id, status)
+      metrics.increment("duplicates", status=status)
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+
+def sql_quote(value: str) -> str:
+  # Quote a string literal for use in a LanceDB filter
+  return "'" + str(value).replace("'", "''") + "'"
+
+
+def scan_column(table, column: str, where: str = None) -> list:
+  """
+    Reads a single column from the table without materialising the other columns.
+    """
+  query = table.search().select([column]).limit(None)
+  if where:
+    query = query.where(where)
+  return query.to_arrow()[column].to_pylist()
+
+
+_indexed_columns = set()
+
+
+def ensure_scalar_index(table, column: str):
+  # A scalar index keeps filtered lookups and deletes on `column` from scanning the whole table
+  if (table.name, column) in _indexed_columns:
+    return
+  try:
+    if not any(column in index.columns for index in table.list_indices()):
+      if table.count_rows() == 0:
+        return
+      table.create_scalar_index(column)
+    _indexed_columns.add((table.name, column))
+  except Exception as e:
+    logging.debug(f"Could not create scalar index on {column}: {e}")
+
+
+class DoneSet:
+  """
+    The set of doc_ids that are already processed in a table.
+    It is loaded once per run and kept up to date as documents complete.
+    """
+
+  def __init__(self, table, where: str = None):
+    # `table` can also be a function returning the table, so that it is only opened when needed
+    self._table = table
+    self.where = where
+    self._doc_ids = None
+    self._lock = threading.Lock()
+
+  @property
+  def table(self):
+    return self._table() if callable(self._table) else self._table
+
+  def load(self):
+    ensure_scalar_index(self.table, "doc_id")
+    self._doc_ids = set(scan_column(self.table, "doc_id", self.where))
+    logging.debug(f"Loaded {len(self._doc_ids)} processed doc_ids from {self.table.name}")
+    return self
+
+  @property
+  def doc_ids(self) -> set:
+    if self._doc_ids is None:
+      # pipeline stages share the set between threads, only the first one scans the table
+      with self._lock:
+        if self._doc_ids is None:
+          self.load()
+    return self._doc_ids
+
+  def __contains__(self, doc_id) -> bool:
+    return doc_id in self.doc_ids
+
+  def __len__(self) -> int:
+    return len(self.doc_ids)
+
+  def add(self, doc_id):
+    self.doc_ids.add(doc_id)
+
+  def discard(self, doc_id):
+    self.doc_ids.discard(doc_id)
@@ -1,13 +1,21 @@
 import re
+import hashlib
 import logging
+import asyncio
+from contextlib import nullcontext
+import numpy as np
+import pyarrow as pa
 
-from src.classes import Embedding, get_id_from_filename
-from src.config import get_embeddings_table, ollama_embed, EMBEDDING_MODEL, get_force_rebuild
+from src import metrics
+from src.classes import get_id_from_filename
+from src.doneset import DoneSet, sql_quote, ensure_scalar_index
+from src.config import get_embeddings_table, get_ollama_embed, get_ollama_embed_async, EMBEDDING_MODEL, get_force_rebuild, get_embed_batch_size
 
 MIN_CHUNK_SIZE = 100
 MAX_CHUNK_SIZE = 500
+LOOKUP_BATCH_SIZE = 500  # Number of hashes per vector lookup query
 
-embeddings_table = get_embeddings_table()
+embedded_docs = DoneSet(get_embeddings_table)
 
 
 def clean_and_normalize_text(text):
@@ -16,9 +24,9 @@ def clean_and_normalize_text(text):
     """
   # Remove artifacts like page numbers, extra symbols, and excessive whitespace
   text = re.sub(r'(Page \d+:?|[‘"“”\'`~!@#$%^&*_+=|\{\}\[\]<>/\\]+)', '', text)
-  text = re.sub(r'\s*\n\s*', '\n', text)  # Normalize newlines
+  text = re.sub(r'[^\S\n]*\n[^\S\n]*', '\n', text)  # Normalize newlines (keeping blank lines)
   text = re.sub(r'\n{2,}', '\n\n', text)  # Ensure double newlines separate paragraphs
-  text = re.sub(r'[^\x20-\x7E]', '', text)  # Remove non-ASCII characters
+  text = re.sub(r'[^\x20-\x7E\n]', '', text)  # Remove non-ASCII characters
   return text.strip()
 
 
@@ -98,36 +106,215 @@ def print_chunks(chunks):
 
 def get_embedding(text):
   try:
-    response = ollama_embed.embed(model=EMBEDDING_MODEL, input=text)
+    with metrics.timer("embed_request"):
+      response = get_ollama_embed().embed(model=EMBEDDING_MODEL, input=text)
+    metrics.increment("embedded_chunks", 1 if isinstance(text, str) else len(text))
     return response['embeddings']
   except Exception as e:
     logging.error(f"Error getting embedding: {e}")
+    metrics.increment("errors", stage="embed_request")
     return None
 
 
-def embed_document(text, filename):
+def get_embeddings(chunks, batch_size=None) -> np.ndarray | None:
+  """
+    Embeds the chunks with one request per `batch_size` chunks.
+    :return: A float32 array with one vector per chunk, or None if any request failed.
+    """
+  batch_size = batch_size or get_embed_batch_size()
+  vectors = []
+  for start in range(0, len(chunks), batch_size):
+    batch = chunks[start:start + batch_size]
+    embeddings = get_embedding(batch)
+    if embeddings is None or len(embeddings) != len(batch):
+      return None
+    vectors.append(np.asarray(embeddings, dtype=np.float32))
+  return np.concatenate(vectors)
+
+
+def chunk_hash(chunk) -> str:
+  # Vectors can be reused for identical chunks embedded with the same model
+  return hashlib.sha256(f"{EMBEDDING_MODEL}\n{chunk}".encode("utf-8")).hexdigest()
+
+
+def lookup_vectors(hashes) -> dict:
+  """
+    Finds stored vectors for the given chunk hashes in any document.
+    :return: A dict of chunk hash to vector.
+    """
+  hashes = sorted(set(hashes))
+  vectors = {}
+  if not hashes:
+    return vectors
+  ensure_scalar_index(get_embeddings_table(), "chunk_hash")
+  for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+    in_list = ", ".join(sql_quote(h) for h in hashes[start:start + LOOKUP_BATCH_SIZE])
+    found = get_embeddings_table().search().where(f"chunk_hash IN ({in_list})") \
+        .select(["chunk_hash", "embedding"]).limit(None).to_arrow()
+    vectors.update(zip(found["chunk_hash"].to_pylist(), vectors_to_numpy(found["embedding"])))
+  return vectors
+
+
+def vectors_to_numpy(column) -> np.ndarray:
+  # View of a fixed-size vector column as a (rows, dimensions) array, without copying the values
+  if isinstance(column, pa.ChunkedArray):
+    column = column.combine_chunks()
+  if len(column) == 0:
+    return np.empty((0, column.type.list_size), dtype=column.type.value_type.to_pandas_dtype())
+  return column.flatten().to_numpy().reshape(len(column), -1)
+
+
+def vectors_to_arrow(vectors: np.ndarray, vector_type: pa.DataType) -> pa.Array:
+  # Without copying when the vectors are contiguous and already of the column's value type (float32 or float16)
+  values = np.ascontiguousarray(vectors, dtype=vector_type.value_type.to_pandas_dtype())
+  if not pa.types.is_fixed_size_list(vector_type):
+    # Variable-length vectors of tables that were not migrated yet
+    return pa.array(list(values), vector_type)
+  return pa.FixedSizeListArray.from_arrays(pa.array(values.ravel()), vector_type.list_size)
+
+
+def embeddings_to_arrow(doc_id, rows) -> pa.Table:
+  # Build a single columnar batch so that the document is written with one `add`
+  schema = get_embeddings_table().schema
+  columns = {
+      "doc_id": [doc_id] * len(rows),
+      "chunk_id": [row["chunk_id"] for row in rows],
+      "content": [row["content"] for row in rows],
+      "chunk_hash": [row["chunk_hash"] for row in rows],
+  }
+  arrays = {name: pa.array(values, schema.field(name).type) for name, values in columns.items()}
+  arrays["embedding"] = vectors_to_arrow(np.stack([row["embedding"] for row in rows]), schema.field("embedding").type)
+  return pa.Table.from_arrays([arrays[name] for name in schema.names], schema=schema)
+
+
+def prepare_embedding(text, filename):
+  """
+    Applies the skip/force rules, chunks the document and diffs it against the stored chunks.
+    Rows whose vector is already stored (in this or any other document) get that vector,
+    the others have `embedding` set to None and still need to be embedded.
+    :return: The doc_id, the rows to insert and the chunk_ids to delete, or None if the document should be skipped.
+    """
   doc_id = get_id_from_filename(filename)
+  stored = {}
   # Check if the embedding already exists in the table
-  existing = embeddings_table.to_pandas().query(f"doc_id == '{doc_id}'")
-  if not get_force_rebuild() and not existing.empty:
-    logging.info(f"Skipping embedding for {doc_id} (already exists)")
+  if doc_id in embedded_docs:
+    if not get_force_rebuild():
+      logging.info(f"Skipping embedding for {doc_id} (already exists)")
+      return None
+    existing = get_embeddings_table().search().where(f"doc_id = {sql_quote(doc_id)}") \
+        .select(["chunk_id", "chunk_hash"]).limit(None).to_arrow()
+    stored = dict(zip(existing["chunk_id"].to_pylist(), existing["chunk_hash"].to_pylist()))
+
+  with metrics.timer("chunk"):
+    chunks = chunk_text(text)
+  if not chunks:
+    logging.info(f"No chunks to embed for {doc_id}")
+    if stored:
+      get_embeddings_table().delete(f"doc_id = {sql_quote(doc_id)}")
+      embedded_docs.discard(doc_id)
+    return None
+  hashes = [chunk_hash(chunk) for chunk in chunks]
+  # Only chunks that are new or changed at their position are rewritten
+  rows = [{
+      "chunk_id": chunk_id,
+      "content": chunk,
+      "chunk_hash": digest,
+      "embedding": None
+  } for chunk_id, (chunk, digest) in enumerate(zip(chunks, hashes)) if stored.get(chunk_id) != digest]
+  stale_ids = [
+      chunk_id for chunk_id, digest in stored.items() if chunk_id >= len(hashes) or hashes[chunk_id] != digest
+  ]
+
+  with metrics.timer("vector_lookup"):
+    known = lookup_vectors(row["chunk_hash"] for row in rows)
+  for row in rows:
+    row["embedding"] = known.get(row["chunk_hash"])
+  reused = sum(row["embedding"] is not None for row in rows)
+  metrics.increment("reused_vectors", reused)
+  logging.debug(f"{doc_id}: {len(chunks) - len(rows)} chunks unchanged, {reused} vectors reused, "
+                f"{len(rows) - reused} chunks to embed, {len(stale_ids)} stale chunks")
+  return doc_id, rows, stale_ids
+
+
+def missing_chunks(rows) -> list[str]:
+  # Unique chunk texts that still need a vector
+  return list(dict.fromkeys(row["content"] for row in rows if row["embedding"] is None))
+
+
+def fill_vectors(rows, chunks, vectors) -> bool:
+  if vectors is None:  # Handle failed embeddings
+    return False
+  by_content = dict(zip(chunks, vectors))
+  for row in rows:
+    if row["embedding"] is None:
+      row["embedding"] = by_content[row["content"]]
+  return True
+
+
+def save_embeddings(doc_id, rows, stale_ids):
+  with metrics.timer("db_write", table="embeddings"):
+    if stale_ids:
+      # Delete changed or removed chunks of this document
+      id_list = ", ".join(str(chunk_id) for chunk_id in stale_ids)
+      get_embeddings_table().delete(f"doc_id = {sql_quote(doc_id)} AND chunk_id IN ({id_list})")
+    # Save embeddings to LanceDB
+    if rows:
+      get_embeddings_table().add(embeddings_to_arrow(doc_id, rows))
+  embedded_docs.add(doc_id)
+
+
+def embed_document(text, filename):
+  prepared = prepare_embedding(text, filename)
+  if prepared is None:
+    return
+  doc_id, rows, stale_ids = prepared
+  chunks = missing_chunks(rows)
+  if not fill_vectors(rows, chunks, get_embeddings(chunks) if chunks else []):
+    logging.error(f"Failed to get embedding. Cancelling embedding for {doc_id}")
+    metrics.increment("errors", stage="embed")
+    return
+  save_embeddings(doc_id, rows, stale_ids)
+
+
+async def get_embedding_async(text, limiter=None):
+  try:
+    async with limiter or nullcontext():
+      with metrics.timer("embed_request"):
+        response = await get_ollama_embed_async().embed(model=EMBEDDING_MODEL, input=text)
+    metrics.increment("embedded_chunks", 1 if isinstance(text, str) else len(text))
+    return response['embeddings']
+  except Exception as e:
+    logging.error(f"Error getting embedding: {e}")
+    metrics.increment("errors", stage="embed_request")
+    return None
+
+
+async def get_embeddings_async(chunks, batch_size=None, limiter=None) -> np.ndarray | None:
+  """
+    Same as `get_embeddings` but sends the batches concurrently.
+    `limiter` (e.g. an asyncio.Semaphore) bounds the number of requests in flight.
+    """
+  batch_size = batch_size or get_embed_batch_size()
+  batches = [chunks[start:start + batch_size] for start in range(0, len(chunks), batch_size)]
+  results = await asyncio.gather(*(get_embedding_async(batch, limiter) for batch in batches))
+  vectors = []
+  for batch, embeddings in zip(batches, results):
+    if embeddings is None or len(embeddings) != len(batch):
+      return None
+    vectors.append(np.asarray(embeddings, dtype=np.float32))
+  return np.concatenate(vectors)
+
+
+async def embed_document_async(text, filename, limiter=None):
+  # Chunking and the table reads and writes run in a thread, so that only the requests wait on the event loop
+  prepared = await asyncio.to_thread(prepare_embedding, text, filename)
+  if prepared is None:
+    return
+  doc_id, rows, stale_ids = prepared
+  chunks = missing_chunks(rows)
+  vectors = await get_embeddings_async(chunks, limiter=limiter) if chunks else []
+  if not fill_vectors(rows, chunks, vectors):
+    logging.error(f"Failed to get embedding. Cancelling embedding for {doc_id}")
+    metrics.increment("errors", stage="embed")
     return
-  if not existing.empty:
-    # Delete existing embeddings for this document
-    embeddings_table.delete(f"doc_id = '{doc_id}'")
-
-  chunks = chunk_text(text)
-  embeddings = []
-  for chunk in chunks:
-    embedding = get_embedding(chunk)
-    if embedding is None:  # Handle failed embeddings
-      logging.error(f"Failed to get embedding. Cancelling embedding for {doc_id}")
-      return
-    embeddings.append(embedding)
-
-  # Save embeddings to LanceDB
-  for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-    flat_embedding = [float(val) for sublist in embedding for val in sublist]
-    embed_model = Embedding(doc_id=doc_id, chunk_id=i, content=chunk, embedding=flat_embedding)
-    # Save the embedding to the database
-    embeddings_table.add([embed_model.model_dump()])
+  await asyncio.to_thread(save_embeddings, doc_id, rows, stale_ids)
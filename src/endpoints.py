@@ -0,0 +1,212 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+
+from src import metrics
+
+MAX_ATTEMPTS = 3  # Attempts per request, each on another endpoint when there is one
+BACKOFF = 0.5  # Seconds before the first retry, doubled on every attempt
+EJECT_AFTER = 3  # Consecutive failures before an endpoint stops receiving requests
+HEALTH_INTERVAL = 10.0  # Seconds between health checks of ejected endpoints
+HEALTH_TIMEOUT = 5.0
+LATENCY_WEIGHT = 0.2  # Weight of the latest request in the moving average latency
+
+
+def parse_urls(value) -> list[str]:
+  # One url, or several separated by commas
+  return [url.strip() for url in (value or "").split(",") if url.strip()]
+
+
+def is_retryable(error) -> bool:
+  """
+    Connection problems, timeouts and server errors are retried on another endpoint;
+    other errors, e.g. an unknown model, would fail the same way everywhere.
+    """
+  import httpx
+  from ollama import ResponseError
+  if isinstance(error, ResponseError):
+    return error.status_code >= 500 or error.status_code == 429
+  return isinstance(error, (ConnectionError, httpx.TransportError))
+
+
+class Endpoint:
+
+  def __init__(self, url, headers, timeout):
+    self.url = url
+    self.headers = headers
+    self.timeout = timeout
+    self.outstanding = 0
+    self.latency = None  # moving average of the request time in seconds
+    self.failures = 0  # consecutive failures
+    self.ejected = False
+    self.requests = 0
+    self.errors = 0
+    self._client = None
+    self._async_client = None
+
+  @property
+  def client(self):
+    from ollama import Client
+    if self._client is None:
+      self._client = Client(host=self.url, headers=self.headers, timeout=self.timeout)
+    return self._client
+
+  @property
+  def async_client(self):
+    from ollama import AsyncClient
+    if self._async_client is None:
+      self._async_client = AsyncClient(host=self.url, headers=self.headers, timeout=self.timeout)
+    return self._async_client
+
+  def score(self):
+    # Expected wait: requests in flight times the usual request time; untried endpoints first
+    return (self.outstanding + 1) * (self.latency or 0.0), self.outstanding, random.random()
+
+  def check_health(self) -> bool:
+    from ollama import Client
+    try:
+      Client(host=self.url, headers=self.headers, timeout=HEALTH_TIMEOUT).list()
+      return True
+    except Exception:
+      return False
+
+
+class EndpointPool:
+  """
+    Sends each request to the endpoint with the fewest requests in flight, weighted by its
+    recent latency, and retries failed requests on another endpoint after a jittered backoff.
+    Endpoints that fail EJECT_AFTER times in a row are ejected until a health check succeeds.
+    """
+
+  def __init__(self, name, urls, headers, timeout=60):
+    if not urls:
+      raise ValueError(f"No urls configured for the {name} endpoints")
+    self.name = name
+    self.endpoints = [Endpoint(url, headers, timeout) for url in urls]
+    self._lock = threading.Lock()
+    self._health_thread = None
+
+  def acquire(self, exclude=()) -> Endpoint:
+    with self._lock:
+      candidates = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+      # Prefer endpoints that were not tried for this request, and any endpoint over none at all
+      candidates = [endpoint for endpoint in candidates if endpoint not in exclude] or candidates or self.endpoints
+      endpoint = min(candidates, key=Endpoint.score)
+      endpoint.outstanding += 1
+      endpoint.requests += 1
+      return endpoint
+
+  def release(self, endpoint, seconds, error=None):
+    with self._lock:
+      endpoint.outstanding -= 1
+      if error is None:
+        endpoint.failures = 0
+        if endpoint.latency is None:
+          endpoint.latency = seconds
+        else:
+          endpoint.latency += LATENCY_WEIGHT * (seconds - endpoint.latency)
+        return
+      endpoint.errors += 1
+      endpoint.failures += 1
+      eject = (not endpoint.ejected and endpoint.failures >= EJECT_AFTER and
+               any(not other.ejected for other in self.endpoints if other is not endpoint))
+      if eject:
+        endpoint.ejected = True
+    if eject:
+      logging.warning(f"Ejected {self.name} endpoint {endpoint.url} after {endpoint.failures} failures: {error}")
+      metrics.increment("ejections", pool=self.name)
+      self._start_health_checks()
+
+  def _start_health_checks(self):
+    with self._lock:
+      if self._health_thread and self._health_thread.is_alive():
+        return
+      self._health_thread = threading.Thread(target=self._check_ejected, name=f"{self.name}-health", daemon=True)
+      self._health_thread.start()
+
+  def _check_ejected(self):
+    # Runs while any endpoint is ejected, and re-admits the ones that answer again
+    while True:
+      time.sleep(HEALTH_INTERVAL)
+      ejected = [endpoint for endpoint in self.endpoints if endpoint.ejected]
+      if not ejected:
+        return
+      for endpoint in ejected:
+        if endpoint.check_health():
+          with self._lock:
+            endpoint.ejected = False
+            endpoint.failures = 0
+            endpoint.latency = None  # measured again from the next requests
+          logging.warning(f"Re-admitted {self.name} endpoint {endpoint.url}")
+
+  def backoff(self, attempt) -> float:
+    return BACKOFF * 2**(attempt - 1) * random.uniform(0.5, 1.5)
+
+  def request(self, method, **kwargs):
+    tried = []
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+      endpoint = self.acquire(tried)
+      tried.append(endpoint)
+      start_time = time.time()
+      try:
+        response = getattr(endpoint.client, method)(**kwargs)
+      except Exception as e:
+        self.release(endpoint, time.time() - start_time, e)
+        if not is_retryable(e) or attempt == MAX_ATTEMPTS:
+          raise
+        logging.warning(f"{self.name} request to {endpoint.url} failed (attempt {attempt} of {MAX_ATTEMPTS}): {e}")
+        metrics.increment("retries", stage=self.name)
+        time.sleep(self.backoff(attempt))
+        continue
+      self.release(endpoint, time.time() - start_time)
+      return response
+
+  async def request_async(self, method, **kwargs):
+    tried = []
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+      endpoint = self.acquire(tried)
+      tried.append(endpoint)
+      start_time = time.time()
+      try:
+        response = await getattr(endpoint.async_client, method)(**kwargs)
+      except Exception as e:
+        self.release(endpoint, time.time() - start_time, e)
+        if not is_retryable(e) or attempt == MAX_ATTEMPTS:
+          raise
+        logging.warning(f"{self.name} request to {endpoint.url} failed (attempt {attempt} of {MAX_ATTEMPTS}): {e}")
+        metrics.increment("retries", stage=self.name)
+        await asyncio.sleep(self.backoff(attempt))
+        continue
+      self.release(endpoint, time.time() - start_time)
+      return response
+
+  def embed(self, **kwargs):
+    return self.request("embed", **kwargs)
+
+  def generate(self, **kwargs):
+    return self.request("generate", **kwargs)
+
+  def status(self) -> list[dict]:
+    with self._lock:
+      return [{
+          "url": endpoint.url,
+          "requests": endpoint.requests,
+          "errors": endpoint.errors,
+          "latency": endpoint.latency,
+          "ejected": endpoint.ejected,
+      } for endpoint in self.endpoints]
+
+
+class AsyncEndpointPool:
+  # Same interface as ollama's AsyncClient, sharing the endpoints and their statistics with the pool
+
+  def __init__(self, pool: EndpointPool):
+    self.pool = pool
+
+  async def embed(self, **kwargs):
+    return await self.pool.request_async("embed", **kwargs)
+
+  async def generate(self, **kwargs):
+    return await self.pool.request_async("generate", **kwargs)
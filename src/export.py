@@ -0,0 +1,165 @@
+import csv
+import json
+import hashlib
+import logging
+import textwrap
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from src.config import get_documents_table, get_vector_db
+
+EXPORT_FORMATS = ("json", "jsonl", "csv", "parquet")
+BATCH_SIZE = 1024  # Documents per record batch
+LIST_SEPARATOR = ", "  # Joins list columns in the CSV export
+
+
+def export_columns(schema: pa.Schema) -> list[str]:
+  # doc_id first, without the filename column
+  return ["doc_id"] + [name for name in schema.names if name not in ("doc_id", "filename")]
+
+
+def scan_documents(table=None, columns: list[str] = None, batch_size=BATCH_SIZE):
+  """
+    Streams the documents table as record batches, without the sample record that defines its schema.
+    """
+  table = table or get_documents_table()
+  columns = columns or export_columns(table.schema)
+  query = table.search().where("doc_id != 'sample'").select(columns).limit(None)
+  for batch in query.to_batches(batch_size):
+    if batch.num_rows:
+      yield batch
+
+
+def row_fingerprint(row: dict) -> str:
+  return hashlib.sha256(json.dumps(row, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def changed_since(version: int, batches):
+  """
+    Filters the batches down to the documents that were added or changed after table `version`.
+    Only a fingerprint per document of the old version is kept in memory.
+    """
+  old_table = get_vector_db().open_table("documents")
+  old_table.checkout(version)
+  old = {}
+  for batch in scan_documents(old_table, export_columns(old_table.schema)):
+    for row in batch.to_pylist():
+      old[row["doc_id"]] = row_fingerprint(row)
+  for batch in batches:
+    rows = batch.to_pylist()
+    keep = [old.get(row["doc_id"]) != row_fingerprint(row) for row in rows]
+    for row in rows:
+      old.pop(row["doc_id"], None)
+    if any(keep):
+      yield batch.filter(pa.array(keep))
+  if old:
+    logging.info(f"{len(old)} documents of version {version} no longer exist and are not exported")
+
+
+def join_list_columns(batch: pa.RecordBatch) -> pa.RecordBatch:
+  # CSV cells cannot hold lists: join them into one string per cell
+  columns = []
+  for column in batch.columns:
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+      column = pc.binary_join(column, LIST_SEPARATOR)
+    columns.append(column)
+  return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+class JsonArrayWriter:
+  # Writes the same layout as json.dump(rows, indent=2), one batch at a time
+  def __init__(self, path):
+    self.file = open(path, "w", encoding="utf-8")
+    self.count = 0
+
+  def write_batch(self, batch):
+    for row in batch.to_pylist():
+      self.file.write(",\n" if self.count else "[\n")
+      self.file.write(textwrap.indent(json.dumps(row, ensure_ascii=False, indent=2), "  "))
+      self.count += 1
+
+  def close(self):
+    self.file.write("\n]" if self.count else "[]")
+    self.file.close()
+
+
+class JsonLinesWriter:
+
+  def __init__(self, path):
+    self.file = open(path, "w", encoding="utf-8")
+
+  def write_batch(self, batch):
+    self.file.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in batch.to_pylist())
+
+  def close(self):
+    self.file.close()
+
+
+class CsvWriter:
+  # Minimal quoting like pandas' to_csv, which Arrow's CSV writer cannot do for strings
+
+  def __init__(self, path, schema):
+    self.file = open(path, "w", encoding="utf-8", newline="")
+    self.writer = csv.writer(self.file, lineterminator="\n")
+    self.writer.writerow(schema.names)
+
+  def write_batch(self, batch):
+    columns = [column.to_pylist() for column in join_list_columns(batch).columns]
+    self.writer.writerows(zip(*columns))
+
+  def close(self):
+    self.file.close()
+
+
+class ParquetWriter:
+
+  def __init__(self, path, schema):
+    import pyarrow.parquet
+    self.writer = pyarrow.parquet.ParquetWriter(path, schema)
+
+  def write_batch(self, batch):
+    self.writer.write_batch(batch)
+
+  def close(self):
+    self.writer.close()
+
+
+def open_writer(export_format, path, schema):
+  if export_format == "json":
+    return JsonArrayWriter(path)
+  if export_format == "jsonl":
+    return JsonLinesWriter(path)
+  if export_format == "csv":
+    return CsvWriter(path, schema)
+  if export_format == "parquet":
+    return ParquetWriter(path, schema)
+  raise ValueError(f"Unknown export format {export_format}, use one of {', '.join(EXPORT_FORMATS)}")
+
+
+def export_documents(formats=("json", "csv"), basename="metadata", since_version: int = None) -> dict:
+  """
+    Streams the documents table into one file per format, a record batch at a time.
+    With `since_version` only the documents added or changed after that table version are exported.
+    :return: A dict of format to the path written, plus the exported table version and number of documents.
+    """
+  table = get_documents_table()
+  table.checkout_latest()
+  columns = export_columns(table.schema)
+  schema = pa.schema([table.schema.field(name) for name in columns])
+  if since_version is not None:
+    basename = f"{basename}_since_v{since_version}"
+  paths = {export_format: f"{basename}.{export_format}" for export_format in formats}
+  writers = [open_writer(export_format, path, schema) for export_format, path in paths.items()]
+  batches = scan_documents(table, columns)
+  if since_version is not None:
+    batches = changed_since(since_version, batches)
+  documents = 0
+  try:
+    for batch in batches:
+      documents += batch.num_rows
+      for writer in writers:
+        writer.write_batch(batch)
+  finally:
+    for writer in writers:
+      writer.close()
+  return {**paths, "version": table.version, "documents": documents}
@@ -1,68 +1,282 @@
 import json
 import time
+import asyncio
 import logging
-from transformers import GPT2Tokenizer
+import threading
+from contextlib import nullcontext
+from functools import lru_cache
 
-from src.config import get_documents_table, get_force_rebuild, ollama_query, QUERY_MODEL, PROMPT_OPTIONS, CONTEXT_WINDOW
-from src.classes import MetaInfo, create_GovDoc, create_MetaInfo, get_id_from_filename
+from src.config import get_documents_table, get_force_rebuild, get_single_call, get_use_llm_cache, get_context_mode, get_context_tokens, get_ollama_query, get_ollama_query_async, QUERY_MODEL, PROMPT_OPTIONS, CONTEXT_WINDOW, LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES
+from src.classes import GovDoc, MetaInfo, MetaInfoCategory, create_GovDoc, create_MetaInfo, get_id_from_filename
+from src import metrics
+from src.doneset import DoneSet
+from src.cache import ResponseCache, prompt_key
+from src.context import stored_chunks, select_chunks, join_chunks
 
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-documents_table = get_documents_table()
+response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_BYTES)
+# Documents count as processed once a title has been extracted
+titled_docs = DoneSet(get_documents_table, where="title IS NOT NULL AND title != ''")
+# Running totals for the single-call mode
+single_call_totals = {"documents": 0, "fallbacks": 0, "saved_tokens": 0, "saved_seconds": 0.0}
+# Time spent truncating prompts and documents to the context window
+tokenizer_totals = {"calls": 0, "seconds": 0.0, "truncated": 0}
+# Documents sent as representative chunks, and the ones without stored chunks that were truncated instead
+context_totals = {"representative": 0, "fallbacks": 0}
+_tokenizer_lock = threading.Lock()
 
 
-def run_prompt(prompt, label="generic", format: dict[str, any] = None):
+RESPONSE_TOKENS = 200  # Consider response tokens to avoid exceeding the context window
+MAX_CHARS_PER_TOKEN = 8  # Conservative upper bound, GPT-2 averages about 4 characters per token on English text
+
+
+def get_tokenizer():
+  # Threads of the async path can ask for it at the same time, only the first one loads it
+  with _tokenizer_lock:
+    return _load_tokenizer()
+
+
+@lru_cache(maxsize=None)
+def _load_tokenizer():
+  # transformers takes a few seconds to import, only load it when a prompt is truncated
+  from transformers import GPT2TokenizerFast
+  return GPT2TokenizerFast.from_pretrained("gpt2")
+
+
+def truncate_text(text, max_tokens):
+  """
+    Cuts the text after `max_tokens` tokens. Only a prefix of at most MAX_CHARS_PER_TOKEN
+    characters per token is tokenised, and the text is cut at the character offset of the
+    last token that fits instead of decoding the tokens.
+    """
   start_time = time.time()
+  trimmed = text[:max_tokens * MAX_CHARS_PER_TOKEN]
+  encoding = get_tokenizer()(trimmed,
+                             truncation=True,
+                             max_length=max_tokens,
+                             add_special_tokens=False,
+                             return_offsets_mapping=True)
+  offsets = encoding["offset_mapping"]
+  if len(offsets) >= max_tokens:
+    trimmed = trimmed[:offsets[-1][1]]
+  elapsed = time.time() - start_time
+  tokenizer_totals["calls"] += 1
+  tokenizer_totals["seconds"] += elapsed
+  metrics.observe("tokenize", elapsed)
+  if len(trimmed) < len(text):
+    tokenizer_totals["truncated"] += 1
+  return trimmed
+
+
+def truncate_prompt(prompt):
   # Ensure the prompt fits within the context window
-  response_tokens = 200  # Consider response tokens to avoid exceeding the context window
-  max_prompt_tokens = CONTEXT_WINDOW - response_tokens
-  # Tokenize the prompt with truncation to fit within the token limit
-  tokens = tokenizer.encode(prompt, truncation=True, max_length=max_prompt_tokens)
-  prompt = tokenizer.decode(tokens, clean_up_tokenization_spaces=True)
+  return truncate_text(prompt, CONTEXT_WINDOW - RESPONSE_TOKENS)
+
+
+def record_stats(stats: dict, response, start_time, label):
+  metrics.increment("tokens", response.get("prompt_eval_count") or 0, kind="prompt", prompt=label)
+  metrics.increment("tokens", response.get("eval_count") or 0, kind="response", prompt=label)
+  # Keep the prompt size and timings reported by Ollama for the caller
+  if stats is None:
+    return
+  stats["seconds"] = time.time() - start_time
+  stats["prompt_tokens"] = response.get("prompt_eval_count") or 0
+  stats["prompt_eval_seconds"] = (response.get("prompt_eval_duration") or 0) / 1e9
+
+
+def cached_answer(prompt, format, stats: dict = None):
+  """
+    Looks up the answer to an identical earlier request.
+    :return: The cache key (None when the cache is bypassed) and the cached answer, if any.
+    """
+  if not get_use_llm_cache():
+    return None, None
+  key = prompt_key(QUERY_MODEL, PROMPT_OPTIONS, format or "json", prompt)
+  # Answers stored before they were validated may not parse, those are asked again
+  answer = response_cache.get(key, validate=lambda answer: valid_answer(answer, format))
+  if answer is not None and stats is not None:
+    stats.update(cached=True, seconds=0.0, prompt_tokens=0, prompt_eval_seconds=0.0)
+  return key, answer
+
+
+def valid_answer(answer, format) -> bool:
+  # Only answers that parse and match their format are cached, a bad answer is asked again on the next run
+  try:
+    fields = clean_metadata_json(json.loads(answer))
+    if format is COMBINED_FORMAT:
+      MetaInfoCategory.model_validate(fields)
+      return "category" in fields
+    if format is METADATA_FORMAT:
+      MetaInfo.model_validate(fields)
+    return True
+  except Exception:
+    return False
+
+
+def run_prompt(prompt, label="generic", format: dict[str, any] = None, stats: dict = None, truncate=True):
+  start_time = time.time()
+  if truncate:
+    prompt = truncate_prompt(prompt)
+  key, answer = cached_answer(prompt, format, stats)
+  if answer is not None:
+    logging.info(f"-> {label} result from cache")
+    metrics.increment("llm_cache_hits", prompt=label)
+    return answer
   try:
-    response = ollama_query.generate(model=QUERY_MODEL,
-                                     prompt=prompt,
-                                     stream=False,
-                                     options=PROMPT_OPTIONS,
-                                     format="json")  # json.dumps(format)
+    with metrics.timer("llm_request", prompt=label):
+      response = get_ollama_query().generate(model=QUERY_MODEL,
+                                             prompt=prompt,
+                                             stream=False,
+                                             options=PROMPT_OPTIONS,
+                                             format=format or "json")
     answer = response['response'].strip()
+    record_stats(stats, response, start_time, label)
+    if key is not None and valid_answer(answer, format):
+      response_cache.put(key, answer)
     end_time = time.time()  # End timer
     logging.debug(answer)
     logging.info(f"-> {label} result in {end_time - start_time:.1f}s")
     return answer
   except Exception as e:
     logging.error(f"Error running prompt: {e}")
+    metrics.increment("errors", stage="llm_request")
     return None
 
 
-def get_metadata(text):
+async def run_prompt_async(prompt,
+                           label="generic",
+                           format: dict[str, any] = None,
+                           limiter=None,
+                           stats: dict = None,
+                           truncate=True):
+  """
+    Same as `run_prompt` but uses the async client. `limiter` (e.g. an asyncio.Semaphore)
+    bounds the number of requests in flight. Tokenizing and the cache run in a thread.
+    """
+  start_time = time.time()
+  if truncate:
+    prompt = await asyncio.to_thread(truncate_prompt, prompt)
+  key, answer = await asyncio.to_thread(cached_answer, prompt, format, stats)
+  if answer is not None:
+    logging.info(f"-> {label} result from cache")
+    metrics.increment("llm_cache_hits", prompt=label)
+    return answer
+  try:
+    async with limiter or nullcontext():
+      with metrics.timer("llm_request", prompt=label):
+        response = await get_ollama_query_async().generate(model=QUERY_MODEL,
+                                                           prompt=prompt,
+                                                           stream=False,
+                                                           options=PROMPT_OPTIONS,
+                                                           format=format or "json")
+    answer = response['response'].strip()
+    record_stats(stats, response, start_time, label)
+    if key is not None and valid_answer(answer, format):
+      await asyncio.to_thread(response_cache.put, key, answer)
+    end_time = time.time()  # End timer
+    logging.debug(answer)
+    logging.info(f"-> {label} result in {end_time - start_time:.1f}s")
+    return answer
+  except Exception as e:
+    logging.error(f"Error running prompt: {e}")
+    metrics.increment("errors", stage="llm_request")
+    return None
+
+
+METADATA_FORMAT = MetaInfo.model_json_schema()
+CATEGORY_FORMAT = {
+    "type": "object",
+    "properties": {
+        "keywords": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "category": {
+            "type": "string"
+        }
+    }
+}
+
+
+METADATA_INSTRUCTIONS = "Please extract the following information from a document: 1.) title, 2.) summary, 3.) level_of_government, 4.) responsible_province, 5.) responsible_city, 6.) authors, 7.) editors 8.) publisher, 9.) publish_date, 10.) publisher_location, 11.) copyright_year, 12.) ISSN, 13.) ISBN, 14.) languages. If the exact title of the document is obvious in the text, then use that, alternatively the title should be your most relevant suggestion for the document and also be less than 8 words. The summary should be concise but still representative of the content of the text and also less than 50 words. Level of government is one of three options: 'federal', 'provincial', or 'municipal'. If the level of government is federal, the responsible province should be Ontario. Federal documents are Ottawa's responsibility. And provincial documents are the responsibility of the capital city of the responsible_province. Municipal documents are the responsibility of that city. The authors and editors lists should only contain strings of the respective names of authors and editors. The author can also be a person who signed an introductory letter at the beginning of the document. The publish date should be converted to yyyy-mm-dd format. If found, write the ISBN number in this format: X-XXXX-XXXX-X. Detected languages should be one or both of these options: 'en', 'fr'. Only include a language if a significant portion of the text is in that language."
 
-  format = MetaInfo.model_json_schema()
-  metadata_prompt = f"Please extract the following information from a document: 1.) title, 2.) summary, 3.) level_of_government, 4.) responsible_province, 5.) responsible_city, 6.) authors, 7.) editors 8.) publisher, 9.) publish_date, 10.) publisher_location, 11.) copyright_year, 12.) ISSN, 13.) ISBN, 14.) languages. If the exact title of the document is obvious in the text, then use that, alternatively the title should be your most relevant suggestion for the document and also be less than 8 words. The summary should be concise but still representative of the content of the text and also less than 50 words. Level of government is one of three options: 'federal', 'provincial', or 'municipal'. If the level of government is federal, the responsible province should be Ontario. Federal documents are Ottawa's responsibility. And provincial documents are the responsibility of the capital city of the responsible_province. Municipal documents are the responsibility of that city. The authors and editors lists should only contain strings of the respective names of authors and editors. The author can also be a person who signed an introductory letter at the beginning of the document. The publish date should be converted to yyyy-mm-dd format. If found, write the ISBN number in this format: X-XXXX-XXXX-X. Detected languages should be one or both of these options: 'en', 'fr'. Only include a language if a significant portion of the text is in that language. You should output the information as JSON. Here follows the available document text:\n\n{text}"
-  metadata = run_prompt(metadata_prompt, "metadata", format)
+
+def metadata_prompt(text):
+  return f"{METADATA_INSTRUCTIONS} You should output the information as JSON. Here follows the available document text:\n\n{text}"
+
+
+def get_metadata(text):
+  metadata = run_prompt(metadata_prompt(truncate_document(text)), "metadata", METADATA_FORMAT, truncate=False)
   return metadata
 
 
+CATEGORY_INSTRUCTIONS = "Extract the 5 best keywords from a document to aid in indexing and searchability.\nKeywords are words or short phrases that are less than 3 words that help to categorize and index the document for easier retrieval and searchability in databases and search engines. They enable researchers and readers to quickly identify the relevant subject matter and scope of the document.\nEach keyword entry should not have more than two words.\nDon't include keywords represented by the document title.\n\nCategorize the document into one of the following categories:\n* Financial and Operational Reports\n* Research and Analysis\n* News and Media\n* Policies and Directives\n* Strategic and Operational Plans\n* Promotional and Educational Material"
+
+
+def category_prompt(text):
+  return f"Create metadata fields `keywords` and `category` for a document.\n\n{CATEGORY_INSTRUCTIONS}\n\nOutput the results in JSON format.\nDocument text follows:\n\n{text}"
+
+
 def get_catergory_keywords(text):
-  format = {
-      "type": "object",
-      "properties": {
-          "keywords": {
-              "type": "array",
-              "items": {
-                  "type": "string"
-              }
-          },
-          "category": {
-              "type": "string"
-          }
-      }
-  }
-  category_prompt = f"Categorize a document into one of the following categories (specific definitions provided here to aid picking the best category):\n* Financial and Operational Reports (Reports from ministries or agencies detailing their activities and finances. Includes annual reports, budgets, expenditure estimates, public accounts, statements, and fiscal summaries)\n* Research and Analysis (In-depth examinations of specific topics, including research reports, discussion papers, and documents that summarize public feedback and consultations)\n* News and Media (Documents designed for public communication, including bulletins, notices, news releases, backgrounders, newsletters, and speeches by government officials)\n* Policies and Directives (Documents that outline rules, regulations, and best practices, including policies, directives, manuals, guidelines, standards, and codes)\n* Strategic and Operational Plans (Documents that outline goals, objectives, and plans for the future, including strategic plans, mandate letters, and ministerial objectives)\n* Promotional and Educational Material (Documents designed to educate or promote government initiatives or public awareness, including brochures, pamphlets, flyers, educational content, and informational guides)\n\nOutput the results in JSON format.\nDocument text follows:\n\n{text}"
-  prompt = f"Create metadata fields `keywords` and `category` for a document.\n\nExtract the 5 best keywords from a document to aid in indexing and searchability.\nKeywords are words or short phrases that are less than 3 words that help to categorize and index the document for easier retrieval and searchability in databases and search engines. They enable researchers and readers to quickly identify the relevant subject matter and scope of the document.\nEach keyword entry should not have more than two words.\nDon't include keywords represented by the document title.\n\nCategorize the document into one of the following categories:\n* Financial and Operational Reports\n* Research and Analysis\n* News and Media\n* Policies and Directives\n* Strategic and Operational Plans\n* Promotional and Educational Material\n\nOutput the results in JSON format.\nDocument text follows:\n\n{text}"
-  category = run_prompt(prompt, "category", format)
+  category = run_prompt(category_prompt(truncate_document(text)), "category", CATEGORY_FORMAT, truncate=False)
   return category
 
 
+COMBINED_FORMAT = MetaInfoCategory.model_json_schema()
+
+
+def combined_prompt(text):
+  return f"{METADATA_INSTRUCTIONS}\n\nAlso create the metadata fields `keywords` and `category` for the document.\n{CATEGORY_INSTRUCTIONS}\n\nOutput all of the fields in a single JSON object.\nDocument text follows:\n\n{text}"
+
+
+@lru_cache(maxsize=None)
+def template_tokens(prompt_builder) -> int:
+  # Number of tokens a prompt uses without any document text
+  return len(get_tokenizer().encode(prompt_builder("")))
+
+
+@lru_cache(maxsize=8)
+def truncate_document(text: str) -> str:
+  """
+    Truncates the document text once so that it fits in any of the metadata prompts;
+    the metadata and category prompts of a document share the result.
+    """
+  max_tokens = CONTEXT_WINDOW - RESPONSE_TOKENS - max(
+      template_tokens(metadata_prompt), template_tokens(category_prompt), template_tokens(combined_prompt))
+  return truncate_text(text, max_tokens)
+
+
+def representative_context(doc_id) -> str | None:
+  """
+    Builds the document text for the metadata prompts from the chunks stored by `embed_document`:
+    the first chunks plus the chunks closest to the document's centroid, within the context token budget.
+    :return: The text, or None if the document has no stored chunks.
+    """
+  with metrics.timer("context"):
+    contents, vectors = stored_chunks(doc_id)
+    if not contents:
+      return None
+    token_counts = [len(ids) for ids in get_tokenizer()(contents, add_special_tokens=False)["input_ids"]]
+    selected = select_chunks(vectors, token_counts, get_context_tokens())
+    if not selected:
+      # Even the first chunk is over the budget
+      return truncate_text(contents[0], get_context_tokens())
+    return join_chunks(contents, selected)
+
+
+def document_context(text: str, doc_id) -> str:
+  # The document text to send with the metadata prompts, depending on the context mode
+  if get_context_mode() == "representative":
+    context = representative_context(doc_id)
+    if context is not None:
+      context_totals["representative"] += 1
+      return context
+    logging.warning(f"No stored chunks for {doc_id}, truncating the document text instead")
+    context_totals["fallbacks"] += 1
+  return text
+
+
 def clean_metadata_json(metadata):
   # Handle None/Null values
   for key, value in metadata.items():
@@ -84,33 +298,156 @@ def clean_metadata_json(metadata):
   return metadata
 
 
-def extract_metadata(text: str, filename: str):
-  doc_id = get_id_from_filename(filename)
+def skip_metadata(doc_id) -> bool:
   # Check if the file exists in the database
-  existing_record = documents_table.to_pandas().query(f"doc_id == '{doc_id}'")
-  if not existing_record.empty:
-    existing_title = existing_record["title"].values[0]
-    if existing_title and not get_force_rebuild():
-      logging.info(f"Skipping metadata generation for {doc_id} (already exists)")
-      return
+  if doc_id in titled_docs and not get_force_rebuild():
+    logging.info(f"Skipping metadata generation for {doc_id} (already exists)")
+    return True
+  return False
+
 
-  metadata_json_string = get_metadata(text)
+def create_metadata(metadata_json_string, doc_id, filename) -> GovDoc | None:
+  if metadata_json_string is None:
+    logging.error(f"No metadata answer for {doc_id}")
+    return None
   metadata = json.loads(metadata_json_string)
   metadata = clean_metadata_json(metadata)  # Handle None/Null values
   try:
-    govdoc = create_GovDoc(create_MetaInfo(metadata), doc_id, filename)
+    return create_GovDoc(create_MetaInfo(metadata), doc_id, filename)
   except Exception as e:
     logging.error(f"Error mapping metadata: {e}")
     print(metadata)
-    return
-  cat_json_string = get_catergory_keywords(text)
+    return None
+
+
+def add_category_keywords(govdoc: GovDoc, cat_json_string) -> bool:
+  if cat_json_string is None:
+    # Not saved, so that the document is retried on the next run
+    logging.error(f"No category answer for {govdoc.doc_id}")
+    return False
   cat = json.loads(cat_json_string)
   cat = clean_metadata_json(cat)  # Handle None/Null values
   govdoc.keywords = cat.get("keywords")
   govdoc.category = cat.get("category")
+  return True
+
+
+def save_metadata(govdoc: GovDoc):
   try:
-    documents_table.merge_insert("filename").when_matched_update_all() \
-        .when_not_matched_insert_all() \
-        .execute([govdoc.model_dump()])
+    with metrics.timer("db_write", table="documents"):
+      get_documents_table().merge_insert("filename").when_matched_update_all() \
+          .when_not_matched_insert_all() \
+          .execute([govdoc.model_dump()])
+    if govdoc.title:
+      titled_docs.add(govdoc.doc_id)
+    else:
+      titled_docs.discard(govdoc.doc_id)
   except Exception as e:
     logging.error(f"Error merging metadata: {e}")
+    metrics.increment("errors", stage="db_write")
+
+
+def parse_combined_metadata(answer) -> dict | None:
+  # Validate the single-call answer against the combined schema
+  try:
+    fields = clean_metadata_json(json.loads(answer))
+    MetaInfoCategory.model_validate(fields)
+    if "category" not in fields:
+      raise ValueError("category is missing")
+    return fields
+  except Exception as e:
+    logging.warning(f"Single-call metadata failed validation ({e}), falling back to two calls")
+    single_call_totals["fallbacks"] += 1
+    return None
+
+
+def create_combined_metadata(fields: dict, doc_id, filename) -> GovDoc:
+  govdoc = create_GovDoc(create_MetaInfo(fields), doc_id, filename)
+  govdoc.keywords = fields.get("keywords")
+  govdoc.category = fields.get("category")
+  return govdoc
+
+
+def report_single_call(doc_id, stats: dict):
+  """
+    Estimates what the single call saved compared to the metadata + category calls,
+    which both prefill the same document text.
+    """
+  if stats.get("cached"):
+    logging.info(f"-> single call for {doc_id} answered from cache")
+    return
+  prompt_tokens = stats.get("prompt_tokens", 0)
+  document_tokens = max(0, prompt_tokens - template_tokens(combined_prompt))
+  saved_tokens = document_tokens + template_tokens(metadata_prompt) + template_tokens(
+      category_prompt) - template_tokens(combined_prompt)
+  prefill_rate = stats.get("prompt_eval_seconds", 0.0) / prompt_tokens if prompt_tokens else 0.0
+  saved_seconds = saved_tokens * prefill_rate
+  single_call_totals["documents"] += 1
+  single_call_totals["saved_tokens"] += saved_tokens
+  single_call_totals["saved_seconds"] += saved_seconds
+  logging.info(f"-> single call for {doc_id}: {prompt_tokens} prompt tokens in {stats.get('seconds', 0.0):.1f}s, "
+               f"saved ~{saved_tokens} prompt tokens and ~{saved_seconds:.1f}s of prefill")
+
+
+def log_tokenizer_summary():
+  if tokenizer_totals["calls"]:
+    logging.info(f"Tokenizer: {tokenizer_totals['calls']} truncations ({tokenizer_totals['truncated']} cut) "
+                 f"in {tokenizer_totals['seconds']:.2f}s")
+  if context_totals["representative"] or context_totals["fallbacks"]:
+    logging.info(f"Representative chunks sent for {context_totals['representative']} documents, "
+                 f"{context_totals['fallbacks']} documents without stored chunks were truncated")
+
+
+def log_single_call_summary():
+  if single_call_totals["documents"] or single_call_totals["fallbacks"]:
+    logging.info(f"Single-call metadata: {single_call_totals['documents']} documents, "
+                 f"{single_call_totals['fallbacks']} fallbacks to two calls, "
+                 f"saved ~{single_call_totals['saved_tokens']} prompt tokens and "
+                 f"~{single_call_totals['saved_seconds']:.1f}s of prefill")
+
+
+def extract_metadata(text: str, filename: str):
+  doc_id = get_id_from_filename(filename)
+  if skip_metadata(doc_id):
+    return
+  text = document_context(text, doc_id)
+  if get_single_call():
+    stats = {}
+    fields = parse_combined_metadata(
+        run_prompt(combined_prompt(truncate_document(text)), "combined", COMBINED_FORMAT, stats, truncate=False))
+    if fields is not None:
+      report_single_call(doc_id, stats)
+      save_metadata(create_combined_metadata(fields, doc_id, filename))
+      return
+  govdoc = create_metadata(get_metadata(text), doc_id, filename)
+  if govdoc is None:
+    return
+  if add_category_keywords(govdoc, get_catergory_keywords(text)):
+    save_metadata(govdoc)
+
+
+def prepare_context(text: str, doc_id) -> str:
+  return truncate_document(document_context(text, doc_id))
+
+
+async def extract_metadata_async(text: str, filename: str, limiter=None):
+  # The table reads and writes and the tokenizer run in a thread, only the requests wait on the event loop
+  doc_id = get_id_from_filename(filename)
+  if await asyncio.to_thread(skip_metadata, doc_id):
+    return
+  text = await asyncio.to_thread(prepare_context, text, doc_id)
+  if get_single_call():
+    stats = {}
+    answer = await run_prompt_async(combined_prompt(text), "combined", COMBINED_FORMAT, limiter, stats, truncate=False)
+    fields = parse_combined_metadata(answer)
+    if fields is not None:
+      report_single_call(doc_id, stats)
+      await asyncio.to_thread(save_metadata, create_combined_metadata(fields, doc_id, filename))
+      return
+  metadata = await run_prompt_async(metadata_prompt(text), "metadata", METADATA_FORMAT, limiter, truncate=False)
+  govdoc = create_metadata(metadata, doc_id, filename)
+  if govdoc is None:
+    return
+  category = await run_prompt_async(category_prompt(text), "category", CATEGORY_FORMAT, limiter, truncate=False)
+  if add_category_keywords(govdoc, category):
+    await asyncio.to_thread(save_metadata, govdoc)
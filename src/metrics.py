@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+PREFIX = "govdocs"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_histograms = {}  # (stage, labels) -> [bucket counts..., count, sum]
+_spans = []  # Chrome trace events, only collected while tracing
+TRACE = False
+
+
+def _key(name, labels: dict):
+  return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def increment(name, value=1, **labels):
+  # Counters, e.g. tokens, retries and errors
+  key = _key(name, labels)
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(stage, seconds, **labels):
+  key = _key(stage, labels)
+  with _lock:
+    histogram = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+    for i, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        histogram[i] += 1
+    histogram[-2] += 1
+    histogram[-1] += seconds
+
+
+def add_span(name, start, seconds, **attributes):
+  if not TRACE:
+    return
+  event = {
+      "name": name,
+      "ph": "X",
+      "ts": int(start * 1e6),
+      "dur": int(seconds * 1e6),
+      "pid": os.getpid(),
+      "tid": threading.get_ident(),
+      "args": attributes,
+  }
+  with _lock:
+    _spans.append(event)
+
+
+@contextmanager
+def timer(stage, **labels):
+  """
+    Times the block into the stage histogram, and into a trace span when tracing is on.
+    Labels become Prometheus labels, so keep them low-cardinality and use `span` for document ids.
+    """
+  start = time.time()
+  try:
+    yield
+  finally:
+    seconds = time.time() - start
+    observe(stage, seconds, **labels)
+    add_span(stage, start, seconds, **labels)
+
+
+@contextmanager
+def span(name, **attributes):
+  # A trace span only, e.g. one per document
+  start = time.time()
+  try:
+    yield
+  finally:
+    add_span(name, start, time.time() - start, **attributes)
+
+
+def collect() -> dict:
+  """
+    Takes the metrics recorded so far and resets them, e.g. in an OCR worker process
+    before sending them to the parent process.
+    :return: A snapshot that can be passed to `merge`.
+    """
+  global _counters, _histograms, _spans
+  with _lock:
+    snapshot = {"counters": _counters, "histograms": _histograms, "spans": _spans}
+    _counters, _histograms, _spans = {}, {}, []
+  return snapshot
+
+
+def reset():
+  # Worker processes start with a copy of the parent's metrics, which must not be sent back
+  collect()
+
+
+def merge(snapshot: dict):
+  with _lock:
+    for key, value in snapshot["counters"].items():
+      _counters[key] = _counters.get(key, 0) + value
+    for key, values in snapshot["histograms"].items():
+      histogram = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+      for i, value in enumerate(values):
+        histogram[i] += value
+    _spans.extend(snapshot["spans"])
+
+
+def _labels_text(labels, extra=()):
+  pairs = list(labels) + list(extra)
+  if not pairs:
+    return ""
+  return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def prometheus_text() -> str:
+  # Prometheus text exposition format, for the node exporter textfile collector
+  lines = []
+  with _lock:
+    counters = sorted(_counters.items())
+    histograms = sorted(_histograms.items())
+  for name in sorted({name for (name, _), _ in counters}):
+    lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+    for (counter, labels), value in counters:
+      if counter == name:
+        lines.append(f"{PREFIX}_{name}_total{_labels_text(labels)} {value}")
+  if histograms:
+    lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+  for (stage, labels), values in histograms:
+    labels = (("stage", stage),) + labels
+    for bound, count in zip(BUCKETS, values):
+      lines.append(f"{PREFIX}_stage_seconds_bucket{_labels_text(labels, [('le', bound)])} {count}")
+    lines.append(f"{PREFIX}_stage_seconds_bucket{_labels_text(labels, [('le', '+Inf')])} {values[-2]}")
+    lines.append(f"{PREFIX}_stage_seconds_sum{_labels_text(labels)} {values[-1]:.6f}")
+    lines.append(f"{PREFIX}_stage_seconds_count{_labels_text(labels)} {values[-2]}")
+  return "\n".join(lines) + "\n"
+
+
+def percentile(values, q) -> float:
+  # Upper bound of the bucket that holds the q-th percentile
+  count = values[-2]
+  if not count:
+    return 0.0
+  for bound, bucket in zip(BUCKETS, values):
+    if bucket >= q * count:
+      return bound
+  return float("inf")
+
+
+def summary() -> dict:
+  with _lock:
+    counters = dict(_counters)
+    histograms = dict(_histograms)
+  return {
+      "counters": [{"name": name, "labels": dict(labels), "value": value}
+                   for (name, labels), value in sorted(counters.items())],
+      "stages": [{
+          "stage": stage,
+          "labels": dict(labels),
+          "count": values[-2],
+          "seconds": round(values[-1], 6),
+          "mean": round(values[-1] / values[-2], 6) if values[-2] else 0.0,
+          "p50_le": percentile(values, 0.5),
+          "p95_le": percentile(values, 0.95),
+      } for (stage, labels), values in sorted(histograms.items())],
+  }
+
+
+def log_summary(log=logging.info):
+  stages = summary()["stages"]
+  if not stages:
+    return
+  log(f"{'stage':>24} {'count':>7} {'total s':>9} {'mean ms':>9} {'p95 ms <=':>10}")
+  for stage in sorted(stages, key=lambda stage: -stage["seconds"]):
+    name = stage["stage"] + "".join(f" {value}" for value in stage["labels"].values())
+    log(f"{name:>24} {stage['count']:7d} {stage['seconds']:9.1f} {stage['mean'] * 1000:9.1f} "
+        f"{stage['p95_le'] * 1000:10.0f}")
+
+
+def write_outputs(prometheus_path=None, json_path=None, trace_path=None):
+  """
+    Writes the metrics of the run. The Prometheus file is written to a temporary file
+    and renamed, as the textfile collector expects.
+    """
+  if prometheus_path:
+    with open(prometheus_path + ".tmp", "w", encoding="utf-8") as f:
+      f.write(prometheus_text())
+    os.replace(prometheus_path + ".tmp", prometheus_path)
+  if json_path:
+    with open(json_path, "w", encoding="utf-8") as f:
+      json.dump(summary(), f, indent=2)
+  if trace_path:
+    with _lock:
+      events = list(_spans)
+    # Chrome trace format, opens in chrome://tracing or https://ui.perfetto.dev
+    with open(trace_path, "w", encoding="utf-8") as f:
+      json.dump({"traceEvents": events}, f)
+
+
+def set_tracing(enabled: bool):
+  global TRACE
+  TRACE = enabled
+
+
+def finish(args, log=logging.info):
+  # Log the summary and write the files requested with the options from `add_arguments`
+  log_summary(log)
+  write_outputs(args.prometheus, args.metrics_json, args.trace)
+
+
+def add_arguments(parser):
+  # Command line options shared by the scripts
+  parser.add_argument("--prometheus", help="Write the run's metrics to this Prometheus textfile (.prom)")
+  parser.add_argument("--metrics-json", help="Write a JSON summary of the run's metrics to this file")
+  parser.add_argument("--trace", help="Record trace spans and write them to this file (Chrome trace format)")
@@ -0,0 +1,226 @@
+import os
+import math
+import time
+import logging
+import pyarrow as pa
+
+from src.config import get_embeddings_table, get_documents_table, EMBEDDING_DIM, DEDUP_PATH
+from src.doneset import sql_quote, scan_column
+from src.embed import get_embedding
+
+INDEX_TYPES = ("IVF_PQ", "IVF_SQ", "IVF_HNSW_SQ", "IVF_HNSW_PQ")
+METRIC = "cosine"
+RESULT_COLUMNS = ["doc_id", "chunk_id", "content"]
+SEARCH_MODES = ("vector", "text", "hybrid")
+RRF_K = 60  # Rank constant of reciprocal rank fusion, damps the weight of the top ranks
+HYBRID_CANDIDATES = 50  # Minimum number of chunks taken from each ranking before fusing them
+
+
+def check_vector_column():
+  field = get_embeddings_table().schema.field("embedding")
+  if not pa.types.is_fixed_size_list(field.type):
+    raise ValueError(f"The embedding column is stored as {field.type}; vector indexes need a fixed-size vector column. "
+                     "Run python migrate_embeddings.py to convert it.")
+
+
+def default_sub_vectors(dimensions: int) -> int:
+  # PQ needs the dimension to be divisible by the number of sub-vectors; aim for 16 dimensions each
+  for sub_vectors in (dimensions // 16, dimensions // 8, dimensions // 4, 1):
+    if sub_vectors and dimensions % sub_vectors == 0:
+      return sub_vectors
+  return 1
+
+
+def index_config(index_type, num_partitions, num_sub_vectors):
+  # lancedb is only imported when an index is built, see `get_vector_db`
+  from lancedb.index import IvfPq, IvfSq, HnswSq, HnswPq
+  if index_type == "IVF_PQ":
+    return IvfPq(distance_type=METRIC, num_partitions=num_partitions, num_sub_vectors=num_sub_vectors)
+  if index_type == "IVF_HNSW_PQ":
+    return HnswPq(distance_type=METRIC, num_partitions=num_partitions, num_sub_vectors=num_sub_vectors)
+  if index_type == "IVF_HNSW_SQ":
+    return HnswSq(distance_type=METRIC, num_partitions=num_partitions)
+  return IvfSq(distance_type=METRIC, num_partitions=num_partitions)
+
+
+def build_index(index_type="IVF_PQ", num_partitions=None, num_sub_vectors=None):
+  """
+    Builds (or replaces) the ANN index on the embedding column.
+    By default there are about sqrt(rows) partitions and 16 dimensions per PQ sub-vector.
+    """
+  if index_type not in INDEX_TYPES:
+    raise ValueError(f"Unknown index type {index_type}, use one of {', '.join(INDEX_TYPES)}")
+  check_vector_column()
+  rows = get_embeddings_table().count_rows()
+  if rows == 0:
+    raise ValueError("The embeddings table is empty")
+  num_partitions = num_partitions or max(1, int(math.sqrt(rows)))
+  num_sub_vectors = num_sub_vectors or default_sub_vectors(EMBEDDING_DIM)
+  logging.info(f"Building {index_type} index over {rows} vectors ({num_partitions} partitions"
+               f"{f', {num_sub_vectors} sub-vectors' if index_type.endswith('PQ') else ''}) ...")
+  start_time = time.time()
+  get_embeddings_table().create_index("embedding",
+                                      config=index_config(index_type, num_partitions, num_sub_vectors),
+                                      replace=True)
+  logging.info(f"Index built in {time.time() - start_time:.1f}s")
+
+
+def refresh_index():
+  # Adds rows written since the index was built to the existing indexes and compacts small fragments
+  start_time = time.time()
+  get_embeddings_table().optimize()
+  logging.info(f"Index refreshed in {time.time() - start_time:.1f}s")
+
+
+def build_fts_index():
+  """
+    Builds (or replaces) the BM25 full-text index on the chunk content, for exact lookups of
+    ISBNs, call numbers and program names. Words are not stemmed and stop words are kept,
+    as the corpus mixes English and French; positions are stored for phrase queries.
+    """
+  rows = get_embeddings_table().count_rows()
+  logging.info(f"Building full-text index over {rows} chunks ...")
+  start_time = time.time()
+  get_embeddings_table().create_fts_index("content",
+                                          replace=True,
+                                          with_position=True,
+                                          stem=False,
+                                          remove_stop_words=False)
+  logging.info(f"Full-text index built in {time.time() - start_time:.1f}s")
+
+
+def filter_doc_ids(filters: str) -> list[str]:
+  # doc_ids of the documents matching a filter on the documents table, e.g. "level_of_government = 'federal'"
+  return scan_column(get_documents_table(), "doc_id", filters)
+
+
+def filter_clause(filters: str):
+  """
+    Turns a filter on the documents table into a filter on the chunks.
+    :return: The clause, or None when no document matches.
+    """
+  doc_ids = filter_doc_ids(filters)
+  if not doc_ids:
+    return None
+  return f"doc_id IN ({', '.join(sql_quote(doc_id) for doc_id in doc_ids)})"
+
+
+def empty_results(columns) -> pa.Table:
+  return pa.table({column: [] for column in columns})
+
+
+def search_vector(vector, k=10, filters: str = None, nprobes=20, refine_factor=None, exact=False, where=None) -> pa.Table:
+  """
+    Finds the `k` chunks closest to `vector`, optionally restricted to documents matching `filters`
+    (or to the chunks matching `where`, a clause from `filter_clause`).
+    `exact` bypasses the ANN index (brute force).
+    """
+  query = get_embeddings_table().search(vector, vector_column_name="embedding").distance_type(METRIC).limit(k)
+  if exact:
+    query = query.bypass_vector_index()
+  else:
+    query = query.nprobes(nprobes)
+    if refine_factor:
+      query = query.refine_factor(refine_factor)
+  if filters:
+    where = filter_clause(filters)
+    if where is None:
+      return empty_results(RESULT_COLUMNS + ["_distance"])
+  if where:
+    query = query.where(where, prefilter=True)
+  return query.select(RESULT_COLUMNS + ["_distance"]).to_arrow()
+
+
+def search_text(query_text: str, k=10, filters: str = None, where=None) -> pa.Table:
+  """
+    Finds the `k` chunks with the best BM25 score for `query_text`; a query in double quotes matches the phrase.
+    Chunks added since the full-text index was built are searched too, without the index.
+    """
+  query = get_embeddings_table().search(query_text, query_type="fts").limit(k)
+  if filters:
+    where = filter_clause(filters)
+    if where is None:
+      return empty_results(RESULT_COLUMNS + ["_score"])
+  if where:
+    query = query.where(where, prefilter=True)
+  return query.select(RESULT_COLUMNS + ["_score"]).to_arrow()
+
+
+def fuse_rankings(rankings: list[pa.Table], k: int) -> pa.Table:
+  """
+    Reciprocal rank fusion: every chunk scores the sum of 1 / (RRF_K + rank) over the rankings it appears in,
+    so that chunks found by both the vector and the text search come first.
+    :return: The `k` best chunks with the columns of every ranking and their `_relevance`.
+    """
+  chunks = {}
+  for ranking in rankings:
+    for rank, row in enumerate(ranking.to_pylist(), 1):
+      chunk = chunks.setdefault((row["doc_id"], row["chunk_id"]), {"_relevance": 0.0})
+      chunk.update(row)
+      chunk["_relevance"] += 1.0 / (RRF_K + rank)
+  fused = sorted(chunks.values(), key=lambda chunk: -chunk["_relevance"])[:k]
+  columns = RESULT_COLUMNS + ["_distance", "_score", "_relevance"]
+  return pa.table({column: [chunk.get(column) for chunk in fused] for column in columns})
+
+
+def search_hybrid(query_text: str, vector, k=10, filters: str = None, nprobes=20, refine_factor=None) -> pa.Table:
+  """
+    Runs the vector and the full-text search with the same filters and fuses both rankings.
+    `_distance` or `_score` is null for chunks that only one of the searches found.
+    """
+  where = None
+  if filters:
+    where = filter_clause(filters)
+    if where is None:
+      return empty_results(RESULT_COLUMNS + ["_distance", "_score", "_relevance"])
+  candidates = max(k, HYBRID_CANDIDATES)
+  by_vector = search_vector(vector, candidates, nprobes=nprobes, refine_factor=refine_factor, where=where)
+  by_text = search_text(query_text, candidates, where=where)
+  return fuse_rankings([by_vector, by_text], k)
+
+
+def linked_duplicates(doc_ids) -> dict[str, list[str]]:
+  # Near-duplicates that `process.py --dedup link` gave no chunks, by representative
+  if not doc_ids or not os.path.exists(DEDUP_PATH):
+    return {}
+  from src.dedup import DuplicateGroups
+  return DuplicateGroups(DEDUP_PATH).linked_members(doc_ids)
+
+
+def join_documents(results: pa.Table) -> list[dict]:
+  """
+    Attaches the document metadata to every chunk, and the metadata of the linked
+    near-duplicates of its document, which the chunk also stands for, as `duplicates`.
+    """
+  chunks = results.to_pylist()
+  doc_ids = sorted({chunk["doc_id"] for chunk in chunks})
+  duplicates = linked_duplicates(doc_ids)
+  all_ids = sorted(set(doc_ids).union(*duplicates.values()))
+  documents = {}
+  if all_ids:
+    found = get_documents_table().search().where(f"doc_id IN ({', '.join(sql_quote(doc_id) for doc_id in all_ids)})") \
+        .limit(None).to_arrow().to_pylist()
+    documents = {document["doc_id"]: document for document in found}
+  for chunk in chunks:
+    chunk["document"] = documents.get(chunk["doc_id"])
+    chunk["duplicates"] = [documents.get(doc_id) or {"doc_id": doc_id} for doc_id in duplicates.get(chunk["doc_id"], [])]
+  return chunks
+
+
+def search(query_text: str, k=10, filters: str = None, nprobes=20, refine_factor=None, mode="vector") -> list[dict]:
+  """
+    Returns the `k` best chunks for the query, each with the metadata of its document.
+    `mode` is "vector" (the query is embedded), "text" (BM25 on the full-text index) or "hybrid" (both, fused).
+    """
+  if mode not in SEARCH_MODES:
+    raise ValueError(f"Unknown search mode {mode}, use one of {', '.join(SEARCH_MODES)}")
+  if mode == "text":
+    return join_documents(search_text(query_text, k, filters))
+  embedding = get_embedding(query_text)
+  if embedding is None:
+    raise RuntimeError("Could not embed the query")
+  if mode == "hybrid":
+    results = search_hybrid(query_text, embedding[0], k, filters, nprobes, refine_factor)
+  else:
+    results = search_vector(embedding[0], k, filters, nprobes, refine_factor)
+  return join_documents(results)
@@ -0,0 +1,69 @@
+import time
+import sqlite3
+import threading
+
+STAGES = ("download", "ocr", "embed", "metadata")
+
+
+class PipelineState:
+  """
+    Per-document progress of the pipeline in a SQLite file: the last stage that
+    completed for every document, and the error of the stage that failed, if any.
+    """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._connection = None
+
+  @property
+  def connection(self):
+    if self._connection is None:
+      self._connection = sqlite3.connect(self.path, check_same_thread=False)
+      self._connection.execute("CREATE TABLE IF NOT EXISTS documents ("
+                               "doc_id TEXT PRIMARY KEY, completed TEXT, failed TEXT, "
+                               "error TEXT, updated REAL NOT NULL)")
+      self._connection.commit()
+    return self._connection
+
+  def next_stage(self, doc_id: str) -> str | None:
+    """
+      :return: The first stage the document still has to go through, or None if it is done.
+      """
+    with self._lock:
+      row = self.connection.execute("SELECT completed FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+    if row is None or row[0] is None:
+      return STAGES[0]
+    index = STAGES.index(row[0]) + 1
+    return STAGES[index] if index < len(STAGES) else None
+
+  def complete(self, doc_id: str, stage: str):
+    self._update(doc_id, stage, None, None)
+
+  def fail(self, doc_id: str, stage: str, error: str):
+    with self._lock:
+      row = self.connection.execute("SELECT completed FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+    self._update(doc_id, row[0] if row else None, stage, error)
+
+  def _update(self, doc_id, completed, failed, error):
+    with self._lock:
+      self.connection.execute(
+          "INSERT OR REPLACE INTO documents (doc_id, completed, failed, error, updated) VALUES (?, ?, ?, ?, ?)",
+          (doc_id, completed, failed, error, time.time()))
+      self.connection.commit()
+
+  def reset(self):
+    with self._lock:
+      self.connection.execute("DELETE FROM documents")
+      self.connection.commit()
+
+  def summary(self) -> dict:
+    """
+      :return: The number of documents per last completed stage, and per failed stage.
+      """
+    with self._lock:
+      completed = dict(self.connection.execute(
+          "SELECT COALESCE(completed, 'none'), COUNT(*) FROM documents GROUP BY completed").fetchall())
+      failed = dict(self.connection.execute(
+          "SELECT failed, COUNT(*) FROM documents WHERE failed IS NOT NULL GROUP BY failed").fetchall())
+    return {"completed": completed, "failed": failed}